@@ -0,0 +1,603 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_async.py
+#
+# Single-threaded OBD transport. One select() loop drives the serial
+# port, timers and any number of pollers, loggers and displays, so none
+# of them needs a thread or a lock. Python 2 has no asyncio; this is a
+# small loop with futures and generator based coroutines in its spirit:
+#
+#   @coroutine
+#   def show_rpm(port):
+#       stream = port.samples([0x0C], 10)
+#       while 1:
+#           pid, stamp, value = yield stream.next()
+#           print value
+#
+#   loop = get_event_loop()
+#   port = AsyncOBDPort("/dev/ttyUSB0")
+#   loop.run_until(port.connect())
+#   loop.run_until(show_rpm(port))
+#
+# A coroutine yields futures and gets their result back (or their error
+# raised), and ends with raise Return(value).
+###########################################################################
+
+import sys
+import time
+import heapq
+import select
+import string
+from collections import deque
+
+import serial
+
+import obd_io
+import obd_sensors
+from obd_io import OBDTimeout
+
+class CancelledError(Exception):
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+class Return(Exception):
+    """Ends a coroutine with a value: raise Return(value)"""
+    def __init__(self, value=None):
+        Exception.__init__(self)
+        self.value = value
+
+#__________________________________________________________________________
+# event loop
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.active = True
+
+    def cancel(self):
+        self.active = False
+
+class EventLoop:
+    """ Runs callbacks when file descriptors get readable or timers expire """
+    def __init__(self):
+        self.readers = {} # fd -> callback
+        self.timers = []  # heap of (when, sequence, Timer)
+        self.ready = deque()
+        self.sequence = 0
+        self.running = False
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        """Returns a Timer whose cancel() stops the call"""
+        timer = Timer(time.time() + delay, callback, args)
+        self.sequence = self.sequence + 1
+        heapq.heappush(self.timers, (timer.when, self.sequence, timer))
+        return timer
+
+    def run_once(self):
+        timeout = None
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        elif not self.readers:
+            raise RuntimeError("nothing left to wait for")
+
+        if self.readers:
+            r, w, x = select.select(self.readers.keys(), [], [], timeout)
+            for fd in r:
+                callback = self.readers.get(fd)
+                if callback is not None:
+                    callback()
+        elif timeout > 0:
+            time.sleep(timeout)
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)[2]
+            if timer.active:
+                self.ready.append((timer.callback, timer.args))
+        # callbacks queued by these run on the next pass
+        for i in range(len(self.ready)):
+            callback, args = self.ready.popleft()
+            callback(*args)
+
+    def run_until(self, future):
+        """Runs the loop until future is done, returns its result"""
+        while not future.done():
+            self.run_once()
+        return future.result()
+
+    def run_forever(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+
+default_loop = None
+
+def get_event_loop():
+    global default_loop
+    if default_loop is None:
+        default_loop = EventLoop()
+    return default_loop
+
+#__________________________________________________________________________
+# futures and coroutines
+
+class Future:
+    """ Result of an operation that finishes later. Without a loop it
+    takes the loop of the first task waiting for it, or the default. """
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.finished = False
+        self.cancelled = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def get_loop(self):
+        if self.loop is None:
+            self.loop = get_event_loop()
+        return self.loop
+
+    def result(self):
+        if not self.finished:
+            raise RuntimeError("result is not ready")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        if self.finished:
+            self.get_loop().call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, value):
+        # a late result of a cancelled operation is dropped
+        if self.finished:
+            return
+        self.value = value
+        self.finish()
+
+    def set_error(self, error):
+        if self.finished:
+            return
+        self.error = error
+        self.finish()
+
+    def cancel(self):
+        """Returns True if the future was still pending"""
+        if self.finished:
+            return False
+        self.cancelled = True
+        self.set_error(CancelledError())
+        return True
+
+    def finish(self):
+        self.finished = True
+        for callback in self.callbacks:
+            self.get_loop().call_soon(callback, self)
+        self.callbacks = []
+
+class Task(Future):
+    """ Drives a generator that yields futures. The first step runs right
+    away, so the task finds its loop in the first future it waits for. """
+    def __init__(self, gen, loop=None):
+        Future.__init__(self, loop)
+        self.gen = gen
+        self.waiting = None
+        self.step(None, None)
+
+    def cancel(self):
+        if self.finished:
+            return False
+        # cancelling what it waits for raises CancelledError in the generator
+        if self.waiting is None or not self.waiting.cancel():
+            self.waiting = None
+            self.get_loop().call_soon(self.step, None, CancelledError())
+        return True
+
+    def step(self, value, error):
+        if self.finished:
+            return
+        self.waiting = None
+        try:
+            if error is not None:
+                future = self.gen.throw(error)
+            else:
+                future = self.gen.send(value)
+        except StopIteration:
+            self.set_result(None)
+        except Return as r:
+            self.set_result(r.value)
+        except CancelledError:
+            self.cancelled = True
+            self.set_error(CancelledError())
+        except Exception as e:
+            self.set_error(e)
+        else:
+            if self.loop is None:
+                self.loop = future.loop
+            elif future.loop is None:
+                future.loop = self.loop
+            self.waiting = future
+            future.add_done_callback(self.wakeup)
+
+    def wakeup(self, future):
+        if future is not self.waiting:
+            return
+        self.step(future.value, future.error)
+
+def coroutine(func):
+    """Makes a generator function return a Task when called"""
+    def start(*args, **kwargs):
+        return Task(func(*args, **kwargs))
+    start.__name__ = func.__name__
+    start.__doc__ = func.__doc__
+    return start
+
+def sleep(delay, loop=None):
+    future = Future(loop)
+    timer = future.get_loop().call_later(delay, future.set_result, None)
+    future.add_done_callback(lambda f: timer.cancel())
+    return future
+
+def with_timeout(future, seconds, loop=None):
+    """Returns a future with the result of future, or TimeoutError after
+    seconds. On timeout future is cancelled; a command already sent still
+    has its reply read, so the port stays in step."""
+    if loop is not None and future.loop is None:
+        future.loop = loop
+    loop = future.get_loop()
+    outer = Future(loop)
+    def expire():
+        if future.cancel():
+            outer.set_error(TimeoutError("no result within %g s" % seconds))
+    timer = loop.call_later(seconds, expire)
+    def finished(f):
+        timer.cancel()
+        if f.error is not None:
+            outer.set_error(f.error)
+        else:
+            outer.set_result(f.value)
+    future.add_done_callback(finished)
+    return outer
+
+#__________________________________________________________________________
+
+def dtc_codes(reply, kind):
+    """Returns ["Active" or "Passive", code] of the DTCs in a mode 03 or 07
+    reply, 3 per message"""
+    letters = ["P", "C", "B", "U"]
+    codes = []
+    for line in string.split(reply, "\r"):
+        line = string.join(string.split(line), "")
+        for i in range(3):
+            val = obd_sensors.hex_to_int(line[2+i*4:6+i*4] or "0")
+            if val == 0: # fill of the last message
+                break
+            codes.append([kind, letters[val >> 14] + "%d%03X" % ((val >> 12) & 3, val & 0xFFF)])
+    return codes
+
+class SampleStream:
+    """ Samples of some PIDs polled at a fixed rate. next() returns a
+    future of (pid, timestamp, value), close() stops polling. """
+    def __init__(self, port, pids, hz):
+        self.port = port
+        self.pids = pids
+        self.period = 1.0 / hz
+        self.queue = deque(maxlen=1000) # samples nobody asked for yet
+        self.waiter = None
+        self.task = self.poll()
+
+    @coroutine
+    def poll(self):
+        while 1:
+            start = time.time()
+            values = yield self.port.query_many(self.pids)
+            now = time.time()
+            for pid, value in zip(self.pids, values):
+                self.push((pid, now, value))
+            yield sleep(max(0, start + self.period - time.time()), self.port.loop)
+
+    def push(self, sample):
+        if self.waiter is not None and not self.waiter.done():
+            waiter = self.waiter
+            self.waiter = None
+            waiter.set_result(sample)
+        else:
+            self.queue.append(sample)
+
+    def next(self):
+        future = Future(self.port.loop)
+        if self.queue:
+            future.set_result(self.queue.popleft())
+        else:
+            self.waiter = future
+        return future
+
+    def close(self):
+        self.task.cancel()
+        if self.waiter is not None:
+            self.waiter.cancel()
+
+class AsyncOBDPort:
+    """ OBDPort for the event loop: every command returns a future.
+    Commands queue up and go out one at a time. """
+    def __init__(self, portnum, baud=obd_io.DEFAULT_BAUD, loop=None):
+        self.loop = loop or get_event_loop()
+        self.port = serial.Serial(portnum, baud, timeout=0)
+        self.ELMver = "Unknown"
+        self.protocol = "Unknown"
+        self.State = 0
+        self.response_count = ""
+        self.deadlines = dict(obd_io.DEADLINES)
+        self.default_deadline = 2.0
+        self.cache = obd_io.ValueCache()
+        self.by_pid = obd_sensors.SENSOR_BY_PID
+        self.queue = deque() # (cmd, deadline, future) not sent yet
+        self.current = None  # (cmd, deadline, future) on the wire
+        self.timer = None
+        self.rxbuf = ""
+        self.desync = True
+        self.loop.add_reader(self.port.fileno(), self.readable)
+
+    #______________________________________________________________________
+    # transactions
+
+    def command(self, cmd, deadline=None):
+        """Returns a future of the reply to cmd, one line per "\\r". Fails
+        with OBDTimeout if the prompt does not come within deadline."""
+        future = Future(self.loop)
+        self.queue.append((cmd, deadline, future))
+        if self.current is None:
+            self.send_next()
+        return future
+
+    def command_deadline(self, cmd):
+        cmd = string.lower(cmd)
+        for prefix in (cmd[:4], cmd[:3], cmd[:2]):
+            if prefix in self.deadlines:
+                return self.deadlines[prefix]
+        return self.default_deadline
+
+    def send_next(self):
+        while self.queue:
+            cmd, deadline, future = self.queue.popleft()
+            if future.done(): # cancelled before it went out
+                continue
+            if self.desync:
+                self.port.flushInput()
+                self.rxbuf = ""
+                self.desync = False
+            if deadline is None:
+                deadline = self.command_deadline(cmd)
+            self.port.write(cmd + "\r")
+            self.current = (cmd, deadline, future)
+            self.timer = self.loop.call_later(deadline, self.timed_out)
+            return
+        self.current = None
+
+    def readable(self):
+        data = self.port.read(max(self.port.inWaiting(), 1))
+        if self.current is None: # nobody asked, drop before next command
+            self.desync = True
+            return
+        self.rxbuf = self.rxbuf + data
+        prompt = self.rxbuf.find(">")
+        if prompt < 0:
+            return
+        reply = self.rxbuf[:prompt]
+        self.rxbuf = self.rxbuf[prompt+1:]
+        self.timer.cancel()
+        future = self.current[2]
+        lines = [l for l in string.split(reply, "\r") if string.strip(l) != ""]
+        # even if the caller gave up (cancelled), the reply was consumed
+        future.set_result(string.join(lines, "\r"))
+        self.send_next()
+
+    def timed_out(self):
+        cmd, deadline, future = self.current
+        self.desync = True
+        future.set_error(OBDTimeout(cmd, deadline, string.replace(self.rxbuf, "\r", "")))
+        self.rxbuf = ""
+        self.send_next()
+
+    #______________________________________________________________________
+    # OBDPort command set
+
+    @coroutine
+    def connect(self):
+        """Resets the adapter and finds the car's protocol. Returns the
+        ELM version, or None if the car does not answer."""
+        try:
+            yield self.command("ati", obd_io.PROBE_DEADLINE)
+            cmd = "atws"
+        except OBDTimeout:
+            cmd = "atz"
+        version = yield self.command(cmd)
+        if "ELM" in version:
+            version = version[version.find("ELM"):]
+        self.ELMver = version
+        for name, value in obd_io.ADAPTER_SETTINGS:
+            yield self.command("at" + name + value)
+        try:
+            yield self.command("0100") # protocol search
+        except OBDTimeout:
+            raise Return(None)
+        self.protocol = yield self.command("atdpn")
+
+        # count the ECUs so mode 01 replies need no idle wait
+        yield self.command("ath1")
+        try:
+            lines = string.split((yield self.command("0100")), "\r")
+        except OBDTimeout:
+            lines = []
+        yield self.command("ath0")
+        ecus = set([obd_io.header_address(l, self.protocol[-1:]) for l in lines])
+        if 0 < len(ecus) < 16:
+            self.response_count = "%X" % len(ecus)
+        self.State = 1
+        raise Return(self.ELMver)
+
+    def is_can(self):
+        return self.protocol[-1:] in obd_io.CAN_PROTOCOLS
+
+    def decode(self, sensor, reply):
+        reply = obd_io.parse_reply(reply)
+        if reply.status is not None:
+            return obd_io.status_value(reply.status)
+        return sensor.value(reply.data[0][1][4:])
+
+    @coroutine
+    def query(self, pid):
+        """Returns (name, value, unit) of mode 01 pid"""
+        sensor = self.by_pid[pid]
+        value = self.cache.get(sensor)
+        if value is None:
+            try:
+                reply = yield self.command(sensor.cmd[:4] + self.response_count)
+                value = self.decode(sensor, reply)
+            except OBDTimeout:
+                value = "NORESPONSE"
+            self.cache.put(sensor, value)
+        raise Return((sensor.name, value, sensor.unit))
+
+    @coroutine
+    def query_many(self, pids):
+        """Returns the values of mode 01 pids, batched on CAN"""
+        values = {}
+        todo = []
+        for pid in pids:
+            value = self.cache.get(self.by_pid[pid])
+            if value is not None:
+                values[pid] = value
+            elif pid not in todo:
+                todo.append(pid)
+
+        batchable = self.is_can() and len(todo) > 1
+        for pid in todo:
+            batchable = batchable and pid in obd_sensors.PID_DATA_BYTES
+        if not batchable:
+            for pid in todo:
+                values[pid] = (yield self.query(pid))[1]
+            raise Return([values[pid] for pid in pids])
+
+        for i in range(0, len(todo), obd_io.MAX_BATCH_PIDS):
+            chunk = todo[i:i+obd_io.MAX_BATCH_PIDS]
+            cmd = "01" + string.join(["%02X" % pid for pid in chunk], "") + self.response_count
+            try:
+                reply = obd_io.parse_reply((yield self.command(cmd)))
+            except OBDTimeout:
+                for pid in chunk:
+                    values[pid] = "NORESPONSE"
+                continue
+            if reply.status is not None:
+                for pid in chunk:
+                    values[pid] = obd_io.status_value(reply.status)
+                continue
+            split = obd_io.split_batch_reply(reply.data[0][1], chunk)
+            if split is None: # could not demultiplex, ask one by one
+                split = {}
+                for pid in chunk:
+                    values[pid] = (yield self.query(pid))[1]
+            for pid in chunk:
+                if pid in split:
+                    sensor = self.by_pid[pid]
+                    values[pid] = sensor.value(split[pid])
+                    self.cache.put(sensor, values[pid])
+                elif pid not in values:
+                    values[pid] = "NODATA"
+        raise Return([values[pid] for pid in pids])
+
+    def get_sensor_values(self, sensors):
+        """Returns a future of the values of given Sensors"""
+        return self.query_many([s.pid for s in sensors])
+
+    def samples(self, pids, hz):
+        """Returns a SampleStream polling pids hz times a second"""
+        return SampleStream(self, pids, hz)
+
+    @coroutine
+    def get_dtc(self):
+        """Returns list of [kind, code] like OBDPort.get_dtc()"""
+        codes = []
+        try:
+            for cmd, kind in ((obd_io.GET_DTC_COMMAND, "Active"),
+                              (obd_io.GET_FREEZE_DTC_COMMAND, "Passive")):
+                reply = yield self.command(cmd)
+                if obd_io.parse_reply(reply).status is None: # not NO DATA
+                    codes.extend(dtc_codes(reply, kind))
+        except OBDTimeout:
+            pass
+        raise Return(codes)
+
+    def clear_dtc(self):
+        """Clears all DTCs and freeze frame data"""
+        return self.command(obd_io.CLEAR_DTC_COMMAND)
+
+    def close(self):
+        self.loop.remove_reader(self.port.fileno())
+        if self.State == 1:
+            self.port.write("atz\r")
+        self.port.close()
+        self.State = 0
+        self.cache.invalidate()
+
+#__________________________________________________________________________
+
+@coroutine
+def display(stream):
+    while 1:
+        pid, stamp, value = yield stream.next()
+        sys.stdout.write("\r%02X: %-12s" % (pid, value))
+        sys.stdout.flush()
+
+@coroutine
+def log(stream, path):
+    f = open(path, "a")
+    try:
+        while 1:
+            pid, stamp, value = yield stream.next()
+            f.write("%.3f,%02X,%s\n" % (stamp, pid, value))
+    finally:
+        f.close()
+
+if __name__ == "__main__":
+    # poll rpm and speed, show and log them from one thread
+    if len(sys.argv) < 2:
+        print "usage: obd_async.py PORT [LOGFILE]"
+        sys.exit(1)
+    loop = get_event_loop()
+    port = AsyncOBDPort(sys.argv[1])
+    if loop.run_until(port.connect()) is None:
+        print "Not connected"
+        sys.exit(1)
+    print "Connected, " + port.ELMver
+    tasks = [display(port.samples([0x0C, 0x0D], 4))]
+    if len(sys.argv) > 2:
+        tasks.append(log(port.samples([0x0C, 0x0D], 10), sys.argv[2]))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    port.close()
@@ -0,0 +1,719 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_bench.py
+#
+# Benchmarks for the OBD I/O path, run against the ELM327 emulator so no
+# car is needed.
+#
+#   python obd_bench.py                  full suite -> bench_results.json
+#   python obd_bench.py -o FILE suite    suite, results to FILE
+#   python obd_bench.py reader fanout    selected microbenchmarks
+#
+# The suite drives OBDPort.sensor, OBD_Recorder.record_data and
+# OBD_Capture.capture_data under every latency profile and reports
+# samples per second, round trip percentiles per PID, CPU time, memory
+# retained per sample and, with tracemalloc, the peak memory of a run.
+# Allocations per sample are not counted: neither tracemalloc nor the gc
+# counters tell freed allocations apart from ones never made. Results
+# carry the git commit so runs can be compared across commits.
+###########################################################################
+
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import resource
+import shutil
+import string
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+
+import obd_io
+import obd_sensors
+import obd_daemon
+import obd_profile
+import obd_async
+import obd_fleet
+import obd_can
+from obd_emulator import ELM327Emulator, CANResponder, ECU, DEFAULT_VALUES
+from obd_recorder import OBD_Recorder
+from obd_capture import OBD_Capture
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+# what measure() can tell about memory held after a scenario
+RETAINED_KEY = tracemalloc and "retained_bytes_per_sample" or "retained_objects_per_sample"
+
+# (protocol, ECU latency s, baud) of the emulated adapter
+PROFILES = {
+    "can-fast"   : ("6", 0.005, 115200),
+    "can-typical": ("6", 0.015, 38400),
+    "kline"      : ("3", 0.05, 38400),
+    }
+# sensors read by the OBDPort.sensor and recorder scenarios
+BENCH_ITEMS = ["rpm", "speed", "throttle_pos", "load", "temp", "maf"]
+
+# replies in the forms adapters print them, with the protocol if headers
+# are on: spaces on and off, several ECUs, multiframe, K-line, messages
+REPLY_CORPUS = [
+    ("41 0C 1A F8 \r", None),
+    ("410C1AF8", None),
+    ("410D00\r", None),
+    ("410C1AF80D0011260446051E", None),
+    ("41 00 BE 3E B8 11 \r41 00 98 3B 00 11 \r", None),
+    ("SEARCHING...\r41 00 BE 3E B8 11 \r", None),
+    ("BUS INIT: ...OK\r41 05 7B \r", None),
+    ("014\r0: 49 02 01 31 50 59 \r1: 4F 42 44 30 45 4D 55 \r2: 30 30 30 30 30 30 31 \r", None),
+    ("7E8 04 41 0C 1A F8 \r7E9 03 41 0D 20 \r", "6"),
+    ("7E8064100BE3EB811\r7E9064100983B0011\r", "6"),
+    ("18DAF110 04 41 0C 1A F8 \r", "7"),
+    ("48 6B 10 41 0C 1A F8 3A \r", "3"),
+    ("NO DATA\r", None),
+    ("CAN ERROR\r", None),
+    ("BUFFER FULL\r", None),
+    ("STOPPED\r", None),
+    ("?\r", None),
+    ("41 0C 1A <DATA ERROR\r", None),
+    ("SEARCHING...\rUNABLE TO CONNECT\r", None),
+    ]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def spawn(emulator):
+    """Runs emulator in a child process so its CPU time is not counted"""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            emulator.run()
+        finally:
+            os._exit(0)
+    return pid
+
+def open_port(emulator, max_baud=None):
+    # no stored profiles, every run connects cold
+    port = obd_io.OBDPort(emulator.name, None, 2, 2, profiles=obd_profile.ProfileStore(os.devnull),
+                          baud=emulator.baud or obd_io.DEFAULT_BAUD, max_baud=max_baud)
+    if port.State == 0:
+        print "Could not open emulated adapter"
+        sys.exit(1)
+    return port
+
+class TimedPort:
+    """ Wraps OBDPort and records the round trip of every sensor read """
+    def __init__(self, port):
+        self.port = port
+        self.rtt = {} # shortname -> list of seconds
+        self.samples = 0
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+    def record(self, sensors, elapsed):
+        for s in sensors:
+            self.rtt.setdefault(s.shortname, []).append(elapsed)
+        self.samples = self.samples + len(sensors)
+
+    def sensor(self, sensor_index):
+        start = time.time()
+        r = self.port.sensor(sensor_index)
+        self.record([obd_sensors.SENSORS[sensor_index]], time.time() - start)
+        return r
+
+    def sensors(self, sensor_indexes):
+        start = time.time()
+        r = self.port.sensors(sensor_indexes)
+        self.record([obd_sensors.SENSORS[i] for i in sensor_indexes], time.time() - start)
+        return r
+
+    def get_sensor_values(self, sensors):
+        start = time.time()
+        r = self.port.get_sensor_values(sensors)
+        self.record(sensors, time.time() - start)
+        return r
+
+    def read_samples(self, samples, sensors=None):
+        if sensors is None:
+            sensors = [obd_sensors.SENSORS[s.pid] for s in samples]
+        start = time.time()
+        r = self.port.read_samples(samples, sensors)
+        self.record(sensors, time.time() - start)
+        return r
+
+def measure(port, func):
+    """Runs func() against a TimedPort and returns its statistics"""
+    timed = TimedPort(port)
+    # memory still held after the run, not what was allocated and freed
+    # on the way: traced bytes, or gc tracked objects without tracemalloc
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+    else:
+        before = len(gc.get_objects())
+    cpu = cpu_time()
+    start = time.time()
+
+    func(timed)
+
+    elapsed = time.time() - start
+    cpu = cpu_time() - cpu
+    if tracemalloc:
+        traced, peak = tracemalloc.get_traced_memory()
+        retained = traced - before
+        tracemalloc.stop()
+    else:
+        retained = len(gc.get_objects()) - before
+
+    samples = max(timed.samples, 1)
+    result = {
+        "samples": timed.samples,
+        "seconds": elapsed,
+        "samples_per_second": timed.samples / elapsed,
+        "cpu_ms_per_sample": cpu * 1000 / samples,
+        RETAINED_KEY: float(retained) / samples,
+        "pids": {},
+        }
+    if tracemalloc: # high-water mark of everything func() had at once
+        result["peak_bytes"] = peak - before
+    for shortname, rtt in timed.rtt.items():
+        result["pids"][shortname] = {
+            "p50_ms": percentile(rtt, 50) * 1000,
+            "p95_ms": percentile(rtt, 95) * 1000,
+            "p99_ms": percentile(rtt, 99) * 1000,
+            }
+    return result
+
+def item_indexes(items):
+    return [obd_sensors.SENSOR_BY_NAME[item].pid for item in items]
+
+def scenario_sensor(count):
+    """OBDPort.sensor() over the bench items, one PID per request"""
+    indexes = item_indexes(BENCH_ITEMS)
+    def run(port):
+        for i in range(count):
+            port.sensor(indexes[i % len(indexes)])
+    return run
+
+def scenario_recorder(cycles):
+    """OBD_Recorder.record_data() logging the bench items"""
+    def run(port):
+        path = tempfile.mkdtemp()
+        try:
+            recorder = OBD_Recorder(path + "/", BENCH_ITEMS)
+            recorder.port = port
+            recorder.record_data(cycles)
+            recorder.log_file.close()
+        finally:
+            shutil.rmtree(path)
+    return run
+
+def scenario_capture(port):
+    """OBD_Capture.capture_data(), one screen of supported sensors.
+    Its seconds include the 3 s settle sleep of capture_data()."""
+    capture = OBD_Capture()
+    capture.port = port
+    capture.capture_data()
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(output, quick=False):
+    count = quick and 30 or 200
+    results = {"commit": git_commit(), "time": time.time(), "profiles": {}}
+    print "memory: %s; allocations per sample are not measured" % \
+          (tracemalloc and "retained bytes per sample, peak per run" or
+           "retained objects per sample, no peak without tracemalloc")
+    for name in sorted(PROFILES.keys()):
+        protocol, latency, baud = PROFILES[name]
+        emulator = ELM327Emulator(protocol, latency, baud)
+        emulator.reset_time = 0.1
+        emulator.search_time = 0.1
+        child = spawn(emulator)
+        try:
+            port = open_port(emulator)
+            profile = {}
+            profile["sensor"] = measure(port, scenario_sensor(count))
+            profile["recorder"] = measure(port, scenario_recorder(count / len(BENCH_ITEMS)))
+            profile["capture"] = measure(port, scenario_capture)
+            port.close()
+        finally:
+            os.kill(child, 15)
+            os.waitpid(child, 0)
+        results["profiles"][name] = profile
+        for scenario in ("sensor", "recorder", "capture"):
+            r = profile[scenario]
+            print "%-12s %-9s %7.1f samples/s  cpu %.3f ms/sample  retained %.1f %s/sample%s" % \
+                  (name, scenario, r["samples_per_second"], r["cpu_ms_per_sample"],
+                   r[RETAINED_KEY], tracemalloc and "bytes" or "objects",
+                   tracemalloc and "  peak %.0f KB" % (r["peak_bytes"] / 1024.0) or "")
+
+    f = open(output, "w")
+    json.dump(results, f, indent=1, sort_keys=True)
+    f.close()
+    print "results written to " + output
+
+#__________________________________________________________________________
+# microbenchmarks
+
+def bench_reader(count=2000, repeat=False):
+    """Replies per second through send_command() + get_result()"""
+    emulator = ELM327Emulator(latency=0, baud=0)
+    emulator.reset_time = 0
+    emulator.search_time = 0
+    emulator.start()
+    port = open_port(emulator)
+    port.repeat_last = repeat
+    start = time.time()
+    for i in range(count):
+        port.send_command("010C1") # one response expected, no idle wait
+        port.get_result()
+    elapsed = time.time() - start
+    port.close()
+    print "reader%s: %d replies in %.3f s, %.0f replies/s" % \
+          (repeat and " (repeat)" or "", count, elapsed, count / elapsed)
+
+def old_parse(code):
+    """What read_reply(), get_result() and interpret_result() did with a
+    reply before parse_reply(), for comparison"""
+    lines = string.split(code, "\r")
+    code = string.join([l for l in lines if string.strip(l) != ""], "\r")
+    code = string.replace(code, "\r", "")
+    code = string.join(string.split(code), "")
+    if code[:6] == "NODATA":
+        return "NODATA"
+    return code[4:]
+
+def bench_parser(count=20000):
+    """parse_reply() over REPLY_CORPUS against the old reply handling, and
+    how many adapter messages the old one passed on as data"""
+    corpus = (REPLY_CORPUS * (count / len(REPLY_CORPUS) + 1))[:count]
+    start = time.time()
+    for reply, protocol in corpus:
+        old_parse(reply)
+    old = time.time() - start
+    start = time.time()
+    for reply, protocol in corpus:
+        obd_io.parse_reply(reply, protocol)
+    new = time.time() - start
+    misread = 0
+    for reply, protocol in REPLY_CORPUS:
+        if obd_io.parse_reply(reply, protocol).status not in (None, "NODATA") and \
+           old_parse(reply) != "NODATA":
+            misread = misread + 1
+    print "parser: parse_reply %.2f us/reply, before %.2f us/reply" % \
+          (new * 1e6 / count, old * 1e6 / count)
+    print "parser: %d of %d adapter messages in the corpus were data to the old parser" % \
+          (misread, len([r for r in REPLY_CORPUS if obd_io.parse_reply(*r).status not in (None, "NODATA")]))
+
+def bench_decode(count=100000):
+    """Decodes per second of every mode 01 sensor the emulated car reports,
+    from the hex string of an ELM327 reply (Sensor.value) and from raw
+    bytes (Sensor.decode)"""
+    for pid in sorted(DEFAULT_VALUES.keys()):
+        sensor = obd_sensors.SENSORS[pid]
+        data = string.join([chr(b) for b in DEFAULT_VALUES[pid]], "")
+        code = string.upper(data.encode("hex"))
+        value, decode = sensor.value, sensor.decode
+        start = time.time()
+        for i in xrange(count):
+            value(code)
+        hex_rate = count / (time.time() - start)
+        start = time.time()
+        for i in xrange(count):
+            decode(data)
+        raw_rate = count / (time.time() - start)
+        print "decode %-22s hex %9.0f/s  raw %9.0f/s%s" % \
+              (sensor.shortname, hex_rate, raw_rate, sensor.raw is None and " (via hex)" or "")
+
+class DictSample:
+    """ obd_io.Sample as a plain class with an instance dictionary """
+    def __init__(self, pid):
+        self.stamp = None
+        self.pid = pid
+        self.data = None
+        self.value = None
+
+def rss_bytes():
+    try:
+        return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def held_bytes(build):
+    """Bytes held by what build() returns: traced by tracemalloc when there
+    is one, else the resident size growth of a forked child"""
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+        records = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        before = rss_bytes()
+        records = build()
+        os.write(w, str(rss_bytes() - before))
+        os._exit(0)
+    os.close(w)
+    size = int(os.read(r, 64))
+    os.close(r)
+    os.waitpid(pid, 0)
+    return size
+
+# what one Sensor may take with its __slots__, not counting shared values
+MAX_SENSOR_BYTES = 128
+
+def bench_memory(count=1000000):
+    """Memory of a million rpm samples kept as the 3-tuples of
+    OBDPort.sensor(), as 4-tuples of the fields of a Sample, as Sample
+    records without and with __slots__, and the size of the Sensor
+    objects. Exits with an error if __slots__ stopped saving memory."""
+    sensor = obd_sensors.SENSORS[0x0C]
+    def tuples():
+        return [(sensor.name, float(i), sensor.unit) for i in xrange(count)]
+    def fields():
+        return [(float(i), sensor.pid, "1AF8", float(i)) for i in xrange(count)]
+    def records(cls):
+        def build():
+            samples = []
+            for i in xrange(count):
+                sample = cls(sensor.pid)
+                sample.stamp = float(i)
+                sample.data = "1AF8"
+                sample.value = float(i)
+                samples.append(sample)
+            return samples
+        return build
+    method = tracemalloc and "tracemalloc" or "resident size"
+    old = held_bytes(tuples)
+    same = held_bytes(fields)
+    plain = held_bytes(records(DictSample))
+    slotted = held_bytes(records(obd_io.Sample))
+    print "memory per %d samples (%s):" % (count, method)
+    print "  sensor() 3-tuples      %6.1f MB (no time or data)" % (old / 1e6)
+    print "  4-tuples of the fields %6.1f MB" % (same / 1e6)
+    print "  Sample, instance dict  %6.1f MB" % (plain / 1e6)
+    print "  Sample, __slots__      %6.1f MB (%.1f MB less than instance dict)" % \
+          (slotted / 1e6, (plain - slotted) / 1e6)
+    # a plain class copy of a Sensor to compare with the slotted one
+    copy = DictSample(0)
+    copy.__dict__ = dict([(name, getattr(sensor, name)) for name in obd_sensors.Sensor.__slots__])
+    sensor_bytes = sys.getsizeof(sensor)
+    copy_bytes = sys.getsizeof(copy) + sys.getsizeof(copy.__dict__)
+    print "Sensor: %d bytes with __slots__, %d with instance dict, %d sensors" % \
+          (sensor_bytes, copy_bytes, len(obd_sensors.SENSORS))
+
+    failures = []
+    if slotted >= plain:
+        failures.append("Sample with __slots__ holds no less than with instance dict")
+    if slotted > same:
+        failures.append("Sample holds more than a tuple of its fields")
+    if sensor_bytes > MAX_SENSOR_BYTES:
+        failures.append("Sensor takes %d bytes, more than %d" % (sensor_bytes, MAX_SENSOR_BYTES))
+    if sensor_bytes >= copy_bytes:
+        failures.append("Sensor with __slots__ takes no less than with instance dict")
+    for failure in failures:
+        print "FAIL: " + failure
+    if failures:
+        sys.exit(1)
+
+def bench_fanout(clients=10, hz=20, duration=3.0):
+    """Latency from sample read in the daemon to arrival at each of
+    several subscribed clients"""
+    emulator = ELM327Emulator(latency=0.002, baud=0)
+    emulator.reset_time = 0
+    emulator.search_time = 0
+    emulator.start()
+    port = open_port(emulator)
+    path = "/tmp/pyobd-bench-%d.sock" % os.getpid()
+    server = obd_daemon.OBDDaemon(port, path)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    latencies = []
+    lock = threading.Lock()
+    def subscriber():
+        client = obd_daemon.DaemonClient(path)
+        client.subscribe([12], hz)
+        end = time.time() + duration
+        for (index, stamp, value) in client.samples():
+            now = time.time()
+            lock.acquire()
+            latencies.append(now - stamp)
+            lock.release()
+            if now > end:
+                break
+        client.close()
+    threads = [threading.Thread(target=subscriber) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    server.shutdown()
+    server.server_close()
+    port.close()
+
+    print "fanout: %d clients, %d samples, latency p50 %.3f ms, p99 %.3f ms, max %.3f ms" % \
+          (clients, len(latencies), percentile(latencies, 50) * 1000,
+           percentile(latencies, 99) * 1000, max(latencies) * 1000)
+
+def bench_startup(runs=3):
+    """Time from opening the port to a ready OBDPort, with the emulator's
+    default reset and protocol search times. Cold starts search the
+    protocol, warm starts reuse the stored vehicle profile."""
+    emulator = ELM327Emulator()
+    emulator.start()
+    path = tempfile.mkdtemp()
+    profiles = obd_profile.ProfileStore(path + "/profiles")
+    times = {"cold": [], "warm": []}
+    try:
+        for kind in ("cold", "warm"):
+            for i in range(runs):
+                if kind == "cold":
+                    profiles.forget(emulator.name)
+                emulator.searched = False # a new session searches again
+                emulator.auto = True
+                start = time.time()
+                port = obd_io.OBDPort(emulator.name, None, 2, 2, profiles=profiles)
+                times[kind].append(time.time() - start)
+                port.close()
+                time.sleep(emulator.reset_time) # close() resets the adapter
+    finally:
+        shutil.rmtree(path)
+    for kind in ("cold", "warm"):
+        print "startup %s: %s s" % (kind, string.join(["%.2f" % t for t in times[kind]], ", "))
+    print "(protocol search %.1f s)" % emulator.search_time
+
+def bench_baud(count=200):
+    """Batched polling of the bench items at the power-on rate and after
+    ATBRD negotiation"""
+    sensors = [obd_sensors.SENSORS[i] for i in item_indexes(BENCH_ITEMS)]
+    for max_baud in (None, 500000):
+        emulator = ELM327Emulator(latency=0.002)
+        emulator.reset_time = 0.1
+        emulator.search_time = 0.1
+        emulator.start()
+        port = open_port(emulator, max_baud)
+        start = time.time()
+        for i in range(count):
+            port.get_batch_values(sensors)
+        elapsed = time.time() - start
+        print "baud %6d: %.0f samples/s" % (port.port.baudrate, count * len(sensors) / elapsed)
+        port.close()
+        emulator.stop()
+
+def bench_async(count=300, duration=2.0):
+    """AsyncOBDPort.query() against OBDPort.sensor() one PID at a time,
+    then three sample streams at different rates on one loop"""
+    emulator = ELM327Emulator(latency=0.005)
+    emulator.reset_time = 0.1
+    emulator.search_time = 0.1
+    emulator.start()
+    port = open_port(emulator)
+    start = time.time()
+    for i in range(count):
+        port.sensor(12)
+    print "sync: %.0f queries/s" % (count / (time.time() - start))
+    port.close()
+    time.sleep(emulator.reset_time * 2) # the atz of close() is answered
+
+    loop = obd_async.EventLoop()
+    port = obd_async.AsyncOBDPort(emulator.name, loop=loop)
+    loop.run_until(port.connect())
+    @obd_async.coroutine
+    def queries():
+        for i in range(count):
+            yield port.query(0x0C)
+    start = time.time()
+    loop.run_until(queries())
+    print "async: %.0f queries/s" % (count / (time.time() - start))
+
+    received = {}
+    @obd_async.coroutine
+    def consume(name, stream):
+        end = time.time() + duration
+        while time.time() < end:
+            yield stream.next()
+            received[name] = received.get(name, 0) + 1
+        stream.close()
+    tasks = [consume("poll 20 Hz", port.samples([0x0C, 0x0D], 20)),
+             consume("log 10 Hz", port.samples([0x05, 0x11], 10)),
+             consume("display 4 Hz", port.samples([0x0C], 4))]
+    for task in tasks:
+        loop.run_until(task)
+    print "async streams over %.0f s: %s" % (duration, string.join(
+        ["%s %d samples" % item for item in sorted(received.items())], ", "))
+    port.close()
+
+def bench_fleet(adapters=16, duration=5.0):
+    """Adapters logged at once by one FleetManager thread, each against
+    its own emulator process"""
+    emulators = []
+    children = []
+    for i in range(adapters):
+        emulator = ELM327Emulator(latency=0.015)
+        emulator.reset_time = 0.1
+        emulator.search_time = 0.3
+        emulators.append(emulator)
+        children.append(spawn(emulator))
+    try:
+        fleet = obd_fleet.FleetManager(obd_async.EventLoop())
+        for i, emulator in enumerate(emulators):
+            fleet.add(emulator.name, name="adapter%d" % i)
+        threads = threading.active_count()
+        cpu = cpu_time()
+        fleet.run(duration)
+        cpu = cpu_time() - cpu
+    finally:
+        for child in children:
+            os.kill(child, 15)
+            os.waitpid(child, 0)
+
+    fleet.print_report()
+    report = fleet.report()
+    total = sum([r[2] for r in report])
+    print "fleet: %d adapters, %d thread(s), %.0f samples/s total, cpu %.0f%% over %.0f s" % \
+          (adapters, threads, total, cpu * 100 / duration, duration)
+
+def bench_can(interface="vcan0", count=300):
+    """CANPort straight on SocketCAN against the ELM327 at its fastest,
+    one PID per request and in batches"""
+    sensors = [obd_sensors.SENSORS[i] for i in item_indexes(BENCH_ITEMS)]
+    try:
+        responder = CANResponder(interface, latency=0.001)
+    except (socket.error, IOError), e:
+        print "can: cannot open %s (%s), create it with" % (interface, e)
+        print "  ip link add dev %s type vcan && ip link set up %s" % (interface, interface)
+        return
+    child = spawn(responder)
+    try:
+        port = obd_can.CANPort(interface)
+        start = time.time()
+        for i in range(count):
+            port.sensor(12)
+        print "socketcan: %.0f sensor/s" % (count / (time.time() - start))
+        start = time.time()
+        for i in range(count):
+            port.get_sensor_values(sensors)
+        print "socketcan: %.0f samples/s batched" % (count * len(sensors) / (time.time() - start))
+        port.close()
+    finally:
+        os.kill(child, 15)
+        os.waitpid(child, 0)
+
+    emulator = ELM327Emulator(latency=0.001)
+    emulator.reset_time = 0.1
+    emulator.search_time = 0.1
+    emulator.start()
+    port = open_port(emulator, 500000)
+    start = time.time()
+    for i in range(count):
+        port.sensor(12)
+    print "elm327:    %.0f sensor/s" % (count / (time.time() - start))
+    start = time.time()
+    for i in range(count):
+        port.get_batch_values(sensors)
+    print "elm327:    %.0f samples/s batched" % (count * len(sensors) / (time.time() - start))
+    port.close()
+    emulator.stop()
+
+def bench_monitor(duration=3.0):
+    """Frames per second captured in monitor mode (ATMA at 500000 baud)
+    against the rate on the emulated bus, with the frames lost in the
+    ring and in the adapter"""
+    for rate in (500, 1000, 2000, 3000):
+        emulator = ELM327Emulator(latency=0.002)
+        emulator.reset_time = 0.1
+        emulator.search_time = 0.1
+        emulator.traffic = [(0x100 + i, rate / 10, [i] * 8) for i in range(10)]
+        emulator.tester_rate = 0
+        child = spawn(emulator)
+        try:
+            port = open_port(emulator, 500000)
+            cpu = cpu_time()
+            monitor = port.monitor(filters=[(0x100, 0x7F8)])
+            time.sleep(duration)
+            monitor.stop()
+            cpu = cpu_time() - cpu
+            stats = monitor.stats()
+            port.close()
+        finally:
+            os.kill(child, 15)
+            os.waitpid(child, 0)
+        print "monitor %4d frames/s on the bus: %5.0f captured/s, %d passed filter, " \
+              "%d ring overflows, %d adapter overflows, cpu %.0f%%" % \
+              (rate, stats["frames_per_s"], stats["frames"], stats["overflows"],
+               stats["adapter_overflows"], cpu * 100 / duration)
+
+def bench_ecus(count=200):
+    """Batched polling of the bench items when one ECU answers (headers
+    off) and when engine and transmission both answer (headers on)"""
+    sensors = [obd_sensors.SENSORS[i] for i in item_indexes(BENCH_ITEMS)]
+    for ecus in ([ECU("7E8")], [ECU("7E8"), ECU("7E9", {0x00: [0x98, 0x3B, 0x00, 0x11],
+                                                        0x05: [0x90], 0x0D: [0x20]})]):
+        emulator = ELM327Emulator(latency=0.002, ecus=ecus)
+        emulator.reset_time = 0.1
+        emulator.search_time = 0.1
+        emulator.start()
+        port = open_port(emulator, 500000)
+        start = time.time()
+        for i in range(count):
+            port.get_batch_values(sensors)
+        elapsed = time.time() - start
+        print "%d ECU(s), headers %s: %.0f samples/s" % \
+              (len(port.ecus), port.headers and "on" or "off", count * len(sensors) / elapsed)
+        port.close()
+        emulator.stop()
+
+BENCHMARKS = {
+    "memory": lambda: bench_memory(),
+    "decode": lambda: bench_decode(),
+    "parser": lambda: bench_parser(),
+    "ecus": lambda: bench_ecus(),
+    "monitor": lambda: bench_monitor(),
+    "can": lambda: bench_can(),
+    "fleet": lambda: bench_fleet(),
+    "async": lambda: bench_async(),
+    "baud": lambda: bench_baud(),
+    "reader": lambda: (bench_reader(), bench_reader(repeat=True)),
+    "fanout": lambda: bench_fanout(),
+    "startup": lambda: bench_startup(),
+    }
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] [suite] [" +
+                          string.join(sorted(BENCHMARKS.keys()), "] [") + "]")
+    parser.add_option("-o", "--output", default="bench_results.json",
+                      help="where the suite writes its results")
+    parser.add_option("-q", "--quick", action="store_true",
+                      help="fewer samples per scenario")
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        args = ["suite"]
+    for name in args:
+        if name == "suite":
+            bench_suite(options.output, options.quick)
+        elif name in BENCHMARKS:
+            BENCHMARKS[name]()
+        else:
+            parser.error("unknown benchmark: " + name)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_broker.py
+#
+# Lets several threads share one OBDPort. Only one transaction is on the
+# serial line at a time, and threads asking for the same sensor within
+# a short window share a single request and all get its value.
+###########################################################################
+
+import sys
+import threading
+import time
+
+# OBDPort methods that are one half of a transaction; locked one by one
+# another thread could get its command in between, so use command()
+RAW_IO = ("send_command", "read_reply", "read_response", "get_result",
+          "get_results", "read_until")
+
+class Request:
+    """ One pending sensor read and the threads waiting for it """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 1
+
+class AcquisitionBroker:
+    """ Thread-safe front end of an OBDPort with request coalescing """
+    def __init__(self, port, window=0.005):
+        self.port = port
+        self.window = window # seconds a request waits for others to join
+        self.lock = threading.Lock()      # guards pending
+        self.port_lock = threading.Lock() # one transaction at a time
+        self.pending = {} # sensor index -> Request not yet on the bus
+        self.transactions = 0
+        self.coalesced = 0
+
+    def __getattr__(self, name):
+        # State, ELMver, port... come from the wrapped OBDPort; its methods
+        # (get_dtc, supported_pids...) get the serial line to themselves
+        if name in RAW_IO:
+            raise AttributeError("%s is not shared, use command()" % name)
+        attr = getattr(self.port, name)
+        if not callable(attr):
+            return attr
+        def locked_method(*args, **kwargs):
+            return self.locked(attr, *args, **kwargs)
+        return locked_method
+
+    def command(self, cmd, deadline=None):
+        """Sends cmd and returns the reply like get_result(), with no other
+        thread on the serial line in between"""
+        def transaction():
+            self.port.send_command(cmd)
+            return self.port.get_result(deadline)
+        return self.locked(transaction)
+
+    def sensor(self, sensor_index):
+        """Returns 3-tuple of given sensor, same as OBDPort.sensor()"""
+        self.lock.acquire()
+        req = self.pending.get(sensor_index)
+        if req is not None: # someone is about to ask, ride along
+            req.waiters = req.waiters + 1
+            self.coalesced = self.coalesced + 1
+            self.lock.release()
+            req.done.wait()
+            if req.error is not None:
+                raise req.error[0], req.error[1], req.error[2]
+            return req.result
+        req = Request()
+        self.pending[sensor_index] = req
+        self.lock.release()
+
+        if self.window > 0:
+            time.sleep(self.window)
+        self.port_lock.acquire()
+        try:
+            # from here on new requests start their own transaction
+            self.lock.acquire()
+            del self.pending[sensor_index]
+            self.lock.release()
+            try:
+                req.result = self.port.sensor(sensor_index)
+            except:
+                req.error = sys.exc_info()
+            self.transactions = self.transactions + 1
+        finally:
+            self.port_lock.release()
+            req.done.set()
+        if req.error is not None:
+            raise req.error[0], req.error[1], req.error[2]
+        return req.result
+
+    def sensors(self, sensor_indexes):
+        """Returns list of 3-tuples, same as OBDPort.sensors()"""
+        return self.locked(self.port.sensors, sensor_indexes)
+
+    def get_sensor_values(self, sensors):
+        return self.locked(self.port.get_sensor_values, sensors)
+
+    def get_dtc(self):
+        return self.locked(self.port.get_dtc)
+
+    def clear_dtc(self):
+        return self.locked(self.port.clear_dtc)
+
+    def get_tests_MIL(self):
+        return self.locked(self.port.get_tests_MIL)
+
+    def close(self):
+        return self.locked(self.port.close)
+
+    def locked(self, func, *args, **kwargs):
+        """Calls func with the serial line to itself"""
+        self.port_lock.acquire()
+        try:
+            self.transactions = self.transactions + 1
+            return func(*args, **kwargs)
+        finally:
+            self.port_lock.release()
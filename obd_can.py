@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_can.py
+#
+# OBD-II straight over Linux SocketCAN (ISO 15765-4), without an ELM327
+# and its AT command layer in between. CANPort offers the sensor() /
+# get_dtc() interface of OBDPort:
+#
+#   port = CANPort("can0")            # 11 bit ids, 500 kbit set by ip link
+#   port = CANPort("can0", extended=True) # 29 bit ids
+#   print port.sensor(12)
+#
+# Requests go to the functional address (all ECUs) unless a target ECU
+# is given; replies longer than one frame are reassembled (ISO-TP) with
+# flow control sent to the answering ECU. For development without a car:
+#
+#   ip link add dev vcan0 type vcan && ip link set up vcan0
+#   python obd_emulator.py --can vcan0
+###########################################################################
+
+import os
+import time
+import fcntl
+import select
+import socket
+import string
+import struct
+import ctypes
+import ctypes.util
+
+import obd_io
+import obd_sensors
+from obd_io import split_batch_reply
+
+# linux/can.h
+AF_CAN = getattr(socket, "AF_CAN", 29)
+CAN_RAW = getattr(socket, "CAN_RAW", 1)
+SOL_CAN_RAW = 101
+CAN_RAW_FILTER = 1
+CAN_EFF_FLAG = 0x80000000
+CAN_EFF_MASK = 0x1FFFFFFF
+CAN_SFF_MASK = 0x7FF
+SIOCGIFINDEX = 0x8933
+# struct can_frame: id, length, 3 pad bytes, 8 data bytes
+CAN_FRAME = struct.Struct("=IB3x8s")
+
+# ISO 15765-4 addressing
+FUNCTIONAL_11 = 0x7DF
+FUNCTIONAL_29 = 0x18DB33F1
+
+# seconds an ECU may take to answer (P2 CAN is 50 ms, some are slower)
+RESPONSE_TIMEOUT = 0.1
+# fill byte of unused data bytes, frames are always 8 bytes long
+PADDING = 0x00
+
+def request_id(response_id, extended):
+    """Returns the physical request id of the ECU answering on response_id"""
+    if extended: # 18DAF1xx -> 18DAxxF1
+        return 0x18DA00F1 | ((response_id & 0xFF) << 8)
+    return response_id - 8 # 7E8 -> 7E0
+
+def is_response_id(can_id, extended):
+    if extended:
+        return can_id & 0x1FFFFF00 == 0x18DAF100
+    return 0x7E8 <= can_id <= 0x7EF
+
+#__________________________________________________________________________
+
+class CANSocket:
+    """ Raw CAN socket bound to one interface. Uses socket.AF_CAN where
+    Python has it, else opens the socket through libc. """
+    def __init__(self, interface):
+        self.interface = interface
+        self.sock = None
+        if hasattr(socket, "AF_CAN"):
+            self.sock = socket.socket(AF_CAN, socket.SOCK_RAW, CAN_RAW)
+            self.sock.bind((interface,))
+            self.fd = self.sock.fileno()
+            return
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.socket(AF_CAN, socket.SOCK_RAW, CAN_RAW)
+        if self.fd < 0:
+            raise socket.error(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        try:
+            ifreq = fcntl.ioctl(self.fd, SIOCGIFINDEX, struct.pack("16si", interface, 0))
+            ifindex = struct.unpack("16si", ifreq)[1]
+            # struct sockaddr_can: family, interface index, address union
+            addr = ctypes.create_string_buffer(struct.pack("HxxI16x", AF_CAN, ifindex))
+            if libc.bind(self.fd, addr, len(addr.raw)) < 0:
+                raise socket.error(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        except (IOError, socket.error):
+            os.close(self.fd)
+            raise
+        self.libc = libc
+
+    def set_filters(self, filters):
+        """Passes only frames matching one of (id, mask)"""
+        data = "".join([struct.pack("=II", can_id, mask) for can_id, mask in filters])
+        if self.sock is not None:
+            self.sock.setsockopt(SOL_CAN_RAW, CAN_RAW_FILTER, data)
+            return
+        buf = ctypes.create_string_buffer(data)
+        if self.libc.setsockopt(self.fd, SOL_CAN_RAW, CAN_RAW_FILTER, buf, len(data)) < 0:
+            raise socket.error(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def send(self, can_id, data, extended=False):
+        """Sends one frame, data is a string of up to 8 bytes"""
+        if extended:
+            can_id = can_id | CAN_EFF_FLAG
+        data = data + chr(PADDING) * (8 - len(data))
+        os.write(self.fd, CAN_FRAME.pack(can_id, 8, data))
+
+    def recv(self, timeout=None):
+        """Returns (id, data) of the next frame, or None after timeout"""
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return None
+        can_id, length, data = CAN_FRAME.unpack(os.read(self.fd, CAN_FRAME.size))
+        if can_id & CAN_EFF_FLAG:
+            return (can_id & CAN_EFF_MASK, data[:length])
+        return (can_id & CAN_SFF_MASK, data[:length])
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        else:
+            os.close(self.fd)
+
+#__________________________________________________________________________
+# ISO 15765-2 transport
+
+def isotp_frames(payload):
+    """Splits payload (string) into the data of single frame, or first
+    frame and consecutive frames"""
+    if len(payload) <= 7:
+        return [chr(len(payload)) + payload]
+    frames = [chr(0x10 | (len(payload) >> 8)) + chr(len(payload) & 0xFF) + payload[:6]]
+    index = 1
+    for i in range(6, len(payload), 7):
+        frames.append(chr(0x20 | (index & 0xF)) + payload[i:i+7])
+        index = index + 1
+    return frames
+
+def isotp_send(sock, tx_id, rx_id, payload, extended, timeout=1.0):
+    """Sends payload to tx_id; a multiframe message waits for the flow
+    control of rx_id and honors its block size and separation time"""
+    frames = isotp_frames(payload)
+    sock.send(tx_id, frames[0], extended)
+    frames = frames[1:]
+    while frames:
+        # flow control: 30 = go on, 31 = wait, 32 = overflow
+        frame = sock.recv(timeout)
+        if frame is None:
+            return False
+        can_id, data = frame
+        if can_id != rx_id or ord(data[0]) & 0xF0 != 0x30:
+            continue
+        status = ord(data[0]) & 0x0F
+        if status == 1:
+            continue
+        if status != 0:
+            return False
+        block = ord(data[1]) or len(frames)
+        st = ord(data[2])
+        if st > 0x7F: # 100 us steps from F1
+            st = 0
+        for frame in frames[:block]:
+            if st:
+                time.sleep(st / 1000.0)
+            sock.send(tx_id, frame, extended)
+        frames = frames[block:]
+    return True
+
+class Reassembler:
+    """ Collects the ISO-TP messages of several senders at once """
+    def __init__(self, sock, extended):
+        self.sock = sock
+        self.extended = extended
+        self.partial = {} # sender id -> [expected length, data, next index]
+
+    def feed(self, can_id, data):
+        """Returns the complete payload once a message is done, else None"""
+        kind = ord(data[0]) >> 4
+        if kind == 0: # single frame
+            return data[1:1 + (ord(data[0]) & 0x0F)]
+        if kind == 1: # first frame, tell the sender to go on
+            length = ((ord(data[0]) & 0x0F) << 8) | ord(data[1])
+            self.partial[can_id] = [length, data[2:8], 1]
+            self.sock.send(request_id(can_id, self.extended), "\x30\x00\x00", self.extended)
+            return None
+        if kind == 2: # consecutive frame
+            entry = self.partial.get(can_id)
+            if entry is None or ord(data[0]) & 0x0F != entry[2] & 0x0F:
+                self.partial.pop(can_id, None) # lost a frame, drop message
+                return None
+            entry[1] = entry[1] + data[1:8]
+            entry[2] = entry[2] + 1
+            if len(entry[1]) >= entry[0]:
+                del self.partial[can_id]
+                return entry[1][:entry[0]]
+        return None
+
+#__________________________________________________________________________
+
+class CANFrameSource:
+    """ Frames of a CANPort's interface for obd_io.CANMonitor """
+    can = True
+
+    def __init__(self, port, filters=None):
+        self.port = port
+        self.filters = filters
+        self.overflows = 0 # the kernel drops frames silently
+
+    def start(self):
+        self.port.sock.set_filters(self.filters or [(0, 0)])
+
+    def read(self):
+        """Returns the frames received so far, waits for the first"""
+        recv = self.port.sock.recv
+        frame = recv(obd_io.POLL_INTERVAL)
+        frames = []
+        while frame is not None and len(frames) < 64:
+            frames.append(frame)
+            frame = recv(0)
+        return frames
+
+    def parse(self, frame):
+        return frame
+
+    def stop(self):
+        self.port.sock.set_filters(self.port.filters)
+
+def hexstring(data):
+    return string.join(["%02X" % ord(c) for c in data], "")
+
+class CANPort:
+    """ OBD-II over SocketCAN with the interface of OBDPort """
+    def __init__(self, interface="can0", extended=False, timeout=RESPONSE_TIMEOUT):
+        self.interface = interface
+        self.extended = extended
+        self.timeout = timeout
+        self.ELMver = "SocketCAN"
+        self.protocol = extended and "7" or "6"
+        self.State = 0
+        self.ecus = [] # response ids of the ECUs that answered 0100
+        self.cache = obd_io.ValueCache()
+        self.sock = CANSocket(interface)
+        if extended:
+            self.filters = [(0x18DAF100 | CAN_EFF_FLAG, 0x1FFFFF00 | CAN_EFF_FLAG)]
+        else:
+            self.filters = [(0x7E8, 0x7F8 | CAN_EFF_FLAG)]
+        self.sock.set_filters(self.filters)
+        self.reassembler = Reassembler(self.sock, extended)
+
+        replies = self.request("\x01\x00")
+        if len(replies) == 0:
+            return
+        self.ecus = sorted(replies.keys())
+        self.State = 1
+
+    def request(self, payload, target=None):
+        """Sends payload to all ECUs (functional) or to the ECU answering
+        on target (physical). Returns dict of response id -> payload.
+        Stops waiting when every known ECU answered."""
+        if target is not None:
+            tx_id = request_id(target, self.extended)
+            expected = 1
+        else:
+            tx_id = self.extended and FUNCTIONAL_29 or FUNCTIONAL_11
+            expected = len(self.ecus) or None
+        self.sock.send(tx_id, isotp_frames(payload)[0], self.extended) # up to 7 bytes
+
+        replies = {}
+        end = time.time() + self.timeout
+        while expected is None or len(replies) < expected:
+            now = time.time()
+            if now > end:
+                break
+            frame = self.sock.recv(end - now)
+            if frame is None:
+                break
+            can_id, data = frame
+            if target is not None and can_id != target:
+                continue
+            message = self.reassembler.feed(can_id, data)
+            if message is None:
+                if can_id in self.reassembler.partial: # more frames coming
+                    end = time.time() + self.timeout
+                continue
+            if ord(message[0]) == 0x7F and len(message) > 2 and ord(message[2]) == 0x78:
+                end = time.time() + 5.0 # response pending, ECU needs longer
+                continue
+            if ord(message[0]) == ord(payload[0]) + 0x40:
+                replies[can_id] = message
+        return replies
+
+    def is_can(self):
+        return True
+
+    def first_reply(self, replies):
+        """Internal use only: not a public interface"""
+        for ecu in self.ecus + sorted(replies.keys()):
+            if ecu in replies:
+                return replies[ecu]
+        return None
+
+    def get_sensor_value(self, sensor):
+        """Returns the value of a mode 01 Sensor"""
+        value = self.cache.get(sensor)
+        if value is not None:
+            return value
+        replies = self.request(chr(0x01) + chr(sensor.pid))
+        if len(replies) == 0: # timeout, caller moves on
+            return "NORESPONSE"
+        if sensor.pid in obd_io.SUPPORT_PIDS:
+            # every ECU answers with the PIDs it knows, OR their bitmaps
+            code = obd_io.merged_bitmap([(ecu, hexstring(reply)) for ecu, reply in replies.items()],
+                                        sensor.pid)
+            if code is None:
+                return "NODATA"
+            value = sensor.value(code)
+            self.cache.put(sensor, value)
+            return value
+        value = sensor.decode(self.first_reply(replies)[2:])
+        self.cache.put(sensor, value)
+        return value
+
+    def get_sensor_values(self, sensors):
+        """Returns values of given Sensors, up to 6 PIDs per request"""
+        values = {}
+        todo = []
+        for s in sensors:
+            value = self.cache.get(s)
+            if value is not None:
+                values[s.shortname] = value
+            elif s not in todo:
+                todo.append(s)
+        for i in range(0, len(todo), obd_io.MAX_BATCH_PIDS):
+            chunk = todo[i:i+obd_io.MAX_BATCH_PIDS]
+            pids = [s.pid for s in chunk]
+            if len(chunk) == 1 or [p for p in pids if p not in obd_sensors.PID_DATA_BYTES]:
+                for s in chunk:
+                    values[s.shortname] = self.get_sensor_value(s)
+                continue
+            replies = self.request(chr(0x01) + string.join([chr(p) for p in pids], ""))
+            # several ECUs may each answer part of the PIDs
+            split = {}
+            for ecu in self.ecus + sorted(replies.keys()):
+                if ecu in replies:
+                    for pid, data in (split_batch_reply(hexstring(replies[ecu]), pids) or {}).items():
+                        if pid not in split:
+                            split[pid] = data
+                        elif pid in obd_io.SUPPORT_PIDS:
+                            split[pid] = obd_io.merge_bitmaps(split[pid], data)
+            for s, pid in zip(chunk, pids):
+                if pid in split:
+                    values[s.shortname] = s.value(split[pid])
+                    self.cache.put(s, values[s.shortname])
+                elif len(replies) == 0:
+                    values[s.shortname] = "NORESPONSE"
+                else:
+                    values[s.shortname] = "NODATA"
+        return [values[s.shortname] for s in sensors]
+
+    def sensor(self, sensor_index):
+        """Returns 3-tuple of given sensors. 3-tuple consists of
+        (Sensor Name (string), Sensor Value (string), Sensor Unit (string) ) """
+        sensor = obd_sensors.SENSORS[sensor_index]
+        return (sensor.name, self.get_sensor_value(sensor), sensor.unit)
+
+    def sensors(self, sensor_indexes):
+        """Returns list of 3-tuples of given sensors, read in batches"""
+        sensors = [obd_sensors.SENSORS[i] for i in sensor_indexes]
+        values = self.get_sensor_values(sensors)
+        return [(s.name, v, s.unit) for s, v in zip(sensors, values)]
+
+    def read_samples(self, samples, sensors=None):
+        """Refills preallocated Samples, same as OBDPort (without data)"""
+        return obd_io.read_samples(self, samples, sensors)
+
+    def supported_pids(self):
+        """Returns SupportedPIDs of the car, same as OBDPort"""
+        return obd_io.read_supported_pids(self)
+
+    def sensor_names(self):
+        """Internal use only: not a public interface"""
+        return [s.name for s in obd_sensors.SENSORS]
+
+    def get_dtc(self):
+        """Returns a list of [kind, code] like OBDPort.get_dtc()"""
+        letters = ["P", "C", "B", "U"]
+        codes = []
+        for mode, kind in ((0x03, "Active"), (0x07, "Passive")):
+            replies = self.request(chr(mode))
+            for ecu in sorted(replies.keys()):
+                data = replies[ecu][2:] # response, number of DTCs
+                for i in range(0, len(data) - 1, 2):
+                    val = (ord(data[i]) << 8) | ord(data[i+1])
+                    if val == 0:
+                        continue
+                    codes.append([kind, letters[val >> 14] + "%d%03X" % ((val >> 12) & 3, val & 0xFFF)])
+        return codes
+
+    def clear_dtc(self):
+        """Clears all DTCs and freeze frame data"""
+        return len(self.request(chr(0x04))) > 0
+
+    def monitor(self, filters=None, decoders=None, callback=None,
+                size=obd_io.MONITOR_RING_SIZE):
+        """Captures all traffic on the interface, returns the running
+        obd_io.CANMonitor. The filters are also set in the kernel."""
+        monitor = obd_io.CANMonitor(CANFrameSource(self, filters), filters,
+                                    decoders, callback, size)
+        monitor.start()
+        return monitor
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.State = 0
+        self.cache.invalidate()
@@ -4,10 +4,11 @@ import obd_io
 import serial
 import platform
 import obd_sensors
+import obd_daemon
 from datetime import datetime
 import time
 
-from obd_utils import scanSerial
+from obd_utils import find_adapter
 
 class OBD_Capture():
     def __init__(self):
@@ -16,15 +17,13 @@ class OBD_Capture():
         localtime = time.localtime(time.time())
 
     def connect(self):
-        portnames = scanSerial()
-        print portnames
-        for port in portnames:
-            self.port = obd_io.OBDPort(port, None, 2, 2)
-            if(self.port.State == 0):
-                self.port.close()
-                self.port = None
-            else:
-                break
+        # share the adapter with other programs if the daemon runs
+        self.port = obd_daemon.connect_daemon()
+        if(self.port):
+            print "Connected to daemon serving "+self.port.port.name
+            return
+
+        self.port = find_adapter()
 
         if(self.port):
             print "Connected to "+self.port.port.name
@@ -39,19 +38,19 @@ class OBD_Capture():
 
         text = ""
         #Find supported sensors - by getting PIDs from OBD
-        # its a string of binary 01010101010101 
-        # 1 means the sensor is supported
-        self.supp = self.port.sensor(0)[1]
+        self.supp = self.port.supported_pids()
         self.supportedSensorList = []
         self.unsupportedSensorList = []
 
-        # loop through PIDs binary
-        for i in range(0, len(self.supp)):
-            if self.supp[i] == "1":
+        # index of a sensor is its PID
+        for i in range(1, len(obd_sensors.SENSORS)):
+            if i in obd_io.SUPPORT_PIDS: # bitmaps of other PIDs, not sensors
+                continue
+            if i in self.supp:
                 # store index of sensor and sensor object
-                self.supportedSensorList.append([i+1, obd_sensors.SENSORS[i+1]])
+                self.supportedSensorList.append([i, obd_sensors.SENSORS[i]])
             else:
-                self.unsupportedSensorList.append([i+1, obd_sensors.SENSORS[i+1]])
+                self.unsupportedSensorList.append([i, obd_sensors.SENSORS[i]])
         
         for supportedSensor in self.supportedSensorList:
             text += "supported sensor index = " + str(supportedSensor[0]) + " " + str(supportedSensor[1].shortname) + "\n"
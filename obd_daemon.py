@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_daemon.py
+#
+# Owns the one OBDPort and serves it to local clients (GUI, recorder...)
+# over a Unix socket, so logging and display can run at the same time.
+#
+#   python obd_daemon.py [socket path]
+#
+# Wire format: every message is a header "!BH" (message type, payload
+# length) followed by the payload. Sensor values travel as entries of
+# "!Bd" (sensor index, timestamp) + "!c" type tag + value:
+#   'i' "!q" integer, 'f' "!d" float, 's' "!H" length + string
+###########################################################################
+
+import os
+import sys
+import socket
+import struct
+import threading
+import time
+import SocketServer
+from collections import deque
+
+import obd_io
+import obd_sensors
+import obd_scheduler
+from obd_broker import AcquisitionBroker
+from obd_utils import find_adapter
+
+DAEMON_SOCKET = "/tmp/pyobd.sock"
+
+# client -> daemon
+MSG_QUERY       = 1 # "!B" count + count * "!B" sensor index
+MSG_SUBSCRIBE   = 2 # "!f" Hz + "!B" count + count * "!B" sensor index
+MSG_UNSUBSCRIBE = 3 # empty
+MSG_INFO        = 4 # empty
+# daemon -> client
+MSG_VALUES      = 16 # "!B" count + count * entry, reply to MSG_QUERY
+MSG_SAMPLES     = 17 # "!B" count + count * entry, pushed to subscribers
+MSG_INFO_REPLY  = 18 # "!H" length + ELM version, "!H" length + port name
+
+HEADER = struct.Struct("!BH")
+ENTRY  = struct.Struct("!Bd")
+
+#__________________________________________________________________________
+# message packing shared by daemon and client
+
+def pack_entries(entries):
+    """Packs list of (index, timestamp, value)"""
+    parts = [struct.pack("!B", len(entries))]
+    for index, stamp, value in entries:
+        parts.append(ENTRY.pack(index, stamp))
+        if type(value) in (int, long):
+            parts.append("i" + struct.pack("!q", value))
+        elif type(value) == float:
+            parts.append("f" + struct.pack("!d", value))
+        else:
+            value = str(value)
+            parts.append("s" + struct.pack("!H", len(value)) + value)
+    return "".join(parts)
+
+def unpack_entries(payload):
+    """Returns list of (index, timestamp, value)"""
+    entries = []
+    pos = 1
+    for i in range(ord(payload[0])):
+        index, stamp = ENTRY.unpack_from(payload, pos)
+        tag = payload[pos + ENTRY.size]
+        pos = pos + ENTRY.size + 1
+        if tag == "i":
+            value = struct.unpack_from("!q", payload, pos)[0]
+            pos = pos + 8
+        elif tag == "f":
+            value = struct.unpack_from("!d", payload, pos)[0]
+            pos = pos + 8
+        else:
+            length = struct.unpack_from("!H", payload, pos)[0]
+            value = payload[pos+2:pos+2+length]
+            pos = pos + 2 + length
+        entries.append((index, stamp, value))
+    return entries
+
+def pack_indexes(indexes):
+    return struct.pack("!B", len(indexes)) + "".join([chr(i) for i in indexes])
+
+def unpack_indexes(payload):
+    return [ord(c) for c in payload[1:1+ord(payload[0])]]
+
+def pack_string(s):
+    return struct.pack("!H", len(s)) + s
+
+def send_message(sock, msgtype, payload=""):
+    sock.sendall(HEADER.pack(msgtype, len(payload)) + payload)
+
+def recv_exact(sock, size):
+    data = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if chunk == "":
+            return None
+        data.append(chunk)
+        size = size - len(chunk)
+    return "".join(data)
+
+def recv_message(sock):
+    """Returns (message type, payload) or None when the peer is gone"""
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    msgtype, length = HEADER.unpack(header)
+    payload = recv_exact(sock, length)
+    if payload is None:
+        return None
+    return (msgtype, payload)
+
+#__________________________________________________________________________
+
+class ClientHandler(SocketServer.BaseRequestHandler):
+    """ Serves requests of one connected client """
+    def setup(self):
+        self.send_lock = threading.Lock() # replies and pushed samples
+
+    def send(self, msgtype, payload):
+        self.send_lock.acquire()
+        try:
+            send_message(self.request, msgtype, payload)
+        finally:
+            self.send_lock.release()
+
+    def handle(self):
+        server = self.server
+        while 1:
+            try:
+                msg = recv_message(self.request)
+            except socket.error:
+                break
+            if msg is None:
+                break
+            msgtype, payload = msg
+            if msgtype == MSG_QUERY:
+                indexes = unpack_indexes(payload)
+                values = server.query(indexes)
+                now = time.time()
+                self.send(MSG_VALUES, pack_entries(
+                    [(i, now, v) for i, v in zip(indexes, values)]))
+            elif msgtype == MSG_SUBSCRIBE:
+                hz = struct.unpack_from("!f", payload)[0]
+                server.subscribe(self, unpack_indexes(payload[4:]), hz)
+            elif msgtype == MSG_UNSUBSCRIBE:
+                server.unsubscribe(self)
+            elif msgtype == MSG_INFO:
+                self.send(MSG_INFO_REPLY, pack_string(server.port.ELMver) +
+                          pack_string(server.port.port.portstr))
+
+    def finish(self):
+        self.server.unsubscribe(self)
+
+class OBDDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """ Shares one OBDPort between local clients """
+    daemon_threads = True
+
+    def __init__(self, port, path=DAEMON_SOCKET):
+        if os.path.exists(path): # left over from a previous run
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, ClientHandler)
+        self.path = path
+        self.port = port
+        self.broker = AcquisitionBroker(port)
+        self.subscribers = {} # handler -> (indexes, Hz)
+        self.sub_lock = threading.Lock()
+        self.changed = threading.Event()
+        self.running = True
+        self.publisher = threading.Thread(target=self.publish)
+        self.publisher.daemon = True
+        self.publisher.start()
+
+    def query(self, indexes):
+        """One-shot read, single sensors are coalesced with other clients"""
+        if len(indexes) == 1:
+            return [self.broker.sensor(indexes[0])[1]]
+        return [s[1] for s in self.broker.sensors(indexes)]
+
+    def subscribe(self, handler, indexes, hz):
+        self.sub_lock.acquire()
+        self.subscribers[handler] = (indexes, hz)
+        self.sub_lock.release()
+        self.changed.set()
+
+    def unsubscribe(self, handler):
+        self.sub_lock.acquire()
+        removed = self.subscribers.pop(handler, None)
+        self.sub_lock.release()
+        if removed is not None:
+            self.changed.set()
+
+    def publish(self):
+        """Polls the subscribed sensors at the highest rate anyone asked
+        for and pushes every sample to the clients that want it."""
+        scheduler = None
+        while self.running:
+            if self.changed.is_set() or scheduler is None:
+                self.changed.clear()
+                self.sub_lock.acquire()
+                subscribers = self.subscribers.items()
+                self.sub_lock.release()
+                rates = {}
+                for handler, (indexes, hz) in subscribers:
+                    for i in indexes:
+                        shortname = obd_sensors.SENSORS[i].shortname
+                        rates[shortname] = max(rates.get(shortname, 0), hz)
+                scheduler = obd_scheduler.PollScheduler(self.broker, rates)
+                index_of = dict([(c.shortname, c.index) for c in scheduler.channels])
+            if len(scheduler.channels) == 0:
+                self.changed.wait(1.0)
+                continue
+
+            try:
+                samples = scheduler.poll()
+            except Exception as e:
+                # the adapter is gone or the serial line broke; close the
+                # subscribers so they notice instead of waiting forever
+                print >> sys.stderr, "Polling failed, closing subscribers: %s" % e
+                for handler, (indexes, hz) in subscribers:
+                    self.disconnect(handler)
+                scheduler = None
+                self.changed.wait(1.0)
+                continue
+            now = time.time()
+            entries = [(index_of[shortname], now, value) for shortname, value in samples]
+            for handler, (indexes, hz) in subscribers:
+                wanted = [e for e in entries if e[0] in indexes]
+                if len(wanted) == 0:
+                    continue
+                try:
+                    handler.send(MSG_SAMPLES, pack_entries(wanted))
+                except socket.error:
+                    self.unsubscribe(handler)
+
+    def disconnect(self, handler):
+        """Unsubscribes handler and shuts its socket, its client sees the
+        daemon close the connection"""
+        self.unsubscribe(handler)
+        try:
+            handler.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def server_close(self):
+        self.running = False
+        self.changed.set()
+        self.publisher.join()
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+#__________________________________________________________________________
+
+class RemoteSerial:
+    """ Stands in for OBDPort.port so code printing port.port.name works """
+    def __init__(self, name):
+        self.name = name
+        self.portstr = name
+
+class DaemonClient:
+    """ Talks to OBDDaemon, offers the sensor interface of OBDPort """
+    def __init__(self, path=DAEMON_SOCKET):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.backlog = deque(maxlen=1000) # samples received while querying
+        self.State = 1
+        send_message(self.sock, MSG_INFO)
+        payload = self.wait_for(MSG_INFO_REPLY)
+        length = struct.unpack_from("!H", payload)[0]
+        self.ELMver = payload[2:2+length]
+        self.port = RemoteSerial(payload[4+length:])
+
+    def wait_for(self, msgtype):
+        while 1:
+            msg = recv_message(self.sock)
+            if msg is None:
+                self.State = 0
+                raise socket.error("daemon closed the connection")
+            if msg[0] == msgtype:
+                return msg[1]
+            if msg[0] == MSG_SAMPLES:
+                self.backlog.extend(unpack_entries(msg[1]))
+
+    def sensors(self, sensor_indexes):
+        """Returns list of 3-tuples, same as OBDPort.sensors()"""
+        send_message(self.sock, MSG_QUERY, pack_indexes(sensor_indexes))
+        entries = unpack_entries(self.wait_for(MSG_VALUES))
+        result = []
+        for index, stamp, value in entries:
+            s = obd_sensors.SENSORS[index]
+            result.append((s.name, value, s.unit))
+        return result
+
+    def sensor(self, sensor_index):
+        """Returns 3-tuple of given sensor, same as OBDPort.sensor()"""
+        return self.sensors([sensor_index])[0]
+
+    def read_samples(self, samples, sensors=None):
+        """Refills preallocated Samples, same as OBDPort (without data)"""
+        return obd_io.read_samples(self, samples, sensors)
+
+    def supported_pids(self):
+        """Returns SupportedPIDs of the car, same as OBDPort"""
+        return obd_io.read_supported_pids(self)
+
+    def get_sensor_values(self, sensors):
+        indexes = [s.pid for s in sensors]
+        return [r[1] for r in self.sensors(indexes)]
+
+    def subscribe(self, sensor_indexes, hz):
+        """Asks the daemon to push given sensors hz times a second"""
+        send_message(self.sock, MSG_SUBSCRIBE,
+                     struct.pack("!f", hz) + pack_indexes(sensor_indexes))
+
+    def unsubscribe(self):
+        send_message(self.sock, MSG_UNSUBSCRIBE)
+
+    def samples(self):
+        """Yields (sensor index, timestamp, value) of subscribed sensors"""
+        while 1:
+            while self.backlog:
+                yield self.backlog.popleft()
+            self.backlog.extend(unpack_entries(self.wait_for(MSG_SAMPLES)))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.State = 0
+
+def connect_daemon(path=DAEMON_SOCKET):
+    """Returns DaemonClient if a daemon is running, else None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        return DaemonClient(path)
+    except socket.error:
+        return None
+
+if __name__ == "__main__":
+    path = DAEMON_SOCKET
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+
+    port = find_adapter()
+    if port is None:
+        print "Not connected"
+        sys.exit(1)
+
+    print "Serving " + port.port.name + " on " + path
+    server = OBDDaemon(port, path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    port.close()
@@ -0,0 +1,596 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_emulator.py
+#
+# ELM327 emulator on a pseudo terminal. OBDPort opens the pty like any
+# serial adapter, so throughput can be measured without a car:
+#
+#   python obd_emulator.py [protocol]      prints the pty to connect to
+#   python obd_emulator.py --can vcan0 [--extended]
+#                                          ECUs on a SocketCAN interface
+#
+# or from Python:
+#
+#   emu = ELM327Emulator(protocol="6", latency=0.02)
+#   emu.set_value(0x0C, [0x1A, 0xF8])
+#   emu.start()
+#   port = obd_io.OBDPort(emu.name, None, 2, 2)
+#
+# Timing model: every OBD request costs the ECU latency, then the
+# adapter waits for further ECUs (ATST, shortened by adaptive timing)
+# unless the expected number of responses was given after the PIDs.
+# Replies are slowed down to the configured baud rate; K-line protocols
+# add their slow bus bit time and inter-request gap. Input sent at a baud
+# rate other than the adapter's (as set on the pty by the host) is lost,
+# ATBRD switches the rate like the real handshake. ATMA prints the frames
+# of traffic and a polling scan tool, BUFFER FULL if the rate is too low.
+###########################################################################
+
+import os
+import sys
+import time
+import atexit
+import select
+import termios
+import threading
+
+import obd_can
+
+PROTOCOLS = {
+    "1": "SAE J1850 PWM",
+    "2": "SAE J1850 VPW",
+    "3": "ISO 9141-2",
+    "4": "ISO 14230-4 (KWP 5BAUD)",
+    "5": "ISO 14230-4 (KWP FAST)",
+    "6": "ISO 15765-4 (CAN 11/500)",
+    "7": "ISO 15765-4 (CAN 29/500)",
+    "8": "ISO 15765-4 (CAN 11/250)",
+    "9": "ISO 15765-4 (CAN 29/250)",
+    }
+CAN_PROTOCOLS = ["6", "7", "8", "9"]
+
+# termios speed code -> baud rate, python 2 lacks the constants above 230400
+SPEEDS = {0o010004: 460800, 0o010005: 500000}
+for rate in (9600, 19200, 38400, 57600, 115200, 230400):
+    SPEEDS[getattr(termios, "B%d" % rate)] = rate
+
+# values of a mid-size petrol car at idle
+DEFAULT_VALUES = {
+    0x00: [0xBE, 0x3E, 0xB8, 0x11], 0x01: [0x00, 0x07, 0x65, 0x00],
+    0x03: [0x02, 0x00], 0x04: [0x3C], 0x05: [0x7B], 0x06: [0x80],
+    0x07: [0x82], 0x0B: [0x21], 0x0C: [0x0C, 0x80], 0x0D: [0x00],
+    0x0E: [0x8C], 0x0F: [0x46], 0x10: [0x02, 0x5A], 0x11: [0x24],
+    0x13: [0x03], 0x14: [0x5A, 0x80], 0x15: [0x5A, 0x80], 0x1C: [0x06],
+    0x1F: [0x01, 0x2C], 0x20: [0x80, 0x00, 0x00, 0x00],
+    }
+
+# broadcast frames of the emulated CAN bus shown by ATMA: (11 bit id,
+# frames per second, 8 data bytes or callable(t) returning them)
+DEFAULT_TRAFFIC = [
+    (0x0C9, 100, [0x80, 0x0C, 0x80, 0x00, 0x24, 0x00, 0x00, 0x00]), # engine
+    (0x0F1, 100, [0x00, 0x00, 0x10, 0x40, 0x00, 0x00, 0x00, 0x00]), # brake
+    (0x1E9, 50, [0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]),  # wheels
+    (0x3C9, 10, [0x46, 0x00, 0x8C, 0x00, 0x00, 0x00, 0x00, 0x00]),  # climate
+    ]
+# seconds stop() waits for a command being answered, e.g. a protocol search
+STOP_TIMEOUT = 5.0
+# text the adapter can hold while the host reads too slowly, after that
+# it prints BUFFER FULL and leaves monitor mode
+MONITOR_BUFFER = 512
+
+class ECU:
+    """ One control unit on the emulated bus """
+    def __init__(self, address, values=None, dtcs=None, vin="1PYOBD0EMU0000001"):
+        self.address = address # CAN id like "7E8", or K-line source byte
+        if values is None:
+            values = dict(DEFAULT_VALUES)
+        self.values = values   # PID -> list of bytes or callable(t)
+        if dtcs is None:
+            dtcs = []
+        self.dtcs = dtcs       # stored DTCs as 2-byte ints, e.g. 0x0133
+        self.freeze_dtcs = []
+        self.vin = vin         # None if the ECU does not report one
+
+    def value(self, pid):
+        v = self.values.get(pid)
+        if callable(v):
+            v = v(time.time())
+        return v
+
+class Bus:
+    """ How the ECUs answer requests. Users set protocol, silent (PIDs
+    the ECUs ignore) and dtc_count (mode 03 replies carry the number of
+    DTCs, as on raw CAN). """
+    dtc_count = False
+
+    def ecu_reply(self, ecu, data):
+        """Returns response bytes of ecu to request data, a list of them
+        if the ECU answers with several messages, None if silent"""
+        mode = data[0]
+        if mode == 0x01:
+            pids = data[1:]
+            if len(pids) == 0 or len(pids) > 6:
+                return None
+            if len(pids) > 1 and self.protocol not in CAN_PROTOCOLS:
+                return None # only CAN ECUs take several PIDs
+            payload = [0x41]
+            for pid in pids:
+                value = ecu.value(pid)
+                if value is not None and pid not in self.silent:
+                    payload = payload + [pid] + list(value)
+            if len(payload) == 1:
+                return None
+            return payload
+        if mode == 0x03 or mode == 0x07:
+            dtcs = mode == 0x03 and ecu.dtcs or ecu.freeze_dtcs
+            if len(dtcs) == 0 and mode == 0x07:
+                return None
+            if self.dtc_count: # ISO 15765-4: count, then all DTCs
+                payload = [mode + 0x40, len(dtcs)]
+                for dtc in dtcs:
+                    payload = payload + [dtc >> 8, dtc & 0xFF]
+                return payload
+            payload = [mode + 0x40]
+            for dtc in dtcs[:3]:
+                payload = payload + [dtc >> 8, dtc & 0xFF]
+            return payload + [0] * (7 - len(payload))
+        if mode == 0x04:
+            ecu.dtcs = []
+            ecu.freeze_dtcs = []
+            return [0x44]
+        if mode == 0x09 and data[1:] == [0x02]:
+            if ecu.vin is None:
+                return None
+            vin = [ord(c) for c in ecu.vin]
+            if self.protocol in CAN_PROTOCOLS:
+                return [0x49, 0x02, 0x01] + vin
+            # older protocols: 5 messages, the first padded with zeros
+            vin = [0] * 3 + vin
+            return [[0x49, 0x02, i + 1] + vin[i*4:i*4+4] for i in range(5)]
+        return None
+
+class ELM327Emulator(threading.Thread, Bus):
+    """ Scriptable ELM327 behind a pty """
+    def __init__(self, protocol="6", latency=None, baud=38400, ecus=None,
+                 version="ELM327 v1.5"):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.protocol = protocol
+        if latency is None: # typical first-response time of the ECU
+            latency = protocol in CAN_PROTOCOLS and 0.015 or 0.05
+        self.latency = latency
+        self.baud = baud # 0 disables the wire time model and baud checks
+        self.default_baud = baud # after ATZ
+        self.max_baud = 500000 # fastest rate adapter and cable can do
+        self.brd = True # knows ATBRD
+        self.brt = 0.075 # ATBRT, wait for the host to confirm a new rate
+        if ecus is None:
+            if protocol in ("7", "9"):
+                ecus = [ECU("18DAF110")]
+            else:
+                ecus = [ECU(protocol in CAN_PROTOCOLS and "7E8" or "10")]
+        self.ecus = ecus
+        self.version = version
+        self.reset_time = 1.0 # ATZ, incl. LED test
+        self.warm_start_time = 0.3 # ATWS
+        self.search_time = 1.5 # automatic protocol search
+        self.silent = [] # PIDs the ECUs ignore, for timeout tests
+        self.traffic = list(DEFAULT_TRAFFIC) # frames ATMA shows
+        self.tester_rate = 20 # a scan tool polling rpm, 0 for none
+        self.commands = 0
+        self.master, self.slave = os.openpty()
+        self.name = os.ttyname(self.slave)
+        self.running = True # until stop(), also when run() in a child
+        self.reset()
+
+    #______________________________________________________________________
+    # scripting
+
+    def set_value(self, pid, value, ecu=0):
+        """Sets reply bytes (list of ints or callable(t)) of a mode 01 PID"""
+        self.ecus[ecu].values[pid] = value
+
+    def set_dtcs(self, dtcs, ecu=0):
+        self.ecus[ecu].dtcs = list(dtcs)
+
+    def start(self):
+        threading.Thread.start(self)
+        atexit.register(self.stop) # ends the thread before the interpreter
+
+    def stop(self):
+        """Ends the thread and closes the pty"""
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(STOP_TIMEOUT)
+        if self.master is not None and not self.is_alive():
+            os.close(self.master)
+            os.close(self.slave)
+            self.master = self.slave = None
+
+    #______________________________________________________________________
+    # adapter state
+
+    def reset(self):
+        """Power-on defaults, as after ATZ"""
+        self.echo = True
+        self.linefeeds = False
+        self.spaces = True
+        self.headers = False
+        self.memory = True
+        self.can_format = True # ATCAF, hide ISO-TP byte and padding
+        self.timeout = 0x32 * 0.004096 # ATST
+        self.adaptive = 1 # ATAT
+        self.auto = True
+        self.searched = False
+        self.last = ""
+        self.last_request = 0
+
+    def run(self):
+        pending = ""
+        while self.running:
+            r, w, x = select.select([self.master], [], [], 0.1)
+            if not r:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            if self.baud and self.host_baud() != self.baud:
+                continue # framing errors, nothing readable
+            pending = pending + data
+            while "\r" in pending:
+                cmd, pending = pending.split("\r", 1)
+                self.handle(cmd)
+
+    def host_baud(self):
+        return SPEEDS.get(termios.tcgetattr(self.slave)[5])
+
+    def change_baud(self, divisor, echo):
+        """ATBRD handshake: OK at the old rate, ID at the new one, which
+        is kept if the host answers with a CR within ATBRT"""
+        try:
+            rate = 4000000.0 / int(divisor, 16)
+        except (ValueError, ZeroDivisionError):
+            rate = None
+        for standard in SPEEDS.values(): # UARTs tolerate a few percent
+            if rate and abs(rate - standard) < standard * 0.03:
+                rate = standard
+        if not self.brd or rate is None:
+            self.write(echo + "?\r\r>")
+            return
+        self.write(echo + "OK\r")
+        old = self.baud
+        self.baud = rate
+        if rate > self.max_baud: # the host sees garbage
+            self.write("\xfe\x80\xf8")
+        else:
+            self.write(self.version + "\r")
+        r, w, x = select.select([self.master], [], [], self.brt)
+        confirmed = False
+        if r:
+            data = os.read(self.master, 1024)
+            confirmed = "\r" in data and rate <= self.max_baud and \
+                        self.host_baud() == rate
+        if not confirmed:
+            self.baud = old
+        self.write(">")
+
+    def write(self, text):
+        if self.baud:
+            time.sleep(len(text) * 10.0 / self.baud) # start + 8 + stop bits
+        os.write(self.master, text)
+
+    def handle(self, cmd):
+        cmd = "".join(cmd.split()).upper()
+        if cmd == "":
+            cmd = self.last # empty CR repeats the last command
+        self.commands = self.commands + 1
+        reply = self.echo and (cmd + "\r") or ""
+        if cmd[:5] == "ATBRD":
+            self.change_baud(cmd[5:], reply)
+            return
+        if cmd == "ATMA":
+            self.monitor(reply)
+            return
+        if cmd[:2] == "AT":
+            lines = self.at_command(cmd[2:])
+        elif cmd != "":
+            self.last = cmd
+            lines = self.obd_request(cmd)
+        else:
+            lines = []
+        eol = self.linefeeds and "\r\n" or "\r"
+        if lines:
+            reply = reply + eol.join(lines) + eol + eol
+        self.write(reply + ">")
+
+    def at_command(self, cmd):
+        """Returns reply lines of an AT command (without the AT)"""
+        if cmd == "Z":
+            time.sleep(self.reset_time)
+            self.reset()
+            self.baud = self.default_baud
+            return ["", self.version]
+        if cmd == "WS":
+            time.sleep(self.warm_start_time)
+            self.reset()
+            return ["", self.version]
+        if cmd == "I":
+            return [self.version]
+        if cmd == "RV":
+            return ["12.6V"]
+        if cmd == "DP":
+            return [(self.auto and "AUTO, " or "") + PROTOCOLS[self.protocol]]
+        if cmd == "DPN":
+            return [(self.auto and "A" or "") + self.protocol]
+        flags = {"E": "echo", "L": "linefeeds", "S": "spaces",
+                 "H": "headers", "M": "memory", "CAF": "can_format"}
+        if cmd[:-1] in flags and cmd[-1:] in "01":
+            setattr(self, flags[cmd[:-1]], cmd[-1] == "1")
+            return ["OK"]
+        if cmd[:2] == "SP" and len(cmd) == 3:
+            if cmd[2] == "0":
+                self.auto = True
+                self.searched = False
+            elif cmd[2] == "A" or cmd[2] == self.protocol:
+                self.auto = cmd[2] == "A"
+                self.searched = True
+            else: # car does not speak it
+                self.auto = False
+                self.searched = False
+            return ["OK"]
+        if cmd[:2] == "ST" and len(cmd) == 4:
+            self.timeout = max(int(cmd[2:], 16), 1) * 0.004096
+            return ["OK"]
+        if cmd[:2] == "AT" and len(cmd) == 3 and cmd[2] in "012":
+            self.adaptive = int(cmd[2])
+            return ["OK"]
+        return ["?"]
+
+    def obd_request(self, cmd):
+        """Returns reply lines of an OBD request like "010C" or "010C0D1" """
+        try:
+            data = [int(cmd[i:i+2], 16) for i in range(0, len(cmd) - 1, 2)]
+        except ValueError:
+            return ["?"]
+        expected = None
+        if len(cmd) % 2 == 1: # response count suffix
+            expected = int(cmd[-1], 16)
+
+        lines = []
+        if not self.searched:
+            if not self.auto: # pinned to a protocol the car does not use
+                time.sleep(self.search_time / 3)
+                return ["UNABLE TO CONNECT"]
+            lines.append("SEARCHING...")
+            time.sleep(self.search_time)
+            self.searched = True
+
+        # K-line ECUs need a gap between requests
+        if self.protocol not in CAN_PROTOCOLS:
+            gap = 0.055 - (time.time() - self.last_request)
+            if gap > 0:
+                time.sleep(gap)
+
+        responses = []
+        for ecu in self.ecus:
+            payload = self.ecu_reply(ecu, data)
+            if payload is None:
+                continue
+            if type(payload[0]) == list: # several messages
+                responses.extend([(ecu, p) for p in payload])
+            else:
+                responses.append((ecu, payload))
+
+        time.sleep(self.latency)
+        if self.protocol not in CAN_PROTOCOLS: # 10.4 kbaud bus
+            time.sleep(sum([len(p) + 4 for e, p in responses]) * 10 / 10400.0)
+        if expected is None or len(responses) < expected:
+            time.sleep(self.idle_wait())
+        self.last_request = time.time()
+
+        if len(responses) == 0:
+            return lines + ["NO DATA"]
+        for ecu, payload in responses:
+            lines.extend(self.format(ecu, payload))
+        return lines
+
+    def monitor(self, echo):
+        """ATMA: prints the bus traffic until the host sends a character"""
+        self.write(echo)
+        eol = self.linefeeds and "\r\n" or "\r"
+        frames = self.bus_traffic()
+        sent = [0] * len(frames)
+        start = time.time()
+        while self.running:
+            r, w, x = select.select([self.master], [], [], 0.002)
+            if r:
+                os.read(self.master, 1024)
+                break
+            t = time.time()
+            lines = []
+            for i in range(len(frames)):
+                header, rate, data, isotp = frames[i]
+                due = int((t - start) * rate)
+                if sent[i] < due:
+                    if callable(data):
+                        data = data(t)
+                    lines.extend([self.monitor_line(header, data, isotp)] * (due - sent[i]))
+                    sent[i] = due
+            if not lines:
+                continue
+            text = eol.join(lines) + eol
+            if len(text) > MONITOR_BUFFER: # host too slow, frames lost
+                self.write("BUFFER FULL" + eol + eol + ">")
+                return
+            self.write(text)
+        self.write(eol + ">")
+
+    def bus_traffic(self):
+        """Returns (header, rate, data, ISO-TP) of the frames ATMA shows"""
+        frames = []
+        extended = self.protocol in ("7", "9")
+        if self.protocol in CAN_PROTOCOLS:
+            for can_id, rate, data in self.traffic:
+                if extended: # J1939 style broadcast
+                    frames.append(("%08X" % (0x18FE0000 | can_id << 4), rate, data, False))
+                else:
+                    frames.append(("%03X" % can_id, rate, data, False))
+        if self.tester_rate and self.ecus:
+            ecu = self.ecus[0]
+            if self.protocol not in CAN_PROTOCOLS:
+                tester, address = "686AF1", "486B" + ecu.address
+            else:
+                tester, address = extended and "18DB33F1" or "7DF", ecu.address
+            reply = lambda t: self.ecu_reply(ecu, [0x01, 0x0C]) or [0x7F, 0x01, 0x12]
+            frames.append((tester, self.tester_rate, [0x01, 0x0C], True))
+            frames.append((address, self.tester_rate, reply, True))
+        return frames
+
+    def monitor_line(self, header, data, isotp):
+        """One frame as ATMA prints it"""
+        sep = self.spaces and " " or ""
+        if self.protocol not in CAN_PROTOCOLS:
+            frame = [int(header[i:i+2], 16) for i in (0, 2, 4)] + data
+            data = data + [sum(frame) & 0xFF] # checksum
+        elif isotp:
+            data = [len(data)] + data
+            if not self.can_format:
+                data = data + [0] * (8 - len(data))
+        if not self.headers:
+            return self.hexbytes(data)
+        return header + sep + self.hexbytes(data)
+
+    def idle_wait(self):
+        """How long the adapter waits for more ECUs after the last reply"""
+        if self.adaptive == 0:
+            return self.timeout
+        # adaptive timing learns the ECU, mode 2 more aggressively
+        learned = self.latency * (self.adaptive == 1 and 4 or 2)
+        return min(self.timeout, max(learned, 0.008))
+
+    def hexbytes(self, values):
+        sep = self.spaces and " " or ""
+        return sep.join(["%02X" % v for v in values])
+
+    def format(self, ecu, payload):
+        """Returns the reply lines of one ECU as the ELM327 prints them"""
+        sep = self.spaces and " " or ""
+        if self.protocol not in CAN_PROTOCOLS:
+            if not self.headers:
+                return [self.hexbytes(payload)]
+            frame = [0x48, 0x6B, int(ecu.address, 16)] + payload
+            frame.append(sum(frame) & 0xFF) # checksum
+            return [self.hexbytes(frame)]
+
+        if len(payload) <= 7: # single frame
+            if not self.headers:
+                return [self.hexbytes(payload)]
+            return [ecu.address + sep + self.hexbytes([len(payload)] + payload)]
+
+        # ISO-TP first frame and consecutive frames
+        lines = []
+        if not self.headers:
+            lines.append("%03X" % len(payload))
+            chunks = [payload[:6]]
+            rest = payload[6:]
+            while rest:
+                chunks.append(rest[:7] + [0] * (7 - len(rest[:7])))
+                rest = rest[7:]
+            for i in range(len(chunks)):
+                lines.append("%X:" % (i & 0xF) + sep + self.hexbytes(chunks[i]))
+            return lines
+        lines.append(ecu.address + sep +
+                     self.hexbytes([0x10 | (len(payload) >> 8), len(payload) & 0xFF] + payload[:6]))
+        rest = payload[6:]
+        index = 1
+        while rest:
+            chunk = rest[:7] + [0] * (7 - len(rest[:7]))
+            lines.append(ecu.address + sep + self.hexbytes([0x20 | (index & 0xF)] + chunk))
+            rest = rest[7:]
+            index = index + 1
+        return lines
+
+class CANResponder(threading.Thread, Bus):
+    """ ECUs answering OBD requests on a SocketCAN interface, e.g. vcan0
+    for CANPort benchmarks """
+    dtc_count = True
+
+    def __init__(self, interface="vcan0", extended=False, latency=0.001, ecus=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.extended = extended
+        self.protocol = extended and "7" or "6"
+        self.latency = latency
+        if ecus is None:
+            ecus = [ECU(extended and "18DAF110" or "7E8")]
+        self.ecus = ecus
+        self.silent = []
+        self.requests = 0
+        self.sock = obd_can.CANSocket(interface)
+        if extended:
+            self.sock.set_filters([(0x18DA00F1 | obd_can.CAN_EFF_FLAG, 0x1FFF00FF | obd_can.CAN_EFF_FLAG),
+                                   (obd_can.FUNCTIONAL_29 | obd_can.CAN_EFF_FLAG, 0x1FFFFFFF | obd_can.CAN_EFF_FLAG)])
+        else:
+            self.sock.set_filters([(0x7DF, 0x7FF | obd_can.CAN_EFF_FLAG),
+                                   (0x7E0, 0x7F8 | obd_can.CAN_EFF_FLAG)])
+        self.running = True # until stop()
+
+    def start(self):
+        threading.Thread.start(self)
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Ends the thread and closes the socket"""
+        self.running = False
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(STOP_TIMEOUT)
+        if self.sock is not None and not self.is_alive():
+            self.sock.close()
+            self.sock = None
+
+    def run(self):
+        functional = self.extended and obd_can.FUNCTIONAL_29 or obd_can.FUNCTIONAL_11
+        while self.running:
+            frame = self.sock.recv(0.1)
+            if frame is None:
+                continue
+            can_id, data = frame
+            if ord(data[0]) >> 4 != 0: # requests are single frames
+                continue
+            targets = []
+            for ecu in self.ecus:
+                address = int(ecu.address, 16)
+                if can_id == functional or can_id == obd_can.request_id(address, self.extended):
+                    targets.append((address, ecu))
+            if not targets:
+                continue
+            self.requests = self.requests + 1
+            request = [ord(c) for c in data[1:1 + (ord(data[0]) & 0x0F)]]
+            time.sleep(self.latency)
+            for address, ecu in targets:
+                payload = self.ecu_reply(ecu, request)
+                if payload is None:
+                    continue
+                if type(payload[0]) == list:
+                    payload = payload[0] # several messages only on K-line
+                obd_can.isotp_send(self.sock, address, obd_can.request_id(address, self.extended),
+                                   "".join([chr(b) for b in payload]), self.extended)
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--can":
+        emu = CANResponder(sys.argv[2], "--extended" in sys.argv)
+        emu.start()
+        print "OBD ECUs (%s) on %s" % (PROTOCOLS[emu.protocol], sys.argv[2])
+    else:
+        protocol = "6"
+        if len(sys.argv) > 1:
+            protocol = sys.argv[1]
+        emu = ELM327Emulator(protocol)
+        emu.start()
+        print "ELM327 emulator (%s) on %s" % (PROTOCOLS[protocol], emu.name)
+    try:
+        while 1:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emu.stop()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_fleet.py
+#
+# Logs several cars at once, one adapter each, from a single thread.
+# Every adapter runs on the obd_async event loop with its own polling
+# plan (sensor -> Hz), log file and reconnect state, so a bench of 16
+# adapters needs no thread per port.
+#
+#   python obd_fleet.py [-d SECONDS] [-r rpm=10,speed=5] PORT[=LOGFILE] ...
+#
+# Without ports all serial ports of scanSerial() are used. Throughput and
+# round trip times of every adapter are printed every few seconds.
+###########################################################################
+
+import sys
+import time
+import string
+from collections import deque
+from optparse import OptionParser
+
+import serial
+
+import obd_io
+import obd_async
+import obd_scheduler
+import obd_sensors
+from obd_async import coroutine, sleep, with_timeout, TimeoutError
+from obd_utils import scanSerial
+
+# seconds between reconnect attempts, doubled after every failure
+RETRY_MIN = 1.0
+RETRY_MAX = 30.0
+# reset plus protocol search of a cold adapter
+CONNECT_TIMEOUT = 20.0
+# rounds without any answer before the link counts as lost
+MAX_MISSES = 5
+
+DEFAULT_PLAN = {"rpm": 10, "speed": 10, "throttle_pos": 10, "load": 5, "temp": 1}
+
+def check_plan(rates):
+    """Raises ValueError unless rates (shortname -> Hz) is a usable plan"""
+    if not rates:
+        raise ValueError("Empty polling plan")
+    for shortname, hz in rates.items():
+        if shortname not in obd_sensors.SENSOR_BY_NAME:
+            raise ValueError("Unknown sensor: %s" % shortname)
+        if hz <= 0:
+            raise ValueError("Rate of %s must be positive: %s" % (shortname, hz))
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class LogSink:
+    """ CSV of time,sensor,value of one adapter """
+    def __init__(self, path):
+        self.file = None
+        if path is not None:
+            self.file = open(path, "a")
+
+    def write(self, stamp, results):
+        if self.file is None:
+            return
+        for shortname, value in results:
+            self.file.write("%.3f,%s,%s\n" % (stamp, shortname, value))
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+class Adapter:
+    """ One adapter of the fleet and its plan, log and reconnect state """
+    def __init__(self, fleet, name, portnum, rates, log_path=None):
+        check_plan(rates) # a bad plan would fail on every reconnect
+        self.fleet = fleet
+        self.name = name
+        self.portnum = portnum
+        self.rates = rates
+        self.log = LogSink(log_path)
+        self.port = None
+        self.task = None
+        self.state = "idle" # connecting, polling, waiting to reconnect
+        self.retry_delay = RETRY_MIN
+        self.reconnects = 0
+        self.last_error = None
+        self.samples = 0
+        self.rtt = deque(maxlen=1000) # seconds per request
+        self.started = None
+
+    @coroutine
+    def run(self):
+        self.started = time.time()
+        while self.fleet.running:
+            self.state = "connecting"
+            try:
+                if (yield self.connect()):
+                    self.retry_delay = RETRY_MIN
+                    self.state = "polling"
+                    yield self.poll() # returns when the car stops answering
+            except obd_async.CancelledError:
+                raise
+            except Exception as e: # garbled replies, unplugged adapter...
+                self.last_error = e
+            self.disconnect()
+            self.state = "waiting"
+            yield sleep(self.retry_delay, self.fleet.loop)
+            self.retry_delay = min(self.retry_delay * 2, RETRY_MAX)
+            self.reconnects = self.reconnects + 1
+
+    @coroutine
+    def connect(self):
+        try:
+            self.port = obd_async.AsyncOBDPort(self.portnum, loop=self.fleet.loop)
+        except serial.SerialException:
+            raise obd_async.Return(False)
+        try:
+            version = yield with_timeout(self.port.connect(), CONNECT_TIMEOUT)
+        except (obd_io.OBDTimeout, TimeoutError):
+            version = None
+        raise obd_async.Return(version is not None)
+
+    @coroutine
+    def poll(self):
+        scheduler = obd_scheduler.PollScheduler(self.port, self.rates)
+        if len(scheduler.channels) == 0:
+            return
+        misses = 0
+        while self.fleet.running and misses < MAX_MISSES:
+            wait = scheduler.wait_time()
+            if wait > 0:
+                yield sleep(wait, self.fleet.loop)
+            due = scheduler.due()
+            start = time.time()
+            values = yield self.port.get_sensor_values([c.sensor for c in due])
+            end = time.time()
+            results = scheduler.record(due, values, start, end)
+            self.rtt.append(end - start)
+            self.samples = self.samples + len(results)
+            self.log.write(end, results)
+            if [v for v in values if v != "NORESPONSE"]:
+                misses = 0
+            else:
+                misses = misses + 1
+
+    def disconnect(self):
+        if self.port is not None:
+            self.port.close()
+        self.port = None
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.disconnect()
+        self.log.close()
+
+    def report(self):
+        """Returns (name, state, samples/s, p50 ms, p99 ms, reconnects)"""
+        elapsed = max(time.time() - (self.started or time.time()), 0.001)
+        p50 = percentile(self.rtt, 50)
+        p99 = percentile(self.rtt, 99)
+        return (self.name, self.state, self.samples / elapsed,
+                p50 and p50 * 1000, p99 and p99 * 1000, self.reconnects)
+
+class FleetManager:
+    """ Drives many adapters from one event loop """
+    def __init__(self, loop=None):
+        self.loop = loop or obd_async.get_event_loop()
+        self.adapters = []
+        self.running = False
+
+    def add(self, portnum, rates=None, log_path=None, name=None):
+        """Adds an adapter, polled by plan rates (shortname -> Hz)"""
+        if rates is None:
+            rates = DEFAULT_PLAN
+        adapter = Adapter(self, name or portnum, portnum, rates, log_path)
+        self.adapters.append(adapter)
+        if self.running:
+            adapter.task = adapter.run()
+        return adapter
+
+    def run(self, duration=None, report_every=None):
+        """Polls all adapters for duration seconds (None: until stop())"""
+        self.running = True
+        for adapter in self.adapters:
+            adapter.task = adapter.run()
+        if duration is not None:
+            self.loop.call_later(duration, self.stop)
+        if report_every is not None:
+            self.loop.call_later(report_every, self.print_report, report_every)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.running = False
+            for adapter in self.adapters:
+                adapter.stop()
+
+    def stop(self):
+        self.running = False
+        self.loop.stop()
+
+    def report(self):
+        return [a.report() for a in self.adapters]
+
+    def print_report(self, again=None):
+        print "%-16s %-10s %9s %9s %9s %5s" % \
+              ("adapter", "state", "samples/s", "p50 ms", "p99 ms", "recon")
+        for name, state, rate, p50, p99, reconnects in self.report():
+            print "%-16s %-10s %9.1f %9s %9s %5d" % \
+                  (name, state, rate, p50 and "%.1f" % p50 or "-",
+                   p99 and "%.1f" % p99 or "-", reconnects)
+        if again is not None and self.running:
+            self.loop.call_later(again, self.print_report, again)
+
+def parse_plan(text):
+    """"rpm=10,speed=5" -> {"rpm": 10.0, "speed": 5.0}, raises ValueError
+    for items that are not shortname=Hz"""
+    plan = {}
+    for item in string.split(text, ","):
+        try:
+            shortname, hz = string.split(item, "=")
+            plan[string.strip(shortname)] = float(hz)
+        except ValueError:
+            raise ValueError("Plan item is not sensor=Hz: %s" % item)
+    return plan
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] PORT[=LOGFILE] ...")
+    parser.add_option("-d", "--duration", type="float",
+                      help="seconds to log, default until Ctrl-C")
+    parser.add_option("-r", "--rates", help="polling plan, e.g. rpm=10,speed=5")
+    parser.add_option("-i", "--interval", type="float", default=5.0,
+                      help="seconds between reports")
+    (options, args) = parser.parse_args()
+    if len(args) == 0:
+        args = scanSerial()
+    plan = None
+    if options.rates:
+        try:
+            plan = parse_plan(options.rates)
+        except ValueError as e:
+            parser.error(str(e))
+
+    fleet = FleetManager()
+    for arg in args:
+        if "=" in arg:
+            portnum, path = string.split(arg, "=", 1)
+        else:
+            portnum, path = arg, None
+        try:
+            fleet.add(portnum, plan, path)
+        except ValueError as e:
+            parser.error(str(e))
+    try:
+        fleet.run(options.duration, options.interval)
+    except KeyboardInterrupt:
+        pass
+    fleet.print_report()
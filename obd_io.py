@@ -25,10 +25,13 @@
 import serial
 import string
 import time
+import binascii
+import threading
 from math import ceil
 from datetime import datetime
 
 import obd_sensors
+import obd_profile
 
 from obd_sensors import hex_to_int
 
@@ -36,6 +39,90 @@ GET_DTC_COMMAND   = "03"
 CLEAR_DTC_COMMAND = "04"
 GET_FREEZE_DTC_COMMAND = "07"
 
+# ELM327 accepts at most six PIDs in one mode 01 request
+MAX_BATCH_PIDS = 6
+# ATDPN protocol numbers of the ISO 15765-4 (CAN) protocols
+CAN_PROTOCOLS = ["6", "7", "8", "9"]
+
+# seconds to wait for the prompt, by command prefix (longest prefix wins).
+# Resets and the protocol search on the first request are slow, a mode 01
+# PID either answers quickly or not at all.
+DEADLINES = {
+    "atz" : 5.0,
+    "atws": 5.0,
+    "at"  : 1.0,
+    "0100": 10.0,
+    "01"  : 0.5,
+    "03"  : 3.0,
+    "04"  : 3.0,
+    "07"  : 3.0,
+    "09"  : 2.0,
+    }
+# how long an adapter that is already up may take to answer ati
+PROBE_DEADLINE = 0.5
+# adapter settings after reset: echo, linefeeds, spaces, headers, memory off.
+# Without spaces and headers every reply is shorter on the wire.
+ADAPTER_SETTINGS = [("e", "0"), ("l", "0"), ("s", "0"), ("h", "0"), ("m", "0")]
+# ELM327 settings after ATZ/ATWS that do not depend on its pin strapping
+RESET_SETTINGS = {"e": "1", "s": "1", "h": "0", "st": "32", "at": "1", "caf": "1"}
+
+# ATST counts in 4.096 ms steps. The tuned timeout is the slowest measured
+# ECU response times TIMING_MARGIN, but no less than ST_MIN steps.
+ST_UNIT = 0.004096
+ST_MIN = 0x05
+TIMING_MARGIN = 2.0
+TIMING_SAMPLES = 5
+
+# serial read timeout, how often a waiting reader checks its deadline
+POLL_INTERVAL = 0.05
+
+# UART rate of the ELM327 after power-on (pin strapped 38400 or 9600)
+DEFAULT_BAUD = 38400
+# rates tried when the adapter does not answer at the expected one
+BAUD_RATES = [38400, 9600, 115200, 57600, 230400, 500000]
+# rates ATBRD may switch to, fastest first
+FAST_BAUD_RATES = [500000, 230400, 115200, 57600]
+# the adapter sends its ID at the new rate and goes back to the old one
+# unless it gets a CR within ATBRT (75 ms default)
+BRD_DEADLINE = 0.2
+
+# seconds a sensor value may be answered from memory, by Sensor.shortname.
+# None keeps the value until reconnect or the next ignition cycle.
+SENSOR_TTL = {
+    "pids"                : None,
+    "pids_21_40"          : None,
+    "pids_41_60"          : None,
+    "pids_61_80"          : None,
+    "pids_81_a0"          : None,
+    "pids_a1_c0"          : None,
+    "pids_c1_e0"          : None,
+    "obd_standard"        : None,
+    "o2_sensor_positions" : None,
+    "o2_sensor_position_b": None,
+    "aux_input"           : 5.0,
+    "fuel_status"         : 5.0,
+    "secondary_air_status": 5.0,
+    "dtc_status"          : 5.0,
+    }
+# engine run time since start; going backwards means a new ignition cycle
+IGNITION_SENSOR = "engine_time"
+
+# mode 01 PIDs whose data is a bitmap of supported PIDs; with several
+# ECUs a PID is supported if any of them supports it
+SUPPORT_PIDS = [0x00, 0x20, 0x40, 0x60, 0x80, 0xA0, 0xC0]
+
+# frames the monitor holds between reader and decoder, a few seconds of
+# a busy 500 kbit bus
+MONITOR_RING_SIZE = 8192
+
+class OBDTimeout(Exception):
+    """Raised when no prompt arrives before a command's deadline"""
+    def __init__(self, cmd, deadline, partial):
+        Exception.__init__(self, "no reply to %s within %.2f s" % (cmd, deadline))
+        self.cmd = cmd
+        self.deadline = deadline
+        self.partial = partial # whatever arrived before giving up
+
 from debugEvent import debug_display
 
 #__________________________________________________________________________
@@ -67,21 +154,638 @@ def decrypt_dtc_code(code):
         dtc.append(type+dig1+dig2+dig3+dig4)
         current = current[4:]
     return dtc
+
+def join_frames(code):
+    """Returns reply without whitespace, a multiframe CAN reply (byte
+    count, then frames prefixed "0:", "1:", ...) joined into one message.
+    Returns None if the frames are malformed."""
+    # remove whitespace
+    code = string.join(string.split(code), "")
+
+    if ":" in code:
+        frames = string.split(code, ":")
+        try:
+            length = hex_to_int(frames[0][:-1])
+        except ValueError:
+            return None
+        data = ""
+        for frame in frames[1:-1]:
+            data = data + frame[:-1] # strip index of next frame
+        code = (data + frames[-1])[:length*2]
+    return code
+
+def decode_vin(code):
+    """Returns the VIN from the reply to 0902, or None"""
+    code = join_frames(code)
+    if code is None or code[:4] != "4902":
+        return None
+    if len(code) == 70 and code[14:18] == "4902":
+        # five messages "49 02 nn" + 4 bytes (older protocols)
+        data = string.join([code[i+6:i+14] for i in range(0, 70, 14)], "")
+    else: # one message "49 02 01" + 17 bytes (CAN)
+        data = code[6:]
+    try:
+        vin = string.join([chr(hex_to_int(data[i:i+2])) for i in range(0, len(data) - 1, 2)], "")
+    except ValueError:
+        return None
+    vin = string.strip(vin, "\x00")
+    if len(vin) != 17 or not vin.isalnum():
+        return None
+    return vin
+
+def response_timing(times):
+    """Returns (ATST value, ATAT mode) for measured ECU response times.
+    ECUs that answer steadily get the aggressive adaptive mode 2."""
+    st = int(ceil(max(times) * TIMING_MARGIN / ST_UNIT))
+    st = min(max(st, ST_MIN), 0xFF)
+    if max(times) < min(times) * 1.5:
+        at = "2"
+    else:
+        at = "1"
+    return ("%02X" % st, at)
+
+def header_address(line, protocol):
+    """Returns the address of the ECU that sent a reply line printed with
+    headers on (ATH1)"""
+    line = string.join(string.split(line), "")
+    if protocol in ("6", "8"): # 11 bit CAN id
+        return line[:3]
+    if protocol in ("7", "9"): # 29 bit CAN id
+        return line[:8]
+    return line[4:6] # priority, target, source
+
+# characters of data lines: hex digits, and ":" after the frame index
+# of a multiframe reply with headers off
+DATA_CHARS = "0123456789ABCDEF:\r"
+
+class Reply:
+    """ A reply of the adapter, parsed. status is None if ECUs answered,
+    else the adapter's message without spaces ("NODATA", "?", "STOPPED",
+    "CANERROR", "BUFFERFULL", "UNABLETOCONNECT"...) or "NORESPONSE"
+    for an empty reply. data is a list of (ECU address, hex string) with
+    headers on; with headers off it is [(None, data)] per reply line,
+    so the first entry is the first line (a multiframe reply is joined
+    into one). """
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+def parse_reply(reply, protocol=None):
+    """Returns the Reply of adapter output (lines separated by "\\r", no
+    prompt). protocol is given when headers are on, to split the data by
+    ECU address. Data lines are only copied to strip spaces."""
+    text = reply.translate(None, " \t\n")
+    if text.translate(None, DATA_CHARS) == "": # only data, the usual case
+        lines = None
+    else:
+        status = None
+        lines = []
+        for line in text.split("\r"):
+            if line.translate(None, DATA_CHARS) == "":
+                lines.append(line)
+            elif line[:9] == "SEARCHING" or (line[:8] == "BUSINIT:" and line[-2:] == "OK"):
+                continue # progress of the protocol search
+            elif "<" in line: # "41 0C 1A <DATA ERROR", a frame went wrong
+                status = line[line.find("<")+1:]
+            elif status is None:
+                status = line
+        if status is not None:
+            return Reply(status, [])
+        text = string.join(lines, "\r")
+
+    if protocol is not None:
+        data = ecu_messages(lines or text.split("\r"), protocol)
+    elif ":" in text: # multiframe, byte count first
+        data = join_frames(text)
+        data = data and [(None, data)]
+    else: # several ECUs or messages answer on separate lines
+        data = [(None, line) for line in text.split("\r") if line != ""]
+    if not data:
+        return Reply("NORESPONSE", [])
+    return Reply(None, data)
+
+def ecu_messages(lines, protocol):
+    """Internal use only: not a public interface"""
+    # data lines with headers -> [(address, data)], in order of answer
+    protocol = protocol[-1:]
+    can = protocol in CAN_PROTOCOLS
+    start = {"6": 3, "8": 3, "7": 8, "9": 8}.get(protocol, 6)
+    order = []
+    messages = {} # address -> list of [length in hex digits or None, data]
+    for line in lines:
+        try:
+            if not can: # priority, target, source ... checksum
+                address = line[4:6]
+                message = [None, line[6:-2]]
+            elif line[start] == "0": # single frame
+                address = line[:start]
+                length = int(line[start+1], 16) * 2
+                message = [length, line[start+2:start+2+length]]
+            elif line[start] == "1": # first frame, length in 12 bits
+                address = line[:start]
+                message = [int(line[start+1:start+4], 16) * 2, line[start+4:]]
+            elif line[start] == "2" and messages.get(line[:start]): # consecutive
+                entry = messages[line[:start]][-1]
+                entry[1] = entry[1] + line[start+2:]
+                continue
+            else:
+                continue
+        except (ValueError, IndexError):
+            continue
+        if address not in messages:
+            order.append(address)
+            messages[address] = []
+        messages[address].append(message)
+
+    replies = []
+    for address in order:
+        data = [m[1][:m[0]] for m in messages[address]]
+        data = string.join([d for d in data if d[:2] != "7F"], "") # no negative responses
+        if data != "":
+            replies.append((address, data))
+    return replies
+
+def split_by_ecu(reply, protocol):
+    """Returns [(address, data)] of a reply printed with headers on (ATH1),
+    one entry per ECU in the order they answered. data is hex without
+    whitespace, headers, ISO-TP bytes and checksums; several messages of
+    an ECU are joined."""
+    return parse_reply(reply, protocol).data
+
+def status_value(status):
+    """Returns the sensor value for a reply with status: "NODATA" if the
+    car does not know the PID, "NORESPONSE" for bus and adapter errors"""
+    if status in ("NODATA", "?"):
+        return "NODATA"
+    return "NORESPONSE"
+
+def merge_bitmaps(a, b):
+    """Returns the union of two supported-PID bitmaps (hex strings)"""
+    return "%0*X" % (len(a), int(a, 16) | int(b, 16))
+
+def merged_bitmap(data, pid):
+    """Returns the union of the supported-PID bitmaps (hex) that answer
+    pid in the data of a Reply, one entry per ECU, or None"""
+    prefix = "41%02X" % pid
+    bitmap = None
+    for address, code in data:
+        if code[:4] != prefix or len(code) != 12:
+            continue
+        if bitmap is None:
+            bitmap = code[4:]
+        else:
+            bitmap = merge_bitmaps(bitmap, code[4:])
+    return bitmap
+
+def split_batch_reply(code, pids):
+    """Splits the reply to a multi-PID mode 01 request into a dictionary
+    of PID -> data bytes (hex string). Returns None if the reply can not
+    be demultiplexed."""
+    code = join_frames(code)
+    if code is None:
+        return None
+
+    if code[:2] != "41":
+        return None
+    values = {}
+    seen = {} # PIDs of the message being read
+    pos = 2
+    while pos + 2 <= len(code):
+        try:
+            pid = hex_to_int(code[pos:pos+2])
+        except ValueError: # not hex, cable said something else
+            return None
+        # between PID records 41 starts the next message (another ECU or
+        # frame) unless 0x41 itself was asked for and not read yet
+        if pid == 0x41 and (pid not in pids or pid in seen):
+            seen = {}
+            pos = pos + 2
+            continue
+        if pid not in pids or pid not in obd_sensors.PID_DATA_BYTES:
+            break
+        end = pos + 2 + obd_sensors.PID_DATA_BYTES[pid]*2
+        if end > len(code):
+            break
+        if pid not in values: # first responding ECU wins
+            values[pid] = code[pos+2:end]
+        seen[pid] = True
+        pos = end
+
+    if len(values) == 0:
+        return None
+    return values
 #__________________________________________________________________________
 
+class ValueCache:
+     """ Keeps values of static and slow-changing sensors for a while """
+     def __init__(self, ttl=None):
+         if ttl is None:
+             ttl = SENSOR_TTL
+         self.ttl = dict(ttl) # shortname -> seconds, None for no expiry
+         self.values = {}     # shortname -> (expiry time, value)
+         self.engine_time = None
+         self.hits = 0
+         self.misses = 0
+
+     def get(self, sensor):
+         """Returns cached value of sensor or None"""
+         if sensor.shortname not in self.ttl:
+             return None
+         entry = self.values.get(sensor.shortname)
+         if entry is None or (entry[0] is not None and entry[0] < time.time()):
+             self.misses = self.misses + 1
+             return None
+         self.hits = self.hits + 1
+         return entry[1]
+
+     def put(self, sensor, value):
+         """Remembers value of sensor if it is cacheable"""
+         if value == "NODATA" or value == "NORESPONSE":
+             return
+         if sensor.shortname == IGNITION_SENSOR:
+             if self.engine_time is not None and value < self.engine_time:
+                 self.invalidate() # engine was restarted
+             self.engine_time = value
+         if sensor.shortname in self.ttl:
+             ttl = self.ttl[sensor.shortname]
+             if ttl is not None:
+                 ttl = time.time() + ttl
+             self.values[sensor.shortname] = (ttl, value)
+
+     def invalidate(self):
+         """Forgets all values, e.g. after reconnect or ignition cycle"""
+         self.values = {}
+         self.engine_time = None
+
+class Sample(object):
+     """ One reading of a mode 01 PID. Loggers allocate these once and
+     let read_samples() refill them every cycle. """
+     __slots__ = ("stamp", "pid", "data", "value")
+
+     def __init__(self, pid):
+         self.stamp = None # time.time() of the reading
+         self.pid = pid
+         self.data = None  # data bytes as hex, None if not read from the car
+         self.value = None
+
+def fill_sample(sample, stamp, value, codes=None):
+     """Sets time, value and data of sample, data looked up by PID in codes
+     (as OBDPort.codes) unless the car did not answer"""
+     sample.stamp = stamp
+     sample.value = value
+     if codes is None or value in ("NODATA", "NORESPONSE"):
+         sample.data = None
+     else:
+         sample.data = codes.get(sample.pid)
+
+def read_samples(port, samples, sensors=None):
+     """Refills samples with the current values of their PIDs, read from
+     port (anything with get_sensor_values()) in one go. sensors are the
+     Sensors of samples, allocated once by loggers, looked up if None"""
+     if sensors is None:
+         sensors = [obd_sensors.SENSORS[s.pid] for s in samples]
+     values = port.get_sensor_values(sensors)
+     stamp = time.time()
+     codes = getattr(port, "codes", None)
+     for i in xrange(len(samples)):
+         fill_sample(samples[i], stamp, values[i], codes)
+     return samples
+
+class SupportedPIDs:
+     """ Mode 01 PIDs the car supports, one 32 bit mask per range as
+     answered to 0100, 0120, ...: bit 31 is the PID after the range's
+     base, bit 0 the base of the next range. """
+     def __init__(self, masks=None):
+         self.masks = dict(masks or {}) # base PID -> mask
+
+     def add(self, base, bits):
+         """Adds the answer to range base as "0"/"1" string, OR-ed with
+         other ECUs' answers. Raises ValueError unless it has 32 bits."""
+         if len(bits) != 32:
+             raise ValueError("Not a 32 bit PID bitmap: %r" % (bits,))
+         self.masks[base] = self.masks.get(base, 0) | int(bits, 2)
+
+     def __contains__(self, pid):
+         if pid == 0:
+             return 0 in self.masks
+         base = (pid - 1) & ~0x1F
+         return (self.masks.get(base, 0) >> (base + 32 - pid)) & 1 == 1
+
+     def pids(self):
+         """Returns the supported PIDs in ascending order"""
+         pids = []
+         for base in sorted(self.masks.keys()):
+             mask = self.masks[base]
+             for i in range(32):
+                 if (mask >> (31 - i)) & 1:
+                     pids.append(base + 1 + i)
+         return pids
+
+     def ranges(self):
+         """Returns [[base, mask]], e.g. for a vehicle profile"""
+         return [[base, mask] for base, mask in sorted(self.masks.items())]
+
+def read_supported_pids(port):
+     """Returns SupportedPIDs of port (anything with sensor()), walking
+     0100, 0120, ... as long as a range says the next one exists"""
+     supported = SupportedPIDs()
+     for base in SUPPORT_PIDS:
+         if base != 0 and base not in supported:
+             break
+         bits = port.sensor(base)[1]
+         try:
+             supported.add(base, bits)
+         except (ValueError, TypeError): # NODATA, garbled or several ECUs run together
+             break
+     return supported
+
+#__________________________________________________________________________
+# passive bus monitor
+
+# mode 01 PID -> Sensor, for decoding replies seen on the bus
+PID_SENSORS = obd_sensors.SENSOR_BY_PID
+
+def decode_obd_frame(data, can=True):
+     """Returns [(shortname, value)] of a mode 01 reply in one frame (data
+     bytes as string, CAN frames start with the ISO-TP byte), [] if the
+     frame is something else"""
+     if can:
+         if len(data) < 2 or ord(data[0]) >> 4 != 0: # only single frames
+             return []
+         data = data[1:1 + (ord(data[0]) & 0x0F)]
+     if len(data) < 3 or ord(data[0]) != 0x41:
+         return []
+     values = []
+     pos = 1
+     while pos < len(data):
+         pid = ord(data[pos])
+         size = obd_sensors.PID_DATA_BYTES.get(pid)
+         if size is None or pos + 1 + size > len(data):
+             break
+         sensor = PID_SENSORS.get(pid)
+         if sensor is not None:
+             values.append((sensor.shortname, sensor.decode(data[pos+1:pos+1+size])))
+         pos = pos + 1 + size
+     return values
+
+class FrameRing:
+     """ Fixed size FIFO of received frames between the thread reading the
+     adapter and the one decoding them. Slots are allocated once; frames
+     arriving while the ring is full are dropped and counted. """
+     def __init__(self, size=MONITOR_RING_SIZE):
+         self.size = size
+         self.stamps = [0.0] * size
+         self.frames = [None] * size
+         self.head = 0 # frames put, only moved by the reader
+         self.tail = 0 # frames taken, only moved by the decoder
+         self.overflows = 0
+         self.ready = threading.Event()
+
+     def __len__(self):
+         return self.head - self.tail
+
+     def put(self, stamp, frame):
+         """Returns False if the ring is full and frame was dropped"""
+         head = self.head
+         if head - self.tail >= self.size:
+             self.overflows = self.overflows + 1
+             return False
+         i = head % self.size
+         self.stamps[i] = stamp
+         self.frames[i] = frame
+         self.head = head + 1
+         if not self.ready.is_set():
+             self.ready.set()
+         return True
+
+     def get(self, timeout=None):
+         """Returns list of (time, frame) put since the last call, waiting
+         up to timeout if there are none"""
+         if self.head == self.tail:
+             self.ready.clear()
+             if self.head == self.tail: # nothing came in meanwhile
+                 self.ready.wait(timeout)
+         head = self.head
+         frames = []
+         for n in xrange(self.tail, head):
+             i = n % self.size
+             frames.append((self.stamps[i], self.frames[i]))
+             self.frames[i] = None
+         self.tail = head
+         return frames
+
+class CANMonitor:
+     """ Passive capture of bus traffic. A reader thread only moves frames
+     from source into a FrameRing; a decoder thread applies the id filters,
+     runs the decoders and publishes the channels. Use OBDPort.monitor()
+     or obd_can.CANPort.monitor() to create one.
+
+     filters   list of (id, mask), a frame passes if id & mask matches
+               one of them; None passes every frame
+     decoders  id -> function(data) returning [(channel, value)], frames
+               of other ids are decoded as mode 01 replies
+     callback  callback(time, channel, value) for every decoded value """
+     def __init__(self, source, filters=None, decoders=None, callback=None,
+                  size=MONITOR_RING_SIZE):
+         self.source = source
+         self.filters = filters
+         self.decoders = decoders or {}
+         self.callback = callback
+         self.ring = FrameRing(size)
+         self.values = {}  # channel -> (time, value), latest only
+         self.ids = {}     # id -> frames that passed the filters
+         self.frames = 0   # frames that passed the filters
+         self.filtered = 0 # frames dropped by the filters
+         self.errors = 0   # lines that were no frame, failing decoders
+         self.running = False
+         self.started = None
+         self.stopped = None
+         self.reader = threading.Thread(target=self.read_loop)
+         self.decoder = threading.Thread(target=self.decode_loop)
+         self.reader.daemon = True
+         self.decoder.daemon = True
+
+     def start(self):
+         self.source.start()
+         self.running = True
+         self.started = time.time()
+         self.reader.start()
+         self.decoder.start()
+
+     def stop(self):
+         """Leaves monitor mode once the captured frames are decoded"""
+         if not self.running:
+             return
+         self.running = False
+         self.reader.join()
+         self.source.stop()
+         self.decoder.join()
+         self.stopped = time.time()
+
+     def read_loop(self):
+         """Internal use only: not a public interface"""
+         read = self.source.read
+         put = self.ring.put
+         while self.running:
+             frames = read()
+             stamp = time.time()
+             for frame in frames:
+                 put(stamp, frame)
+
+     def passes(self, frame_id):
+         if self.filters is None:
+             return True
+         for filter_id, mask in self.filters:
+             if frame_id & mask == filter_id & mask:
+                 return True
+         return False
+
+     def decode_loop(self):
+         """Internal use only: not a public interface"""
+         parse = self.source.parse
+         can = self.source.can
+         while self.running or self.reader.is_alive() or len(self.ring):
+             for stamp, raw in self.ring.get(POLL_INTERVAL):
+                 frame = parse(raw)
+                 if frame is None:
+                     self.errors = self.errors + 1
+                     continue
+                 frame_id, data = frame
+                 if not self.passes(frame_id):
+                     self.filtered = self.filtered + 1
+                     continue
+                 self.frames = self.frames + 1
+                 self.ids[frame_id] = self.ids.get(frame_id, 0) + 1
+                 try:
+                     decoder = self.decoders.get(frame_id)
+                     if decoder is None:
+                         values = decode_obd_frame(data, can)
+                     else:
+                         values = decoder(data)
+                 except Exception:
+                     self.errors = self.errors + 1
+                     continue
+                 for channel, value in values:
+                     self.values[channel] = (stamp, value)
+                     if self.callback is not None:
+                         self.callback(stamp, channel, value)
+
+     def stats(self):
+         """Returns dictionary of frame counts and rates"""
+         elapsed = max((self.stopped or time.time()) - (self.started or time.time()), 0.001)
+         return {"received": self.ring.head,
+                 "frames": self.frames,
+                 "filtered": self.filtered,
+                 "errors": self.errors,
+                 "overflows": self.ring.overflows,
+                 "adapter_overflows": self.source.overflows,
+                 "frames_per_s": self.ring.head / elapsed,
+                 "ids": len(self.ids)}
+
+class ELMFrameSource:
+     """ Frames printed by an ELM327 in monitor mode (ATMA), headers on.
+     CAN frames are shown raw (ATCAF0), ISO-TP byte and padding included. """
+     def __init__(self, port):
+         self.port = port
+         self.can = port.is_can()
+         protocol = port.protocol[-1:] # "A6" during auto search
+         if protocol in ("7", "9"):
+             self.id_digits = 8
+         elif self.can:
+             self.id_digits = 3
+         else: # priority, target, source
+             self.id_digits = 6
+         self.overflows = 0 # BUFFER FULL, adapter could not send fast enough
+         self.pending = ""  # part of a line
+         self.saved = []
+
+     def start(self):
+         port = self.port
+         options = [("h", "1")]
+         if self.can:
+             options.append(("caf", "0"))
+         self.saved = [(name, port.settings.get(name)) for name, value in options]
+         for name, value in options:
+             port.set_option(name, value)
+         port.send_command("atma")
+
+     def read(self):
+         """Returns the complete lines received so far"""
+         serial_port = self.port.port
+         data = serial_port.read(max(serial_port.inWaiting(), 1))
+         if data == "":
+             return []
+         lines = string.split(self.pending + data, "\r")
+         self.pending = lines.pop()
+         if ">" in self.pending: # adapter gave up (BUFFER FULL), go on
+             self.pending = ""
+             serial_port.write("atma\r")
+         return [l for l in lines if l != ""]
+
+     def parse(self, line):
+         """Returns (id, data) of a line or None"""
+         if line[:11] == "BUFFER FULL":
+             self.overflows = self.overflows + 1
+             return None
+         line = string.replace(line, " ", "")
+         try:
+             frame_id = int(line[:self.id_digits], 16)
+             data = binascii.unhexlify(line[self.id_digits:])
+         except (ValueError, TypeError): # echo, STOPPED, odd length
+             return None
+         if not self.can:
+             data = data[:-1] # checksum
+         return (frame_id, data)
+
+     def stop(self):
+         port = self.port
+         port.port.write("\r") # any character ends monitoring
+         port.read_until([">"], port.command_deadline("at"))
+         port.desync = True # frames sent meanwhile
+         for name, value in self.saved:
+             if value is not None:
+                 port.set_option(name, value)
+
 class OBDPort:
      """ OBDPort abstracts all communication with OBD-II device."""
-     def __init__(self,portnum,_notify_window,SERTIMEOUT,RECONNATTEMPTS):
+     def __init__(self,portnum,_notify_window,SERTIMEOUT,RECONNATTEMPTS,profiles=None,
+                  baud=DEFAULT_BAUD,max_baud=None):
          """Initializes port by resetting device and gettings supported PIDs. """
          # These should really be set by the user.
-         baud     = 38400
          databits = 8
          par      = serial.PARITY_NONE  # parity
          sb       = 1                   # stop bits
-         to       = SERTIMEOUT
+         to       = POLL_INTERVAL
          self.ELMver = "Unknown"
+         self.protocol = "Unknown"
+         self.adapter_baud = baud # rate the adapter answered at before ATBRD
          self.State = 1 #state SERIAL is 1 connected, 0 disconnected (connection failed)
          self.port = None
+         self.rxbuf = "" # bytes received after the last prompt
+         self.desync = True # set when a reply ended without a prompt,
+                            # drops whatever the adapter sent before we came
+         self.last_cmd = None
+         self.sent_at = None # time.time() the last command was sent
+         self.reply_deadline = None # seconds its reply may take
+         self.bus_init = False # next request wakes a K-line bus after ATSP
+         self.repeat_last = False # use empty CR to repeat the same PID
+         self.deadlines = dict(DEADLINES)
+         self.default_deadline = SERTIMEOUT
+         self.timeouts = {} # command -> number of timeouts
+         self.cache = ValueCache()
+         self.settings = {} # known adapter settings, e.g. "e" -> "0"
+         self.vin = None
+         self.ecus = [] # addresses of the ECUs answering mode 01
+         self.headers = False # ATH1 kept on to tell several ECUs apart
+         self.ecu_values = {} # ECU address -> {shortname: value}, with headers
+         self.supported = None # SupportedPIDs, read on first use
+         self.codes = {} # PID -> hex data of the value last read
+         self.response_count = "" # appended to mode 01 requests once
+                                  # the number of ECUs is known
+         self.response_time = None # slowest ECU response seen, seconds
+         if profiles is None:
+             profiles = obd_profile.ProfileStore()
+         self.profiles = profiles
          
          self._notify_window=_notify_window
          debug_display(self._notify_window, 1, "Opening interface (serial port)")
@@ -99,20 +803,26 @@ class OBDPort:
          debug_display(self._notify_window, 1, "Connecting to ECU...")
          
          try:
-            self.send_command("atz")   # initialize
-            time.sleep(1)
+            self.ELMver = self.reset_adapter()   # initialize
          except serial.SerialException:
             self.State = 0
             return None
             
-         self.ELMver = self.get_result()
          if(self.ELMver is None):
             self.State = 0
             return None
          
-         debug_display(self._notify_window, 2, "atz response:" + self.ELMver)
-         self.send_command("ate0")  # echo off
-         debug_display(self._notify_window, 2, "ate0 response:" + self.get_result())
+         debug_display(self._notify_window, 2, "reset response:" + self.ELMver)
+         self.adapter_baud = self.port.baudrate
+         if max_baud is not None:
+             self.negotiate_baud(max_baud)
+         for name, value in ADAPTER_SETTINGS:
+             self.set_option(name, value)
+
+         if self.warm_connect(portnum):
+            debug_display(self._notify_window, 2, "known vehicle, protocol " + self.protocol)
+            return None
+
          self.send_command("0100")
          ready = self.get_result()
          
@@ -121,6 +831,12 @@ class OBDPort:
             return None
             
          debug_display(self._notify_window, 2, "0100 response:" + ready)
+         self.send_command("atdpn") # protocol chosen by auto search
+         protocol = self.get_result()
+         if protocol is not None:
+            self.protocol = protocol
+         debug_display(self._notify_window, 2, "atdpn response:" + self.protocol)
+         self.learn_vehicle(portnum)
          return None
               
      def close(self):
@@ -132,68 +848,354 @@ class OBDPort:
          
          self.port = None
          self.ELMver = "Unknown"
+         self.protocol = "Unknown"
+         self.cache.invalidate()
+
+     def reset_adapter(self):
+         """Internal use only: not a public interface"""
+         # an adapter that answers right away only needs a warm start,
+         # a cold reset adds the LED test. Both end with the prompt.
+         # ATWS also keeps a rate set by ATBRD or found by detect_baud()
+         self.send_command("ati")
+         if self.get_result(PROBE_DEADLINE) is not None or self.detect_baud():
+             cmd = "atws"
+         else:
+             cmd = "atz"
+         self.send_command(cmd)
+         version = self.get_result()
+         # replies still under way from before (e.g. the atz of a previous
+         # close) echo another command, skip them
+         while version is not None and "ELM" in version and \
+               string.lower(version[:version.find("ELM")]) not in ("", cmd):
+             version = self.get_result()
+         if version is None:
+             return None
+         self.settings = dict(RESET_SETTINGS)
+         if "ELM" in version: # drop the echo of the reset command
+             version = version[version.find("ELM"):]
+         return version
+
+     def detect_baud(self):
+         """Internal use only: not a public interface"""
+         opened = self.port.baudrate
+         for rate in BAUD_RATES:
+             if rate == opened:
+                 continue
+             self.port.baudrate = rate
+             self.desync = True
+             self.send_command("ati")
+             r = self.get_result(PROBE_DEADLINE)
+             if r is not None and "ELM" in r:
+                 debug_display(self._notify_window, 2, "adapter found at %d baud" % rate)
+                 return True
+         self.port.baudrate = opened
+         self.desync = True
+         return False
+
+     def negotiate_baud(self, max_baud):
+         """Switches adapter and port to the fastest rate up to max_baud
+         both can handle (ATBRD). Stays at the current rate if the adapter
+         does not know ATBRD or no faster rate works."""
+         opened = self.port.baudrate
+         for rate in FAST_BAUD_RATES:
+             if rate > max_baud or rate <= opened:
+                 continue
+             self.send_command("atbrd%02X" % int(round(4000000.0 / rate)))
+             r = self.read_until(["OK\r", ">"], self.command_deadline("at"))
+             if r is None or "OK" not in r: # "?", ATBRD not supported
+                 self.desync = True
+                 return opened
+             # the adapter sends its ID at the new rate, a CR confirms it
+             self.port.baudrate = rate
+             ident = self.read_until(["\r"], BRD_DEADLINE)
+             if ident is not None and "ELM" in ident:
+                 self.port.write("\r")
+                 self.sent_at = time.time()
+                 try:
+                     self.read_reply() # the prompt, at the new rate
+                     debug_display(self._notify_window, 2, "switched to %d baud" % rate)
+                     return rate
+                 except OBDTimeout:
+                     pass
+             # adapter went back to the old rate
+             self.port.baudrate = opened
+             self.desync = True
+             time.sleep(BRD_DEADLINE)
+         return opened
+
+     def read_until(self, markers, deadline):
+         """Internal use only: not a public interface"""
+         buffer = self.rxbuf
+         end = time.time() + deadline
+         while 1:
+             for marker in markers:
+                 i = buffer.find(marker)
+                 if i >= 0:
+                     self.rxbuf = buffer[i+len(marker):]
+                     return buffer[:i+len(marker)]
+             if time.time() > end:
+                 break
+             buffer = buffer + self.port.read(max(self.port.inWaiting(), 1))
+         self.rxbuf = ""
+         return None
+
+     def set_option(self, name, value):
+         """Sends AT command name+value unless the adapter already has it"""
+         if self.settings.get(name) == value:
+             return
+         self.send_command("at" + name + value)
+         r = self.get_result()
+         if r is not None and "OK" in r:
+             self.settings[name] = value
+         debug_display(self._notify_window, 2, "at%s%s response:%s" % (name, value, r))
+
+     def warm_connect(self, portnum):
+         """Internal use only: not a public interface"""
+         # any car seen on this port may be plugged in; try the protocols
+         # of their profiles, the last car's first
+         protocols = self.profiles.protocols(portnum)
+         profile = None
+         for protocol in protocols:
+             self.send_command("atsp" + protocol) # no search
+             self.get_result()
+             self.protocol = protocol
+             self.bus_init = protocol not in CAN_PROTOCOLS
+             profile = self.match_profile(portnum)
+             if profile is not None:
+                 break
+         if profile is None:
+             if protocols:
+                 self.send_command("atsp0") # back to automatic search
+                 self.get_result()
+                 self.protocol = "Unknown"
+             return False
+         self.profiles.store(portnum, profile) # now the last car seen here
+
+         self.vin = profile["vin"] and str(profile["vin"])
+         self.set_ecus([str(ecu) for ecu in profile["ecus"]])
+         self.response_time = profile["response_time"]
+         timing = profile.get("timing")
+         if timing is not None:
+             self.set_option("st", str(timing["st"]))
+             self.set_option("at", str(timing["at"]))
+         else:
+             self.tune_timing()
+         self.cache.put(obd_sensors.SENSORS[0], str(profile["pids"]))
+         if profile.get("supported") is not None:
+             self.supported = SupportedPIDs(profile["supported"])
+         return True
+
+     def match_profile(self, portnum):
+         """Internal use only: not a public interface"""
+         # profile of the car answering at self.protocol, or None
+         vin = self.read_vin()
+         if vin is not None:
+             profile = self.profiles.get(portnum, vin)
+         else: # car without VIN, recognize it by its PIDs
+             profile = self.profiles.get(portnum, None)
+             if profile is not None:
+                 self.send_command("0100")
+                 if self.read_pids() != profile["pids"]:
+                     profile = None
+         if profile is None or str(profile["protocol"]) != self.protocol:
+             return None
+         return profile
+
+     def learn_vehicle(self, portnum):
+         """Internal use only: not a public interface"""
+         self.vin = self.read_vin()
+         protocol = self.protocol[-1:] # without "A" of auto search
+
+         # headers tell who answers
+         self.set_option("h", "1")
+         self.send_command("0100")
+         try:
+             replies = split_by_ecu(self.read_reply(), protocol)
+         except OBDTimeout:
+             replies = []
+         self.set_ecus(sorted([address for address, data in replies]))
+         self.tune_timing()
+
+         pids = self.sensor(0)[1]
+         if len(self.ecus) == 0 or pids in ("NODATA", "NORESPONSE"):
+             return
+         self.profiles.store(portnum, {
+             "vin": self.vin,
+             "protocol": protocol,
+             "ecus": self.ecus,
+             "pids": pids,
+             "supported": self.supported_pids().ranges(),
+             "response_time": self.response_time,
+             "timing": {"st": self.settings.get("st"), "at": self.settings.get("at")},
+             })
+
+     def set_ecus(self, ecus):
+         """Internal use only: not a public interface"""
+         self.ecus = ecus
+         if 0 < len(ecus) < 16:
+             self.response_count = "%X" % len(ecus)
+         else:
+             self.response_count = ""
+         # a single ECU is faster without headers, several need them
+         self.headers = len(ecus) > 1
+         self.set_option("h", self.headers and "1" or "0")
+         self.ecu_values = {}
+
+     def tune_timing(self):
+         """Measures how fast the ECUs answer and sets ATST and adaptive
+         timing to match, so the adapter does not idle after the last
+         reply for the default 200 ms"""
+         if self.response_count == "":
+             return # can not tell the ECU from the adapter's idle wait
+         # with the response count the prompt comes right after the last
+         # ECU, so the round trip is the ECU response time
+         times = []
+         for i in range(TIMING_SAMPLES):
+             self.send_command("0100" + self.response_count)
+             start = time.time()
+             try:
+                 self.read_reply()
+             except OBDTimeout:
+                 continue
+             times.append(time.time() - start)
+         if len(times) == 0:
+             return
+         self.response_time = max(times)
+         st, at = response_timing(times)
+         self.set_option("st", st)
+         self.set_option("at", at)
+
+     def read_pids(self):
+         """Internal use only: not a public interface"""
+         try:
+             reply = self.read_response()
+         except OBDTimeout:
+             return None
+         if reply.status is not None:
+             return None
+         # one line per ECU with headers off, a PID is supported if any
+         # ECU supports it (as learn_vehicle stored it)
+         pids = merged_bitmap(reply.data, 0x00)
+         return pids and obd_sensors.SENSORS[0].value(pids)
+
+     def read_vin(self):
+         """Returns the vehicle identification number or None"""
+         # older protocols send the VIN in 5 messages; with several ECUs
+         # only the headers tell whose they are, so they are on for this
+         self.set_option("h", "1")
+         self.send_command("0902")
+         try:
+             reply = parse_reply(self.read_reply(), self.protocol)
+         except OBDTimeout:
+             reply = None
+         self.set_option("h", self.headers and "1" or "0")
+         if reply is None:
+             return None
+         for address, data in reply.data: # messages joined per ECU
+             vin = decode_vin(data)
+             if vin is not None:
+                 return vin
+         return None
+
+     def is_can(self):
+         """Returns True if the adapter is talking to the car over CAN"""
+         protocol = self.protocol
+         if len(protocol) == 2 and protocol[0] == "A": # "A" marks auto search
+             protocol = protocol[1]
+         return protocol in CAN_PROTOCOLS
 
      def send_command(self, cmd):
          """Internal use only: not a public interface"""
          if self.port:
-             self.port.flushOutput()
-             self.port.flushInput()
-             for c in cmd:
-                 self.port.write(c)
-             self.port.write("\r\n")
+             if self.desync or self.rxbuf != "":
+                 # a reply was cut short or overran its prompt, drop the rest
+                 self.port.flushInput()
+                 self.rxbuf = ""
+                 self.desync = False
+             if self.repeat_last and cmd == self.last_cmd and cmd[:2].lower() != "at":
+                 self.port.write("\r") # ELM327 repeats last command on empty CR
+             else:
+                 self.port.write(cmd + "\r")
+             self.last_cmd = cmd
+             self.sent_at = time.time()
+             self.reply_deadline = self.command_deadline(cmd)
+             if self.bus_init and cmd[:2].lower() != "at":
+                 # the ECUs answer after the 5 baud or fast init
+                 self.reply_deadline = max(self.reply_deadline, self.command_deadline("0100"))
+                 self.bus_init = False
              #debug_display(self._notify_window, 3, "Send command:" + cmd)
 
      def interpret_result(self,code):
          """Internal use only: not a public interface"""
-         # Code will be the string returned from the device.
-         # It should look something like this:
-         # '41 11 0 0\r\r'
-         
-         # 9 seems to be the length of the shortest valid response
-         if len(code) < 7:
-             #raise Exception("BogusCode")
-             print "boguscode?"+code
-         
-         # get the first thing returned, echo should be off
-         code = string.split(code, "\r")
-         code = code[0]
-         
-         #remove whitespace
-         code = string.split(code)
-         code = string.join(code, "")
-         
-         #cables can behave differently 
-         if code[:6] == "NODATA": # there is no such sensor
+         # Code will be the string returned from the device, e.g.
+         # '41 11 0 0\r\r'. Returns the data after mode and PID, or
+         # "NODATA" if the adapter said anything else (NO DATA, CAN ERROR...)
+         reply = parse_reply(code)
+         if reply.status is not None:
              return "NODATA"
-             
-         # first 4 characters are code from ELM
-         code = code[4:]
-         return code
+         return reply.data[0][1][4:]
     
-     def get_result(self):
+     def command_deadline(self, cmd):
+         """Returns how many seconds to wait for the reply to cmd"""
+         cmd = string.lower(cmd)
+         for prefix in (cmd[:4], cmd[:3], cmd[:2]):
+             if prefix in self.deadlines:
+                 return self.deadlines[prefix]
+         return self.default_deadline
+
+     def read_reply(self, deadline=None):
+         """Returns the reply to the last command, up to the prompt, one
+         line per "\\r". Raises OBDTimeout if the prompt does not arrive
+         in time."""
+         if deadline is None:
+             deadline = self.reply_deadline or self.command_deadline(self.last_cmd or "")
+         # counted from sending the command; bytes that keep coming without
+         # a prompt (SEARCHING..., bus chatter, noise) do not extend it
+         end = (self.sent_at or time.time()) + deadline
+         chunks = [self.rxbuf]
+         prompt = self.rxbuf.find(">")
+         while prompt < 0:
+             if time.time() > end:
+                break
+             # take everything the driver has, block for at least a byte
+             c = self.port.read(max(self.port.inWaiting(), 1))
+             if len(c) == 0:
+                continue
+             prompt = c.find(">")
+             if prompt >= 0:
+                prompt = prompt + sum([len(chunk) for chunk in chunks])
+             chunks.append(c)
+
+         buffer = string.join(chunks, "")
+         if prompt < 0:
+            self.rxbuf = ""
+            self.desync = True
+            buffer = string.replace(buffer, "\r", "")
+            self.timeouts[self.last_cmd] = self.timeouts.get(self.last_cmd, 0) + 1
+            debug_display(self._notify_window, 3, "Timeout: %s" % self.last_cmd)
+            raise OBDTimeout(self.last_cmd, deadline, buffer)
+
+         # keep bytes after the prompt for next reply
+         self.rxbuf = buffer[prompt+1:]
+         return buffer[:prompt]
+
+     def read_response(self, deadline=None):
+         """Returns the parsed Reply to the last command, with headers on
+         the known ECUs first. Raises OBDTimeout like read_reply()."""
+         if not self.headers:
+             return parse_reply(self.read_reply(deadline))
+         reply = parse_reply(self.read_reply(deadline), self.protocol)
+         ranks = dict([(address, i) for i, address in enumerate(self.ecus)])
+         reply.data.sort(key=lambda r: ranks.get(r[0], len(ranks)))
+         return reply
+
+     def get_result(self, deadline=None):
          """Internal use only: not a public interface"""
-         #time.sleep(0.01)
-         repeat_count = 0
          if self.port is not None:
-             buffer = ""
-             while 1:
-                 c = self.port.read(1)
-                 if len(c) == 0:
-                    if(repeat_count == 5):
-                        break
-                    print "Got nothing\n"
-                    repeat_count = repeat_count + 1
-                    continue
-                    
-                 if c == '\r':
-                    continue
-                    
-                 if c == ">":
-                    break;
-                     
-                 if buffer != "" or c != ">": #if something is in buffer, add everything
-                    buffer = buffer + c
-                    
+             try:
+                 buffer = string.replace(self.read_reply(deadline), "\r", "")
+             except OBDTimeout as e:
+                 buffer = e.partial
              #debug_display(self._notify_window, 3, "Get result:" + buffer)
              if(buffer == ""):
                 return None
@@ -202,21 +1204,158 @@ class OBDPort:
             debug_display(self._notify_window, 3, "NO self.port!")
          return None
 
-     # get sensor value from command
+     # get sensor value, from cache if still valid
      def get_sensor_value(self,sensor):
          """Internal use only: not a public interface"""
-         cmd = sensor.cmd
-         self.send_command(cmd)
-         data = self.get_result()
-         
-         if data:
-             data = self.interpret_result(data)
-             if data != "NODATA":
-                 data = sensor.value(data)
+         data = self.cache.get(sensor)
+         if data is None:
+             data = self.read_sensor_value(sensor)
+             self.cache.put(sensor, data)
+         return data
+
+     # get sensor value from command
+     def read_sensor_value(self,sensor):
+         """Internal use only: not a public interface"""
+         if self.headers:
+             return self.read_ecu_values([sensor])[0]
+         if self.response_count != "":
+             cmd = sensor.cmd[:4] + self.response_count
          else:
+             cmd = sensor.cmd
+         self.send_command(cmd)
+         try:
+             reply = self.read_response()
+         except OBDTimeout: # skip this PID, caller moves on
              return "NORESPONSE"
-             
-         return data
+         if reply.status is not None:
+             return status_value(reply.status)
+         if sensor.pid in SUPPORT_PIDS and sensor.cmd[:2] == "01":
+             # several ECUs may answer on separate lines, OR their bitmaps
+             code = merged_bitmap(reply.data, sensor.pid)
+             if code is None:
+                 return "NODATA"
+             self.codes[sensor.pid] = code
+             return sensor.value(code)
+         # first 4 characters are mode and PID
+         code = reply.data[0][1][4:]
+         self.codes[sensor.pid] = code
+         return sensor.value(code)
+
+     # get sensor values of several mode 01 sensors, batched on CAN
+     def get_sensor_values(self, sensors):
+         """Internal use only: not a public interface"""
+         values = [self.cache.get(s) for s in sensors]
+         missing = [s for s, v in zip(sensors, values) if v is None]
+
+         if not self.is_can():
+             read = [self.read_sensor_value(s) for s in missing]
+         else:
+             read = []
+             for i in range(0, len(missing), MAX_BATCH_PIDS):
+                 read.extend(self.get_batch_values(missing[i:i+MAX_BATCH_PIDS]))
+
+         read = iter(read)
+         for i in range(len(values)):
+             if values[i] is None:
+                 values[i] = read.next()
+                 self.cache.put(sensors[i], values[i])
+         return values
+
+     def get_batch_values(self, sensors):
+         """Internal use only: not a public interface"""
+         pids = [s.pid for s in sensors]
+         batchable = len(sensors) > 1
+         for s, pid in zip(sensors, pids):
+             if s.cmd[:2] != "01" or pid not in obd_sensors.PID_DATA_BYTES:
+                 batchable = False
+         if not batchable:
+             return [self.read_sensor_value(s) for s in sensors]
+         if self.headers:
+             return self.read_ecu_values(sensors)
+
+         self.send_command("01" + string.join([s.cmd[2:4] for s in sensors], "") +
+                           self.response_count)
+         try:
+             reply = self.read_response()
+         except OBDTimeout:
+             return ["NORESPONSE"] * len(sensors)
+         if reply.status is not None:
+             return [status_value(reply.status)] * len(sensors)
+
+         split = split_batch_reply(reply.data[0][1], pids)
+         if split is None: # could not demultiplex, ask one by one
+             return [self.read_sensor_value(s) for s in sensors]
+
+         values = []
+         for s, pid in zip(sensors, pids):
+             if pid in split:
+                 self.codes[pid] = split[pid]
+                 values.append(s.value(split[pid]))
+             else:
+                 values.append("NODATA")
+         return values
+
+     def read_ecu_values(self, sensors):
+         """Internal use only: not a public interface"""
+         # one request, every ECU answers with its part of the PIDs
+         pids = [s.pid for s in sensors]
+         self.send_command("01" + string.join([s.cmd[2:4] for s in sensors], "") +
+                           self.response_count)
+         try:
+             reply = self.read_response()
+         except OBDTimeout:
+             return ["NORESPONSE"] * len(sensors)
+         if reply.status is not None:
+             return [status_value(reply.status)] * len(sensors)
+
+         for values in self.ecu_values.values(): # ECUs may stop answering
+             for s in sensors:
+                 values.pop(s.shortname, None)
+         merged = {}
+         for address, data in reply.data:
+             if len(pids) == 1 and pids[0] not in obd_sensors.PID_DATA_BYTES:
+                 split = None
+                 if data[:4] == "41" + sensors[0].cmd[2:4]:
+                     split = {pids[0]: data[4:]}
+             else:
+                 split = split_batch_reply(data, pids)
+             if split is None:
+                 continue
+             values = self.ecu_values.setdefault(address, {})
+             for s, pid in zip(sensors, pids):
+                 if pid not in split:
+                     continue
+                 values[s.shortname] = s.value(split[pid])
+                 if pid not in merged:
+                     merged[pid] = split[pid]
+                 elif pid in SUPPORT_PIDS:
+                     merged[pid] = merge_bitmaps(merged[pid], split[pid])
+
+         values = []
+         for s, pid in zip(sensors, pids):
+             if pid in merged:
+                 self.codes[pid] = merged[pid]
+                 values.append(s.value(merged[pid]))
+             else:
+                 values.append("NODATA")
+         return values
+
+     def sensor_by_ecu(self, sensor_index):
+         """Returns dictionary of ECU address -> value of given sensor,
+         read now. Without headers (one ECU) the address is that ECU's or
+         None if it is not known."""
+         sensor = obd_sensors.SENSORS[sensor_index]
+         if not self.headers:
+             value = self.read_sensor_value(sensor)
+             self.cache.put(sensor, value)
+             return {(self.ecus or [None])[0]: value}
+         merged = self.read_ecu_values([sensor])[0]
+         self.cache.put(sensor, merged)
+         values = {}
+         for address, ecu_values in self.ecu_values.items():
+             if sensor.shortname in ecu_values:
+                 values[address] = ecu_values[sensor.shortname]
+         return values
 
      # return string of sensor name and value from sensor index
      def sensor(self , sensor_index):
@@ -226,6 +1365,24 @@ class OBDPort:
          r = self.get_sensor_value(sensor)
          return (sensor.name,r, sensor.unit)
 
+     def sensors(self, sensor_indexes):
+         """Returns list of 3-tuples of given sensors, same as sensor().
+         On CAN vehicles up to six mode 01 PIDs share one request."""
+         sensors = [obd_sensors.SENSORS[i] for i in sensor_indexes]
+         values = self.get_sensor_values(sensors)
+         return [(s.name, v, s.unit) for s, v in zip(sensors, values)]
+
+     def read_samples(self, samples, sensors=None):
+         """Refills preallocated Samples with time, data and value of
+         their PIDs, read like sensors() but without a tuple per value"""
+         return read_samples(self, samples, sensors)
+
+     def supported_pids(self):
+         """Returns SupportedPIDs of the car, read once per connection"""
+         if self.supported is None:
+             self.supported = read_supported_pids(self)
+         return self.supported
+
      def sensor_names(self):
          """Internal use only: not a public interface"""
          names = []
@@ -263,17 +1420,19 @@ class OBDPort:
           dtcNumber = r[0]
           mil = r[1]
           DTCCodes = []
-          
+          if self.headers: # DTCs of all ECUs
+             dtcNumber = sum([v[0] for v in self.sensor_by_ecu(1).values() if type(v) == list])
           
           print "Number of stored DTC:" + str(dtcNumber) + " MIL: " + str(mil)
           # get all DTC, 3 per mesg response
           for i in range(0, ((dtcNumber+2)/3)):
             self.send_command(GET_DTC_COMMAND)
-            res = self.get_result()
-            print "DTC result:" + res
-            for i in range(0, 3):
-                val1 = hex_to_int(res[3+i*6:5+i*6])
-                val2 = hex_to_int(res[6+i*6:8+i*6]) #get DTC codes from response (3 DTC each 2 bytes)
+            for res in self.get_results():
+              print "DTC result:" + res
+              res = string.join(string.split(res), "") # spaces may be off
+              for i in range(0, 3):
+                val1 = hex_to_int(res[2+i*4:4+i*4])
+                val2 = hex_to_int(res[4+i*4:6+i*4]) #get DTC codes from response (3 DTC each 2 bytes)
                 val  = (val1<<8)+val2 #DTC val as int
                 
                 if val==0: #skip fill of last packet
@@ -285,34 +1444,53 @@ class OBDPort:
           
           #read mode 7
           self.send_command(GET_FREEZE_DTC_COMMAND)
-          res = self.get_result()
+          for res in self.get_results():
+            res = string.join(string.split(res), "") # spaces may be off
           
-          if res[:7] == "NODATA": #no freeze frame
-            return DTCCodes
+            if res[:6] == "NODATA": #no freeze frame
+              return DTCCodes
           
-          print "DTC freeze result:" + res
-          for i in range(0, 3):
-              val1 = hex_to_int(res[3+i*6:5+i*6])
-              val2 = hex_to_int(res[6+i*6:8+i*6]) #get DTC codes from response (3 DTC each 2 bytes)
-              val  = (val1<<8)+val2 #DTC val as int
+            print "DTC freeze result:" + res
+            for i in range(0, 3):
+                val1 = hex_to_int(res[2+i*4:4+i*4])
+                val2 = hex_to_int(res[4+i*4:6+i*4]) #get DTC codes from response (3 DTC each 2 bytes)
+                val  = (val1<<8)+val2 #DTC val as int
+                  
+                if val==0: #skip fill of last packet
+                  break
+                     
+                DTCStr=dtcLetters[(val&0xC000)>14]+str((val&0x3000)>>12)+str((val&0x0f00)>>8)+str((val&0x00f0)>>4)+str(val&0x000f)
+                DTCCodes.append(["Passive",DTCStr])
                 
-              if val==0: #skip fill of last packet
-                break
-                   
-              DTCStr=dtcLetters[(val&0xC000)>14]+str((val&0x3000)>>12)+str((val&0x0f00)>>8)+str((val&0x00f0)>>4)+str(val&0x000f)
-              DTCCodes.append(["Passive",DTCStr])
-              
           return DTCCodes
               
+     def get_results(self):
+         """Internal use only: not a public interface"""
+         # the reply of each ECU with headers on, else the whole reply
+         try:
+             reply = self.read_response()
+         except OBDTimeout:
+             return []
+         return [data for address, data in reply.data]
+
      def clear_dtc(self):
          """Clears all DTCs and freeze frame data"""
          self.send_command(CLEAR_DTC_COMMAND)     
          r = self.get_result()
          return r
      
+     def monitor(self, filters=None, decoders=None, callback=None,
+                 size=MONITOR_RING_SIZE):
+         """Puts the adapter in monitor mode (ATMA) and returns the running
+         CANMonitor. Requests can not be sent until its stop()."""
+         monitor = CANMonitor(ELMFrameSource(self), filters, decoders, callback, size)
+         monitor.start()
+         return monitor
+
      def log(self, sensor_index, filename): 
           file = open(filename, "w")
           start_time = time.time() 
+          self.repeat_last = True # same PID over and over
           if file:
                data = self.sensor(sensor_index)
                file.write("%s     \t%s(%s)\n" % \
@@ -324,3 +1502,24 @@ class OBDPort:
                     file.write(line)
                     file.flush()
           
+
+#___________________________________________________________
+
+def test():
+    # 0x41 (monitor status) batched with other PIDs: only the leading 41
+    # is the mode byte
+    assert split_batch_reply("410C1AF841000000000D20", [0x0C, 0x41, 0x0D]) == \
+           {0x0C: "1AF8", 0x41: "00000000", 0x0D: "20"}
+    assert split_batch_reply("41410007E5000C1AF8", [0x41, 0x0C]) == \
+           {0x41: "0007E500", 0x0C: "1AF8"}
+    # 41 between records starts the next message when 0x41 is not asked
+    # for or already read
+    assert split_batch_reply("410C1AF80D20410C1B00", [0x0C, 0x0D]) == \
+           {0x0C: "1AF8", 0x0D: "20"}
+    assert split_batch_reply("410C1AF8410000000041051B", [0x0C, 0x41, 0x05]) == \
+           {0x0C: "1AF8", 0x41: "00000000", 0x05: "1B"}
+    assert split_batch_reply("7F0112", [0x0C, 0x0D]) is None
+    print "obd_io: ok"
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_profile.py
+#
+# Remembers what was learned about a car on a given adapter port: the
+# OBD protocol, responding ECUs, supported PIDs and response timing.
+# Reconnecting to the same car pins the protocol with ATSP and skips
+# the protocol search and PID discovery.
+###########################################################################
+
+import os
+import json
+
+PROFILE_CACHE = os.path.expanduser("~/.pyobd_profiles")
+
+class ProfileStore:
+    """ Vehicle profiles keyed by adapter port and VIN """
+    def __init__(self, path=PROFILE_CACHE):
+        self.path = path
+        self.ports = {}    # port -> VIN of the car seen last
+        self.vehicles = {} # "port|VIN" -> profile dictionary
+        try:
+            f = open(path)
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            self.ports = data.get("ports", {})
+            self.vehicles = data.get("vehicles", {})
+        except (IOError, ValueError):
+            pass
+
+    def key(self, port, vin):
+        return "%s|%s" % (port, vin)
+
+    def last(self, port):
+        """Returns profile of the car last seen on port, or None"""
+        if port not in self.ports:
+            return None
+        return self.vehicles.get(self.key(port, self.ports[port]))
+
+    def get(self, port, vin):
+        """Returns profile of the car with vin (None: without VIN) as seen
+        on port, or None"""
+        return self.vehicles.get(self.key(port, vin))
+
+    def protocols(self, port):
+        """Returns the protocols of the cars seen on port, the one of the
+        car seen last first"""
+        profiles = [self.last(port)]
+        for key in sorted(self.vehicles.keys()):
+            if key.startswith(port + "|"):
+                profiles.append(self.vehicles[key])
+        protocols = []
+        for profile in profiles:
+            if profile is not None and str(profile["protocol"]) not in protocols:
+                protocols.append(str(profile["protocol"]))
+        return protocols
+
+    def store(self, port, profile):
+        """Saves profile (needs "vin", may be None) as last seen on port"""
+        self.ports[port] = profile["vin"]
+        self.vehicles[self.key(port, profile["vin"])] = profile
+        self.save()
+
+    def forget(self, port):
+        vin = self.ports.pop(port, None)
+        self.vehicles.pop(self.key(port, vin), None)
+        self.save()
+
+    def save(self):
+        try:
+            f = open(self.path, "w")
+            json.dump({"ports": self.ports, "vehicles": self.vehicles}, f,
+                      indent=1, sort_keys=True)
+            f.close()
+        except IOError:
+            pass
@@ -4,39 +4,42 @@ import obd_io
 import serial
 import platform
 import obd_sensors
+import obd_daemon
+import obd_scheduler
 from datetime import datetime
 import time
 import getpass
+import sys
+import shutil
+import tempfile
 
 
-from obd_utils import scanSerial
+from obd_utils import find_adapter
 
 class OBD_Recorder():
-    def __init__(self, path, log_items):
+    def __init__(self, path, log_items, rates = None):
         self.port = None
         self.sensorlist = []
+        self.rates = rates # shortname -> Hz, None polls round robin
         localtime = time.localtime(time.time())
         filename = path+"car-"+str(localtime[0])+"-"+str(localtime[1])+"-"+str(localtime[2])+"-"+str(localtime[3])+"-"+str(localtime[4])+"-"+str(localtime[5])+".log"
         self.log_file = open(filename, "w", 128)
-        self.log_file.write("Time,RPM,MPH,Throttle,Load,Fuel Status\n");
+        self.log_file.write("Time,RPM,km/h,Throttle,Load,Fuel Status\n");
 
         for item in log_items:
             self.add_log_item(item)
 
-        self.gear_ratios = [34/13, 39/21, 36/23, 27/20, 26/21, 25/22]
+        self.gear_ratios = [34/13.0, 39/21.0, 36/23.0, 27/20.0, 26/21.0, 25/22.0]
         #log_formatter = logging.Formatter('%(asctime)s.%(msecs).03d,%(message)s', "%H:%M:%S")
 
     def connect(self):
-        portnames = scanSerial()
-        #portnames = ['COM10']
-        print portnames
-        for port in portnames:
-            self.port = obd_io.OBDPort(port, None, 2, 2)
-            if(self.port.State == 0):
-                self.port.close()
-                self.port = None
-            else:
-                break
+        # share the adapter with other programs if the daemon runs
+        self.port = obd_daemon.connect_daemon()
+        if(self.port):
+            print "Connected to daemon serving "+self.port.port.name
+            return
+
+        self.port = find_adapter()
 
         if(self.port):
             print "Connected to "+self.port.port.name
@@ -45,32 +48,72 @@ class OBD_Recorder():
         return self.port
         
     def add_log_item(self, item):
-        for index, e in enumerate(obd_sensors.SENSORS):
-            if(item == e.shortname):
-                self.sensorlist.append(index)
-                print "Logging item: "+e.name
-                break
+        e = obd_sensors.SENSOR_BY_NAME.get(item)
+        if e is not None:
+            self.sensorlist.append(e.pid)
+            print "Logging item: "+e.name
             
             
-    def record_data(self):
+    def record_data(self, cycles = None):
+        """Logs until interrupted, or for given number of log lines"""
         if(self.port is None):
             return None
         
         print "Logging started"
-        
-        while 1:
+
+        scheduler = None
+        if self.rates:
+            scheduler = obd_scheduler.PollScheduler(self.port, self.rates,
+                                                    self.port.supported_pids())
+
+        # allocated once, refilled every log line
+        samples = [obd_io.Sample(index) for index in self.sensorlist]
+        sensors = [obd_sensors.SENSORS[index] for index in self.sensorlist]
+        position = dict([(sensor.shortname, i) for i, sensor in enumerate(sensors)])
+        codes = getattr(self.port, "codes", None)
+        logged = [None] * len(samples) # value each field of line shows
+        line = [""] * (len(samples) + 1)
+        while cycles is None or cycles > 0:
+            if cycles is not None:
+                cycles = cycles - 1
             localtime = datetime.now()
-            current_time = str(localtime.hour)+":"+str(localtime.minute)+":"+str(localtime.second)+"."+str(localtime.microsecond)
-            log_string = current_time
-            results = {}
-            for index in self.sensorlist:
-                (name, value, unit) = self.port.sensor(index)
-                log_string = log_string + ","+str(value)
-                results[obd_sensors.SENSORS[index].shortname] = value;
-
-            gear = self.calculate_gear(results["rpm"], results["speed"])
-            log_string = log_string #+ "," + str(gear)
-            self.log_file.write(log_string+"\n")
+            line[0] = "%d:%d:%d.%d" % (localtime.hour, localtime.minute,
+                                       localtime.second, localtime.microsecond)
+            if scheduler:
+                # only the channels that were due, others keep last reading
+                due = scheduler.poll()
+                stamp = time.time()
+                for (shortname, value) in due:
+                    i = position.get(shortname)
+                    if i is not None:
+                        obd_io.fill_sample(samples[i], stamp, value, codes)
+            else:
+                self.port.read_samples(samples, sensors)
+            for i in xrange(len(samples)):
+                value = samples[i].value
+                last = logged[i]
+                if value is last or (type(value) is type(last) and value == last):
+                    continue
+                logged[i] = value
+                if value is None:
+                    line[i + 1] = ""
+                else:
+                    line[i + 1] = str(value)
+
+            gear = self.calculate_gear(self.value("rpm", samples, position),
+                                       self.value("speed", samples, position))
+            self.log_file.write(",".join(line)+"\n") #+ "," + str(gear)
+
+    def value(self, shortname, samples, position):
+        """Returns the logged value of shortname, "" if it is not logged
+        or not a number (None, NODATA, NORESPONSE)"""
+        i = position.get(shortname)
+        if i is None:
+            return ""
+        value = samples[i].value
+        if not isinstance(value, (int, long, float)):
+            return ""
+        return value
 
             
     def calculate_gear(self, rpm, speed):
@@ -79,11 +122,11 @@ class OBD_Recorder():
         if rpm == "" or rpm == 0:
             return 0
 
-        rps = rpm/60
-        mps = (speed*1.609*1000)/3600
+        rps = rpm/60.0
+        mps = (speed*1000)/3600.0 # km/h
         
-        primary_gear = 85/46 #street triple
-        final_drive  = 47/16
+        primary_gear = 85/46.0 #street triple
+        final_drive  = 47/16.0
         
         tyre_circumference = 1.978 #meters
 
@@ -93,11 +136,39 @@ class OBD_Recorder():
         gear = min((abs(current_gear_ratio - i), i) for i in self.gear_ratios)[1] 
         return gear
         
-username = getpass.getuser()  
-logitems = ["rpm", "speed", "throttle_pos", "load", "fuel_status"]
-o = OBD_Recorder('/home/'+username+'/pyobd-pi-TFT/log/', logitems)
-o.connect()
-
-if not o.is_connected():
-    print "Not connected"
-o.record_data()
+class SilentPort:
+    """ A port whose car never answers, for test() """
+    def get_sensor_values(self, sensors):
+        return ["NORESPONSE"] * len(sensors)
+
+    def read_samples(self, samples, sensors=None):
+        return obd_io.read_samples(self, samples, sensors)
+
+    def supported_pids(self):
+        return None
+
+def test():
+    path = tempfile.mkdtemp()
+    try:
+        for rates in (None, {"rpm": 10, "speed": 10}):
+            o = OBD_Recorder(path + "/", ["rpm", "speed", "load"], rates)
+            o.port = SilentPort()
+            o.record_data(3) # no TypeError from calculate_gear()
+            o.log_file.close()
+    finally:
+        shutil.rmtree(path)
+    print "obd_recorder: ok"
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["test"]:
+        test()
+        sys.exit(0)
+    username = getpass.getuser()  
+    logitems = ["rpm", "speed", "throttle_pos", "load", "fuel_status"]
+    lograte = {"rpm": 10, "speed": 10, "throttle_pos": 10, "load": 5, "fuel_status": 0.2}
+    o = OBD_Recorder('/home/'+username+'/pyobd-pi-TFT/log/', logitems, lograte)
+    o.connect()
+
+    if not o.is_connected():
+        print "Not connected"
+    o.record_data()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+###########################################################################
+# obd_scheduler.py
+#
+# Polls sensors at individual target rates instead of round robin.
+# Every channel has a period (1/Hz) and a next due time; the channel with
+# the earliest due time goes on the bus first (earliest deadline first).
+# Channels that are due together share one batched request.
+###########################################################################
+
+import time
+
+import obd_io
+import obd_sensors
+
+# weight of the newest round trip in the running average
+RTT_WEIGHT = 0.2
+
+class Channel:
+    """ One polled sensor and its bookkeeping """
+    def __init__(self, index, hz):
+        self.index = index
+        self.sensor = obd_sensors.SENSORS[index]
+        self.shortname = self.sensor.shortname
+        self.hz = hz
+        self.period = 1.0 / hz
+        self.next_due = 0
+        self.rtt = None # running average of seconds per read
+        self.samples = 0
+        self.value = None
+
+class PollScheduler:
+    """ Shares one OBDPort between sensors with different target rates """
+    def __init__(self, port, rates = None, supported = None):
+        self.port = port
+        self.channels = []
+        self.supported = supported # SupportedPIDs, None polls every sensor
+        self.skipped = [] # shortnames the car does not support
+        self.start_time = time.time()
+        if rates:
+            for shortname, hz in rates.items():
+                self.add(shortname, hz)
+
+    def add(self, shortname, hz):
+        """Adds sensor with given shortname, polled hz times a second,
+        unless the supported PIDs given to the scheduler lack it"""
+        e = obd_sensors.SENSOR_BY_NAME.get(shortname)
+        if e is None:
+            raise ValueError("Unknown sensor: %s" % shortname)
+        if self.supported is not None and e.pid not in self.supported:
+            self.skipped.append(shortname)
+            return
+        self.channels.append(Channel(e.pid, hz))
+
+    def poll(self):
+        """Reads the channels that are due, earliest deadline first, and
+        returns a list of (shortname, value). Sleeps until the next
+        deadline if nothing is due yet."""
+        if len(self.channels) == 0:
+            return []
+
+        wait = self.wait_time()
+        if wait > 0:
+            time.sleep(wait)
+        due = self.due()
+
+        start = time.time()
+        values = self.port.get_sensor_values([c.sensor for c in due])
+        return self.record(due, values, start, time.time())
+
+    def wait_time(self):
+        """Returns seconds until the earliest channel is due"""
+        return max(0, min([c.next_due for c in self.channels]) - time.time())
+
+    def due(self):
+        """Returns the channels to read next, earliest deadline first, as
+        many as fit in one request"""
+        now = max(time.time(), min([c.next_due for c in self.channels]))
+        due = [c for c in self.channels if c.next_due <= now]
+        due.sort(key=lambda c: c.next_due)
+        return due[:obd_io.MAX_BATCH_PIDS]
+
+    def record(self, due, values, start, end):
+        """Books values of the due channels read between start and end,
+        returns list of (shortname, value)"""
+        cost = (end - start) / len(due)
+        results = []
+        for c, value in zip(due, values):
+            if c.rtt is None:
+                c.rtt = cost
+            else:
+                c.rtt = c.rtt + RTT_WEIGHT * (cost - c.rtt)
+            # a channel that fell behind is due now, not in a burst later
+            c.next_due = max(c.next_due + c.period, end)
+            c.samples = c.samples + 1
+            c.value = value
+            results.append((c.shortname, value))
+        return results
+
+    def load(self):
+        """Returns the fraction of bus time the requested rates need,
+        from measured round trips. Above 1.0 not every rate can be met."""
+        return sum([c.hz * (c.rtt or 0) for c in self.channels])
+
+    def report(self):
+        """Returns list of (shortname, requested Hz, achieved Hz, round
+        trip seconds) for every channel."""
+        elapsed = time.time() - self.start_time
+        report = []
+        for c in self.channels:
+            report.append((c.shortname, c.hz, c.samples / elapsed, c.rtt))
+        return report
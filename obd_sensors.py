@@ -22,56 +22,18 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 ###########################################################################
 
+from binascii import hexlify
+
 def hex_to_int(str):
-    i = eval("0x" + str, {}, {})
-    return i
-
-def maf(code):
-    code = hex_to_int(code)
-    return code * 0.00132276
-
-def throttle_pos(code):
-    code = hex_to_int(code)
-    return code * 100.0 / 255.0
-
-def intake_m_pres(code): # in kPa
-    code = hex_to_int(code)
-    return code / 0.14504
-  
-def rpm(code):
-    code = hex_to_int(code)
-    return code / 4
-
-def speed(code):
-    code = hex_to_int(code)
-    return code / 1.609
-
-def percent_scale(code):
-    code = hex_to_int(code)
-    return code * 100.0 / 255.0
-
-def timing_advance(code):
-    code = hex_to_int(code)
-    return (code - 128) / 2.0
-
-def sec_to_min(code):
-    code = hex_to_int(code)
-    return code / 60
-
-def temp(code):
-    code = hex_to_int(code)
-    c = code - 40 
-    return 32 + (9 * c / 5) 
+    return int(str, 16)
+
+# bits of a byte as "0"/"1", most significant first
+BYTE_BITS = ["".join([str((b >> i) & 1) for i in range(7, -1, -1)]) for b in range(256)]
 
 def cpass(code):
     #fixme
     return code
 
-def fuel_trim_percent(code):
-    code = hex_to_int(code)
-    #return (code - 128.0) * 100.0 / 128
-    return (code - 128) * 100 / 128
-
 def dtc_decrypt(code):
     #first byte is byte after PID and without spaces
     num = hex_to_int(code[:2]) #A byte
@@ -101,83 +63,277 @@ def dtc_decrypt(code):
     
     res.append(((numD>>7)&0x01)) #EGR SystemC7  bit of different 
     
-    #return res
-    return "#"
+    return res
 
 def hex_to_bitstring(str):
-    bitstring = ""
-    for i in str:
-        # silly type safety, we don't want to eval random stuff
-        if type(i) == type(''): 
-            v = eval("0x%s" % i)
-            if v & 8 :
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 4:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 2:
-                bitstring += '1'
-            else:
-                bitstring += '0'
-            if v & 1:
-                bitstring += '1'
-            else:
-                bitstring += '0'                
-    return bitstring
-
-class Sensor:
-    def __init__(self, shortName, sensorName, sensorcommand, sensorValueFunction, u):
+    if str == "":
+        return ""
+    return bin(int(str, 16))[2:].zfill(len(str) * 4)
+
+def bitstring_raw(data):
+    return "".join([BYTE_BITS[ord(c)] for c in data])
+
+# Mode 01 PIDs of SAE J1979, one row per PID:
+#   (pid, shortname, name, data bytes, layout, scale, offset, unit)
+# The value is scale * X + offset, X taken from the data bytes by layout:
+#   "A"    first byte          "AB"     first two bytes
+#   "ABs"  AB, two's complement "ABCD"  first four bytes
+#   "bits" bitmap as "0"/"1"   "status" monitor status (dtc_decrypt)
+#   "raw"  hex string as received
+# PIDs carrying several quantities give the first one (A, or AB).
+# Units are those of the standard: km/h, kPa, degrees C, g/s.
+PERCENT = 100 / 255.0
+TRIM = 100 / 128.0
+LAMBDA = 2 / 65536.0
+CATALOGUE = [
+    (0x00, "pids"                  , "Supported PIDs"      , 4, "bits"  , 1     , 0    , ""     ),
+    (0x01, "dtc_status"            , "S-S DTC Cleared"     , 4, "status", 1     , 0    , ""     ),
+    (0x02, "dtc_ff"                , "DTC C-F-F"           , 2, "raw"   , 1     , 0    , ""     ),
+    (0x03, "fuel_status"           , "Fuel System Stat"    , 2, "raw"   , 1     , 0    , ""     ),
+    (0x04, "load"                  , "Calc Load Value"     , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x05, "temp"                  , "Coolant Temp"        , 1, "A"     , 1     , -40  , "C"    ),
+    (0x06, "short_term_fuel_trim_1", "S-T Fuel Trim"       , 1, "A"     , TRIM  , -100 , "%"    ),
+    (0x07, "long_term_fuel_trim_1" , "L-T Fuel Trim"       , 1, "A"     , TRIM  , -100 , "%"    ),
+    (0x08, "short_term_fuel_trim_2", "S-T Fuel Trim"       , 1, "A"     , TRIM  , -100 , "%"    ),
+    (0x09, "long_term_fuel_trim_2" , "L-T Fuel Trim"       , 1, "A"     , TRIM  , -100 , "%"    ),
+    (0x0A, "fuel_pressure"         , "FuelRail Pressure"   , 1, "A"     , 3     , 0    , "kPa"  ),
+    (0x0B, "manifold_pressure"     , "Intk Manifold"       , 1, "A"     , 1     , 0    , "kPa"  ),
+    (0x0C, "rpm"                   , "Engine RPM"          , 2, "AB"    , 0.25  , 0    , "rpm"  ),
+    (0x0D, "speed"                 , "Vehicle Speed"       , 1, "A"     , 1     , 0    , "km/h" ),
+    (0x0E, "timing_advance"        , "Timing Advance"      , 1, "A"     , 0.5   , -64  , "deg"  ),
+    (0x0F, "intake_air_temp"       , "Intake Air Temp"     , 1, "A"     , 1     , -40  , "C"    ),
+    (0x10, "maf"                   , "AirFlow Rate(MAF)"   , 2, "AB"    , 0.01  , 0    , "g/s"  ),
+    (0x11, "throttle_pos"          , "Throttle Position"   , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x12, "secondary_air_status"  , "2nd Air Status"      , 1, "raw"   , 1     , 0    , ""     ),
+    (0x13, "o2_sensor_positions"   , "Loc of O2 sensors"   , 1, "raw"   , 1     , 0    , ""     ),
+    (0x14, "o211"                  , "O2 Sensor: 1 - 1"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x15, "o212"                  , "O2 Sensor: 1 - 2"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x16, "o213"                  , "O2 Sensor: 1 - 3"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x17, "o214"                  , "O2 Sensor: 1 - 4"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x18, "o221"                  , "O2 Sensor: 2 - 1"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x19, "o222"                  , "O2 Sensor: 2 - 2"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x1A, "o223"                  , "O2 Sensor: 2 - 3"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x1B, "o224"                  , "O2 Sensor: 2 - 4"    , 2, "A"     , 0.005 , 0    , "V"    ),
+    (0x1C, "obd_standard"          , "OBD Designation"     , 1, "raw"   , 1     , 0    , ""     ),
+    (0x1D, "o2_sensor_position_b"  , "Loc of O2 sensor"    , 1, "raw"   , 1     , 0    , ""     ),
+    (0x1E, "aux_input"             , "Aux input status"    , 1, "raw"   , 1     , 0    , ""     ),
+    (0x1F, "engine_time"           , "Engine Start Time"   , 2, "AB"    , 1     , 0    , "s"    ),
+    (0x20, "pids_21_40"            , "Supported PIDs 21-40", 4, "bits"  , 1     , 0    , ""     ),
+    (0x21, "mil_distance"          , "Distance MIL on"     , 2, "AB"    , 1     , 0    , "km"   ),
+    (0x22, "fuel_rail_pressure_vac", "FuelRail P (vac)"    , 2, "AB"    , 0.079 , 0    , "kPa"  ),
+    (0x23, "fuel_rail_pressure"    , "FuelRail P (gauge)"  , 2, "AB"    , 10    , 0    , "kPa"  ),
+    (0x24, "o2_lambda_1"           , "O2 S1 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x25, "o2_lambda_2"           , "O2 S2 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x26, "o2_lambda_3"           , "O2 S3 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x27, "o2_lambda_4"           , "O2 S4 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x28, "o2_lambda_5"           , "O2 S5 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x29, "o2_lambda_6"           , "O2 S6 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x2A, "o2_lambda_7"           , "O2 S7 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x2B, "o2_lambda_8"           , "O2 S8 Lambda"        , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x2C, "commanded_egr"         , "Commanded EGR"       , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x2D, "egr_error"             , "EGR Error"           , 1, "A"     , TRIM  , -100 , "%"    ),
+    (0x2E, "evap_purge"            , "Cmd Evap Purge"      , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x2F, "fuel_level"            , "Fuel Level"          , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x30, "warmups"               , "Warm-ups Cleared"    , 1, "A"     , 1     , 0    , ""     ),
+    (0x31, "clr_distance"          , "Distance Cleared"    , 2, "AB"    , 1     , 0    , "km"   ),
+    (0x32, "evap_pressure"         , "Evap Vapor Press"    , 2, "ABs"   , 0.25  , 0    , "Pa"   ),
+    (0x33, "baro_pressure"         , "Barometric Press"    , 1, "A"     , 1     , 0    , "kPa"  ),
+    (0x34, "o2_current_1"          , "O2 S1 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x35, "o2_current_2"          , "O2 S2 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x36, "o2_current_3"          , "O2 S3 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x37, "o2_current_4"          , "O2 S4 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x38, "o2_current_5"          , "O2 S5 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x39, "o2_current_6"          , "O2 S6 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x3A, "o2_current_7"          , "O2 S7 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x3B, "o2_current_8"          , "O2 S8 Lambda (I)"    , 4, "AB"    , LAMBDA, 0    , ""     ),
+    (0x3C, "catalyst_temp_b1s1"    , "Catalyst T B1S1"     , 2, "AB"    , 0.1   , -40  , "C"    ),
+    (0x3D, "catalyst_temp_b2s1"    , "Catalyst T B2S1"     , 2, "AB"    , 0.1   , -40  , "C"    ),
+    (0x3E, "catalyst_temp_b1s2"    , "Catalyst T B1S2"     , 2, "AB"    , 0.1   , -40  , "C"    ),
+    (0x3F, "catalyst_temp_b2s2"    , "Catalyst T B2S2"     , 2, "AB"    , 0.1   , -40  , "C"    ),
+    (0x40, "pids_41_60"            , "Supported PIDs 41-60", 4, "bits"  , 1     , 0    , ""     ),
+    (0x41, "monitor_status"        , "Monitor Status"      , 4, "raw"   , 1     , 0    , ""     ),
+    (0x42, "control_voltage"       , "Control Module V"    , 2, "AB"    , 0.001 , 0    , "V"    ),
+    (0x43, "absolute_load"         , "Absolute Load"       , 2, "AB"    , PERCENT, 0   , "%"    ),
+    (0x44, "commanded_lambda"      , "Commanded Lambda"    , 2, "AB"    , LAMBDA, 0    , ""     ),
+    (0x45, "relative_throttle_pos" , "Rel Throttle Pos"    , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x46, "ambient_air_temp"      , "Ambient Air Temp"    , 1, "A"     , 1     , -40  , "C"    ),
+    (0x47, "throttle_pos_b"        , "Abs Throttle Pos B"  , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x48, "throttle_pos_c"        , "Abs Throttle Pos C"  , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x49, "accelerator_pos_d"     , "Accel Pedal Pos D"   , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x4A, "accelerator_pos_e"     , "Accel Pedal Pos E"   , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x4B, "accelerator_pos_f"     , "Accel Pedal Pos F"   , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x4C, "throttle_actuator"     , "Cmd Throttle Act"    , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x4D, "engine_mil_time"       , "Engine Run MIL"      , 2, "AB"    , 1     , 0    , "min"  ),
+    (0x4E, "clr_time"              , "Time Since Cleared"  , 2, "AB"    , 1     , 0    , "min"  ),
+    (0x4F, "max_values"            , "Max Lambda/V/I/MAP"  , 4, "raw"   , 1     , 0    , ""     ),
+    (0x50, "max_maf"               , "Max AirFlow Rate"    , 4, "A"     , 10    , 0    , "g/s"  ),
+    (0x51, "fuel_type"             , "Fuel Type"           , 1, "raw"   , 1     , 0    , ""     ),
+    (0x52, "ethanol_percent"       , "Ethanol Fuel"        , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x53, "evap_pressure_abs"     , "Abs Evap Press"      , 2, "AB"    , 0.005 , 0    , "kPa"  ),
+    (0x54, "evap_pressure_2"       , "Evap Vapor Press 2"  , 2, "ABs"   , 1     , 0    , "Pa"   ),
+    (0x55, "short_o2_trim_1"       , "S-T O2 Trim B1"      , 2, "A"     , TRIM  , -100 , "%"    ),
+    (0x56, "long_o2_trim_1"        , "L-T O2 Trim B1"      , 2, "A"     , TRIM  , -100 , "%"    ),
+    (0x57, "short_o2_trim_2"       , "S-T O2 Trim B2"      , 2, "A"     , TRIM  , -100 , "%"    ),
+    (0x58, "long_o2_trim_2"        , "L-T O2 Trim B2"      , 2, "A"     , TRIM  , -100 , "%"    ),
+    (0x59, "fuel_rail_pressure_abs", "FuelRail P (abs)"    , 2, "AB"    , 10    , 0    , "kPa"  ),
+    (0x5A, "relative_accel_pos"    , "Rel Accel Pedal"     , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x5B, "hybrid_battery_life"   , "Hybrid Battery"      , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x5C, "oil_temp"              , "Oil Temp"            , 1, "A"     , 1     , -40  , "C"    ),
+    (0x5D, "fuel_injection_timing" , "Injection Timing"    , 2, "AB"    , 1/128.0, -210, "deg"  ),
+    (0x5E, "fuel_rate"             , "Fuel Rate"           , 2, "AB"    , 0.05  , 0    , "L/h"  ),
+    (0x5F, "emission_req"          , "Emission Reqs"       , 1, "raw"   , 1     , 0    , ""     ),
+    (0x60, "pids_61_80"            , "Supported PIDs 61-80", 4, "bits"  , 1     , 0    , ""     ),
+    (0x61, "driver_demand_torque"  , "Demand Torque"       , 1, "A"     , 1     , -125 , "%"    ),
+    (0x62, "actual_torque"         , "Actual Torque"       , 1, "A"     , 1     , -125 , "%"    ),
+    (0x63, "reference_torque"      , "Reference Torque"    , 2, "AB"    , 1     , 0    , "Nm"   ),
+    (0x64, "torque_points"         , "Torque Idle"         , 5, "A"     , 1     , -125 , "%"    ),
+    (0x65, "aux_io"                , "Aux Input/Output"    , 2, "raw"   , 1     , 0    , ""     ),
+    (0x66, "maf_sensors"           , "MAF Sensor A/B"      , 5, "raw"   , 1     , 0    , ""     ),
+    (0x67, "coolant_temps"         , "Coolant Temp 1/2"    , 3, "raw"   , 1     , 0    , ""     ),
+    (0x68, "intake_air_temps"      , "Intake Air T 1-3"    , 7, "raw"   , 1     , 0    , ""     ),
+    (0x69, "egr_data"              , "EGR Cmd/Error"       , 7, "raw"   , 1     , 0    , ""     ),
+    (0x6A, "diesel_intake_flow"    , "Diesel Intake Flow"  , 5, "raw"   , 1     , 0    , ""     ),
+    (0x6B, "egr_temp"              , "EGR Temp"            , 5, "raw"   , 1     , 0    , ""     ),
+    (0x6C, "throttle_actuator_ab"  , "Throttle Act A/B"    , 5, "raw"   , 1     , 0    , ""     ),
+    (0x6D, "fuel_pressure_control" , "Fuel Press Control"  , 6, "raw"   , 1     , 0    , ""     ),
+    (0x6E, "injection_pressure"    , "Injection Press"     , 5, "raw"   , 1     , 0    , ""     ),
+    (0x6F, "turbo_inlet_pressure"  , "Turbo Inlet Press"   , 3, "raw"   , 1     , 0    , ""     ),
+    (0x70, "boost_pressure"        , "Boost Press Ctrl"    , 9, "raw"   , 1     , 0    , ""     ),
+    (0x71, "vgt_control"           , "VGT Control"         , 5, "raw"   , 1     , 0    , ""     ),
+    (0x72, "wastegate_control"     , "Wastegate Control"   , 5, "raw"   , 1     , 0    , ""     ),
+    (0x73, "exhaust_pressure"      , "Exhaust Press"       , 5, "raw"   , 1     , 0    , ""     ),
+    (0x74, "turbo_rpm"             , "Turbo RPM"           , 5, "raw"   , 1     , 0    , ""     ),
+    (0x75, "turbo_temp_a"          , "Turbo A Temp"        , 7, "raw"   , 1     , 0    , ""     ),
+    (0x76, "turbo_temp_b"          , "Turbo B Temp"        , 7, "raw"   , 1     , 0    , ""     ),
+    (0x77, "charge_air_temp"       , "Charge Air Temp"     , 5, "raw"   , 1     , 0    , ""     ),
+    (0x78, "egt_bank_1"            , "EGT Bank 1"          , 9, "raw"   , 1     , 0    , ""     ),
+    (0x79, "egt_bank_2"            , "EGT Bank 2"          , 9, "raw"   , 1     , 0    , ""     ),
+    (0x7A, "dpf_pressure_1"        , "DPF Press B1"        , 7, "raw"   , 1     , 0    , ""     ),
+    (0x7B, "dpf_pressure_2"        , "DPF Press B2"        , 7, "raw"   , 1     , 0    , ""     ),
+    (0x7C, "dpf_temp"              , "DPF Temp"            , 9, "raw"   , 1     , 0    , ""     ),
+    (0x7D, "nox_nte_status"        , "NOx NTE Status"      , 1, "raw"   , 1     , 0    , ""     ),
+    (0x7E, "pm_nte_status"         , "PM NTE Status"       , 1, "raw"   , 1     , 0    , ""     ),
+    (0x7F, "engine_run_time"       , "Engine Run Time"     , 13, "raw"  , 1     , 0    , ""     ),
+    (0x80, "pids_81_a0"            , "Supported PIDs 81-A0", 4, "bits"  , 1     , 0    , ""     ),
+    (0x81, "aecd_time_1"           , "AECD 1-5 Run Time"   , 41, "raw"  , 1     , 0    , ""     ),
+    (0x82, "aecd_time_2"           , "AECD 6-10 Run Time"  , 41, "raw"  , 1     , 0    , ""     ),
+    (0x83, "nox_sensor"            , "NOx Sensor"          , 9, "raw"   , 1     , 0    , ""     ),
+    (0x84, "manifold_surface_temp" , "Manifold Surface T"  , 1, "A"     , 1     , -40  , "C"    ),
+    (0x85, "nox_reagent"           , "NOx Reagent System"  , 10, "raw"  , 1     , 0    , ""     ),
+    (0x86, "pm_sensor"             , "PM Sensor"           , 5, "raw"   , 1     , 0    , ""     ),
+    (0x87, "manifold_pressure_ab"  , "Intk Manifold A/B"   , 5, "raw"   , 1     , 0    , ""     ),
+    (0x88, "scr_inducement"        , "SCR Inducement"      , 13, "raw"  , 1     , 0    , ""     ),
+    (0x89, "aecd_time_3"           , "AECD 11-15 Run Time" , 41, "raw"  , 1     , 0    , ""     ),
+    (0x8A, "aecd_time_4"           , "AECD 16-20 Run Time" , 41, "raw"  , 1     , 0    , ""     ),
+    (0x8B, "diesel_aftertreatment" , "Aftertreatment"      , 7, "raw"   , 1     , 0    , ""     ),
+    (0x8C, "o2_wide_range"         , "O2 Wide Range"       , 17, "raw"  , 1     , 0    , ""     ),
+    (0x8D, "throttle_pos_g"        , "Throttle Pos G"      , 1, "A"     , PERCENT, 0   , "%"    ),
+    (0x8E, "friction_torque"       , "Friction Torque"     , 1, "A"     , 1     , -125 , "%"    ),
+    (0x8F, "pm_sensor_banks"       , "PM Sensor B1/B2"     , 7, "raw"   , 1     , 0    , ""     ),
+    (0x90, "wwh_obd_info"          , "WWH-OBD Info"        , 3, "raw"   , 1     , 0    , ""     ),
+    (0x91, "wwh_obd_info_2"        , "WWH-OBD Info 2"      , 5, "raw"   , 1     , 0    , ""     ),
+    (0x92, "fuel_system_control"   , "Fuel System Ctrl"    , 2, "raw"   , 1     , 0    , ""     ),
+    (0x93, "wwh_obd_counters"      , "WWH-OBD Counters"    , 3, "raw"   , 1     , 0    , ""     ),
+    (0x94, "nox_warning"           , "NOx Warning"         , 12, "raw"  , 1     , 0    , ""     ),
+    (0x98, "egt_sensor_1"          , "EGT Sensor B1"       , 9, "raw"   , 1     , 0    , ""     ),
+    (0x99, "egt_sensor_2"          , "EGT Sensor B2"       , 9, "raw"   , 1     , 0    , ""     ),
+    (0x9A, "hybrid_battery"        , "Hybrid Battery V"    , 6, "raw"   , 1     , 0    , ""     ),
+    (0x9B, "def_sensor"            , "DEF Sensor"          , 4, "raw"   , 1     , 0    , ""     ),
+    (0x9C, "o2_sensor_data"        , "O2 Sensor Data"      , 17, "raw"  , 1     , 0    , ""     ),
+    (0x9D, "engine_fuel_rate"      , "Engine Fuel Rate"    , 4, "AB"    , 0.02  , 0    , "g/s"  ),
+    (0x9E, "exhaust_flow"          , "Exhaust Flow"        , 2, "AB"    , 0.2   , 0    , "kg/h" ),
+    (0x9F, "fuel_system_use"       , "Fuel System Use"     , 9, "raw"   , 1     , 0    , ""     ),
+    (0xA0, "pids_a1_c0"            , "Supported PIDs A1-C0", 4, "bits"  , 1     , 0    , ""     ),
+    (0xA1, "nox_corrected"         , "NOx Corrected"       , 9, "raw"   , 1     , 0    , ""     ),
+    (0xA2, "cylinder_fuel_rate"    , "Cylinder Fuel Rate"  , 2, "AB"    , 1/32.0, 0    , "mg"   ),
+    (0xA3, "evap_pressure_3"       , "Evap Vapor Press 3"  , 9, "raw"   , 1     , 0    , ""     ),
+    (0xA4, "transmission_gear"     , "Transmission Gear"   , 4, "raw"   , 1     , 0    , ""     ),
+    (0xA5, "def_dosing"            , "Cmd DEF Dosing"      , 4, "raw"   , 1     , 0    , ""     ),
+    (0xA6, "odometer"              , "Odometer"            , 4, "ABCD"  , 0.1   , 0    , "km"   ),
+    (0xA7, "nox_sensor_2"          , "NOx Sensor 3/4"      , 4, "raw"   , 1     , 0    , ""     ),
+    (0xA8, "nox_corrected_2"       , "NOx Corrected 3/4"   , 4, "raw"   , 1     , 0    , ""     ),
+    (0xA9, "abs_switch"            , "ABS Disable Switch"  , 4, "raw"   , 1     , 0    , ""     ),
+    (0xC0, "pids_c1_e0"            , "Supported PIDs C1-E0", 4, "bits"  , 1     , 0    , ""     ),
+    ]
+# last PID covered; the ones not listed above get a raw placeholder
+LAST_PID = 0xC4
+
+def make_decoders(layout, scale, offset):
+    """Returns the decoders (hex string, raw bytes) of a catalogue layout.
+    One byte values are looked up in a table built here."""
+    if layout == "A":
+        table = [b * scale + offset for b in range(256)]
+        return (lambda code: table[int(code[:2], 16)],
+                lambda data: table[ord(data[0])])
+    if layout == "AB":
+        return (lambda code: int(code[:4], 16) * scale + offset,
+                lambda data: (ord(data[0]) << 8 | ord(data[1])) * scale + offset)
+    if layout == "ABs":
+        def signed(x):
+            if x & 0x8000:
+                x = x - 0x10000
+            return x * scale + offset
+        return (lambda code: signed(int(code[:4], 16)),
+                lambda data: signed(ord(data[0]) << 8 | ord(data[1])))
+    if layout == "ABCD":
+        return (lambda code: int(code[:8], 16) * scale + offset,
+                lambda data: (ord(data[0]) << 24 | ord(data[1]) << 16 |
+                              ord(data[2]) << 8 | ord(data[3])) * scale + offset)
+    if layout == "bits":
+        return (hex_to_bitstring, bitstring_raw)
+    if layout == "status":
+        return (dtc_decrypt, None)
+    return (cpass, None)
+
+class Sensor(object):
+    __slots__ = ("shortname", "name", "cmd", "pid", "value", "unit", "raw")
+
+    def __init__(self, shortName, sensorName, sensorcommand, sensorValueFunction, u, raw=None):
         self.shortname = shortName
         self.name = sensorName
         self.cmd  = sensorcommand
-        self.value= sensorValueFunction
+        self.pid = hex_to_int(sensorcommand[2:4])
+        self.value= sensorValueFunction # hex string -> value
         self.unit = u
+        self.raw = raw # raw bytes -> value, None decodes via hex
+
+    def decode(self, data):
+        """Returns the value of the data bytes (string) of a reply"""
+        if self.raw is not None:
+            return self.raw(data)
+        return self.value(hexlify(data).upper())
+
+def build_sensors():
+    """Returns the Sensor of every PID up to LAST_PID, so that
+    SENSORS[pid] is the sensor of pid"""
+    rows = dict([(row[0], row) for row in CATALOGUE])
+    sensors = []
+    for pid in range(LAST_PID + 1):
+        if pid in rows:
+            (pid, shortname, name, size, layout, scale, offset, unit) = rows[pid]
+        else:
+            (shortname, name, layout, unit) = ("pid_%02x" % pid, "PID %02X" % pid, "raw", "")
+            (scale, offset) = (1, 0)
+        value, raw = make_decoders(layout, scale, offset)
+        sensors.append(Sensor(shortname, name, "01%02X" % pid, value, unit, raw))
+    return sensors
+
+SENSORS = build_sensors()
+
+# constant time lookups besides SENSORS[pid]
+SENSOR_BY_PID = dict([(s.pid, s) for s in SENSORS])
+SENSOR_BY_NAME = dict([(s.shortname, s) for s in SENSORS])
+
+# number of data bytes the ECU returns for each mode 01 PID,
+# needed to split a reply carrying several PIDs
+PID_DATA_BYTES = dict([(row[0], row[3]) for row in CATALOGUE])
 
-SENSORS = [
-    Sensor("pids"                  , "Supported PIDs"				, "0100" , hex_to_bitstring ,""       ), 
-    Sensor("dtc_status"            , "S-S DTC Cleared"				, "0101" , dtc_decrypt      ,""       ),    
-    Sensor("dtc_ff"                , "DTC C-F-F"					, "0102" , cpass            ,""       ),      
-    Sensor("fuel_status"           , "Fuel System Stat"				, "0103" , cpass            ,""       ),
-    Sensor("load"                  , "Calc Load Value"				, "01041", percent_scale    ,""       ),    
-    Sensor("temp"                  , "Coolant Temp"					, "0105" , temp             ,"F"      ),
-    Sensor("short_term_fuel_trim_1", "S-T Fuel Trim"				, "0106" , fuel_trim_percent,"%"      ),
-    Sensor("long_term_fuel_trim_1" , "L-T Fuel Trim"				, "0107" , fuel_trim_percent,"%"      ),
-    Sensor("short_term_fuel_trim_2", "S-T Fuel Trim"				, "0108" , fuel_trim_percent,"%"      ),
-    Sensor("long_term_fuel_trim_2" , "L-T Fuel Trim"				, "0109" , fuel_trim_percent,"%"      ),
-    Sensor("fuel_pressure"         , "FuelRail Pressure"			, "010A" , cpass            ,""       ),
-    Sensor("manifold_pressure"     , "Intk Manifold"				, "010B" , intake_m_pres    ,"psi"    ),
-    Sensor("rpm"                   , "Engine RPM"					, "010C1", rpm              ,""       ),
-    Sensor("speed"                 , "Vehicle Speed"				, "010D1", speed            ,"MPH"    ),
-    Sensor("timing_advance"        , "Timing Advance"				, "010E" , timing_advance   ,"degrees"),
-    Sensor("intake_air_temp"       , "Intake Air Temp"				, "010F" , temp             ,"F"      ),
-    Sensor("maf"                   , "AirFlow Rate(MAF)"			, "0110" , maf              ,"lb/min" ),
-    Sensor("throttle_pos"          , "Throttle Position"			, "01111", throttle_pos     ,"%"      ),
-    Sensor("secondary_air_status"  , "2nd Air Status"				, "0112" , cpass            ,""       ),
-    Sensor("o2_sensor_positions"   , "Loc of O2 sensors"			, "0113" , cpass            ,""       ),
-    Sensor("o211"                  , "O2 Sensor: 1 - 1"				, "0114" , fuel_trim_percent,"%"      ),
-    Sensor("o212"                  , "O2 Sensor: 1 - 2"				, "0115" , fuel_trim_percent,"%"      ),
-    Sensor("o213"                  , "O2 Sensor: 1 - 3"				, "0116" , fuel_trim_percent,"%"      ),
-    Sensor("o214"                  , "O2 Sensor: 1 - 4"				, "0117" , fuel_trim_percent,"%"      ),
-    Sensor("o221"                  , "O2 Sensor: 2 - 1"				, "0118" , fuel_trim_percent,"%"      ),
-    Sensor("o222"                  , "O2 Sensor: 2 - 2"				, "0119" , fuel_trim_percent,"%"      ),
-    Sensor("o223"                  , "O2 Sensor: 2 - 3"				, "011A" , fuel_trim_percent,"%"      ),
-    Sensor("o224"                  , "O2 Sensor: 2 - 4"				, "011B" , fuel_trim_percent,"%"      ),
-    Sensor("obd_standard"          , "OBD Designation"				, "011C" , cpass            ,""       ),
-    Sensor("o2_sensor_position_b"  , "Loc of O2 sensor" 			, "011D" , cpass            ,""       ),
-    Sensor("aux_input"             , "Aux input status"				, "011E" , cpass            ,""       ),
-    Sensor("engine_time"           , "Engine Start MIN"				, "011F" , sec_to_min       ,"min"    ),
-    Sensor("engine_mil_time"       , "Engine Run MIL"				, "014D" , sec_to_min       ,"min"    ),
-    ]
-     
     
 #___________________________________________________________
 
 def test():
     for i in SENSORS:
-        print i.name, i.value("F")
+        print i.name, i.value("FF" * PID_DATA_BYTES.get(i.pid, 4))
 
 if __name__ == "__main__":
     test()
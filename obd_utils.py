@@ -1,32 +1,103 @@
 import serial
 import platform
+import os
+import re
+import glob
+import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+import obd_io
+
+# where the last port that worked is remembered
+PORT_CACHE = os.path.expanduser("~/.pyobd_port")
+
+def device_number(name):
+    return int(re.sub("[^0-9]", "", name) or 0)
 
 def scanSerial():
     """scan for available ports. return a list of serial names"""
     available = []
  # Enable Bluetooh connection
-    for i in range(10):
-      try:
-		s = serial.Serial("/dev/rfcomm"+str(i))
-		available.append( (str(s.port)))
-		s.close()   # explicit close 'cause of delayed GC in java
-      except serial.SerialException:
-		pass
+    available.extend(sorted(glob.glob("/dev/rfcomm[0-9]*"), key=device_number))
  # Enable USB connection
-    for i in range(256):
-      try:
-        s = serial.Serial("/dev/ttyUSB"+str(i))
-        available.append(s.portstr)
-        s.close()   # explicit close 'cause of delayed GC in java
-      except serial.SerialException:
+    available.extend(sorted(glob.glob("/dev/ttyUSB[0-9]*"), key=device_number))
+ # Enable obdsim
+    #available.extend(sorted(glob.glob("/dev/pts/[0-9]*"), key=device_number))
+
+    return available
+
+def load_last_port():
+    """Returns {"port": name, "baud": rate, "max_baud": rate} of the last
+    adapter that worked, or None. baud is the rate the adapter answered
+    at, max_baud the one ATBRD got to."""
+    try:
+        f = open(PORT_CACHE)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+def save_last_port(port):
+    """Remembers the serial settings of a connected OBDPort"""
+    try:
+        f = open(PORT_CACHE, "w")
+        json.dump({"port": port.port.name, "baud": port.adapter_baud,
+                   "max_baud": port.port.baudrate}, f)
+        f.close()
+    except IOError:
         pass
- # Enable obdsim 
-    #for i in range(256):
-      #try: #scan Simulator
-        #s = serial.Serial("/dev/pts/"+str(i))
-        #available.append(s.portstr)
-        #s.close()   # explicit close 'cause of delayed GC in java
-      #except serial.SerialException:
-        #pass
-    
-    return available
\ No newline at end of file
+
+def find_adapter(notify_window=None, SERTIMEOUT=2, RECONNATTEMPTS=2, candidates=None,
+                 max_baud=None):
+    """Returns a connected OBDPort or None. The last port that worked is
+    tried first, then all other candidates (default: scanSerial()) are
+    probed at the same time. With max_baud the adapter is switched to
+    the fastest rate up to max_baud that works."""
+    if candidates is None:
+        candidates = scanSerial()
+    candidates = list(candidates)
+    last = load_last_port()
+    if last is not None and last.get("port") in candidates:
+        candidates.remove(last["port"])
+        baud = last.get("baud", obd_io.DEFAULT_BAUD)
+        last_max = max_baud
+        if max_baud is not None and "max_baud" in last: # skip rates that failed
+            last_max = min(max_baud, last["max_baud"])
+        port = obd_io.OBDPort(last["port"], notify_window, SERTIMEOUT, RECONNATTEMPTS,
+                              baud=baud, max_baud=last_max)
+        if port.State == 1:
+            save_last_port(port)
+            return port
+        port.close()
+    if len(candidates) == 0:
+        return None
+
+    lock = threading.Lock()
+    found = []
+    def probe(name):
+        port = obd_io.OBDPort(name, notify_window, SERTIMEOUT, RECONNATTEMPTS,
+                              max_baud=max_baud)
+        lock.acquire()
+        keep = port.State == 1 and len(found) == 0
+        if keep:
+            found.append(port)
+        lock.release()
+        if not keep: # failed, or another adapter answered first
+            port.close()
+            return None
+        return port
+
+    # probes still running when one succeeds finish in the background
+    pool = ThreadPool(len(candidates))
+    port = None
+    for port in pool.imap_unordered(probe, candidates):
+        if port is not None:
+            break
+    pool.close()
+
+    if port is not None:
+        save_last_port(port)
+    return port